@@ -26,29 +26,55 @@ MY TASKS
 """
 
 import argparse
-import pandas as pd
 from datetime import datetime
-from time import sleep
+from time import sleep, perf_counter, process_time
 import sys
 import os
 import logging
-from colorama import just_fix_windows_console#, init
-from fpdf import FPDF
+import importlib
+import importlib.util
 from decimal import Decimal
-import ast
+import tempfile
+import hashlib
+import pickle
+import tracemalloc
+import cProfile
+from itertools import islice
+import glob
+import json
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import threading
+
+# pandas and numpy take most of the startup time, so they are only imported the first time an attribute is used.
+# fpdf, colorama, ast and http.server are imported inside the functions that need them
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+    
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.__dict__['module'] = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
 
 # set global variables
 sleep_time = 0
 num_students_per_school = 12
 max_school_id = 425
 tests = {'1':'Biology', '2':'Chemistry', '3':'Mathematics', '4':'Physics', '5':'Computer Science'}
-pd.set_option('display.max_rows', None)
-pd.set_option('display.max_columns', None)
-pd.set_option('display.max_colwidth', 30)
 
-# initialize colors for terminal
-just_fix_windows_console()
-#init()
+# display options for printing tables and colors for terminal, called by main so importing MaST.py changes nothing
+def setup_terminal():
+    from colorama import just_fix_windows_console#, init
+    pd.set_option('display.max_rows', None)
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.max_colwidth', 30)
+    just_fix_windows_console()
+    #init()
 def red(phrase): return("\033[91m"+phrase+"\033[0m") 
 def grey(phrase): return("\033[90m"+phrase+"\033[0m")
 def green(phrase): return("\033[92m"+phrase+"\033[0m")
@@ -63,13 +89,51 @@ current_month = datetime.now().strftime("%B")
 current_day = datetime.now().day
 file_date_tag = '-'+str(current_year)+"-"+current_weekday
 logfile = 'MaST-'+str(current_year)+'.log'
-logging.basicConfig(filename=logfile, level = logging.INFO, format="%(asctime)s %(message)s")
 cwd = os.getcwd()
 
 # function to load test keys, schools, and students excel files
+# parsed spreadsheets are pickled in cache_folder so unchanged inputs skip pd.read_excel. An entry is reused when the
+# file's mtime and size match, or failing that its content hash, so editing a spreadsheet invalidates it. --no_cache turns this off
+cache_folder = '.mast-cache'
+use_cache = True
+
+def cache_path(file, reader):
+    name = hashlib.sha256((reader+'|'+os.path.abspath(file)).encode()).hexdigest()[:32]
+    return os.path.join(cache_folder, name+'.pkl')
+
+def cached_read(file, reader):
+    read = getattr(pd, reader)
+    if not use_cache:
+        return read(file)
+    stat = os.stat(file)
+    path = cache_path(file, reader)
+    try:
+        with open(path, 'rb') as f:
+            entry = pickle.load(f)
+    except Exception:
+        entry = None
+    if entry is not None and (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+        logging.info('Loaded '+file+' from '+path)
+        return entry['df']
+    digest = file_hash(file)
+    if entry is not None and entry['sha256'] == digest:
+        df = entry['df']
+        logging.info('Loaded '+file+' from '+path+' (touched but unchanged)')
+    else:
+        df = read(file)
+    entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': digest, 'df': df}
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_folder, suffix='.pkl', delete=False) as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+    except OSError as e:
+        logging.info('Could not cache '+file+': '+str(e))
+    return df
+
 def safe_open_excel(flag, file):
     try:
-        df = pd.read_excel(file)
+        df = cached_read(file, 'read_excel')
     except:
         print(flag+' '+file.ljust(30)+red('Fail'))
         print('\nExiting')
@@ -84,7 +148,7 @@ def safe_open_excel(flag, file):
 # semi-redudant function but I'm lazy
 def safe_open_csv(flag, file):
     try:
-        df = pd.read_csv(file)
+        df = cached_read(file, 'read_csv')
     except:
         print(flag+' '+file.ljust(30)+red('Fail'))
         print('\nExiting')
@@ -96,186 +160,1473 @@ def safe_open_csv(flag, file):
     sleep(sleep_time)
     return df
 
-# agg df creation
+# -- Instrumentation --
+
+# every stage of a run records wall time, cpu time, peak memory and row counts. Finished stages go to the log and to
+# stage_records, which main appends to stages_filename as one json line per run. Peak memory is the process's peak
+# resident size so far, which is cheap to read. --profile sets profile_folder and each stage then also dumps a cProfile
+# .prof file there and measures its own peak with tracemalloc, which is exact per stage but makes pure python code slower
+stages_filename = 'MaST-stages'+file_date_tag+'.jsonl'
+stage_records = []
+open_stages = []
+profile_folder = None
+
+# peak resident memory of this process in MB, None where the resource module is missing (Windows)
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+
+def measure_start(name, profile=None):
+    record = {'stage': name, 'wall': perf_counter(), 'cpu': process_time(), 'inner_peak': 0, 'profiler': None, 'profile': profile}
+    if profile is not None:
+        if not tracemalloc.is_tracing(): tracemalloc.start()
+        # an inner stage resets the peak, so the stage around it keeps the highest peak seen so far
+        if open_stages: open_stages[-1]['inner_peak'] = max(open_stages[-1]['inner_peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        # cProfile can't nest, only the outermost stage is profiled
+        if not any(stage['profiler'] for stage in open_stages):
+            record['profiler'] = cProfile.Profile()
+            record['profiler'].enable()
+    open_stages.append(record)
+    return record
+
+def measure_stop(record, rows=None):
+    open_stages.remove(record)
+    wall, cpu = perf_counter() - record['wall'], process_time() - record['cpu']
+    if record['profile'] is None:
+        peak, memory = peak_rss(), 'rss'
+    else:
+        if record['profiler'] is not None:
+            record['profiler'].disable()
+            os.makedirs(record['profile'], exist_ok=True)
+            name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in record['stage'])
+            record['profiler'].dump_stats(os.path.join(record['profile'], name+'.prof'))
+        peak = max(tracemalloc.get_traced_memory()[1], record['inner_peak'])
+        if open_stages: open_stages[-1]['inner_peak'] = max(open_stages[-1]['inner_peak'], peak)
+        peak, memory = peak/2**20, 'tracemalloc'
+    return {'stage': record['stage'], 'wall': wall, 'cpu': cpu, 'peak_mb': peak, 'memory': memory, 'rows': None if rows is None else int(rows), 'pid': os.getpid()}
+
+def log_stage(result):
+    stage_records.append(result)
+    peak = '' if result['peak_mb'] is None else f", {result['peak_mb']:.1f} MB peak"
+    rows = '' if result['rows'] is None else f", {result['rows']} rows"
+    logging.info(f"Stage {result['stage']}: {result['wall']:.3f} s wall, {result['cpu']:.3f} s cpu{peak}{rows}")
+
+def begin_stage(name):
+    return measure_start(name, profile_folder)
+
+def end_stage(record, rows=None):
+    result = measure_stop(record, rows)
+    log_stage(result)
+    return result
+
+# appends the stages of this run to stages_filename
+def write_stage_report(command, started, filename=None):
+    filename = filename or stages_filename
+    while open_stages: end_stage(open_stages[-1])
+    run = {'command': command, 'argv': sys.argv[1:], 'started': str(started), 'stages': stage_records}
+    with open(filename, 'a') as f:
+        f.write(json.dumps(run)+'\n')
+
+# quantiles computed for every test, all q_list_small and q_list_large values HAVE to be in q_options
+q_options = [0.99, 0.98, 0.97, 0.96, 0.95, 0.94, 0.90, 0.88, 0.80, 0.75, 0.50]
+q_list_small = [0.98, 0.96, 0.94, 0.88, 0.75, 0.50] # tests with less than 100 entries
+q_list_large = [0.99, 0.98, 0.97, 0.90, 0.80, 0.50]
+
+# agg df creation - count, max, and every q_options quantile for each test
+# np.percentile on q*100 is exactly what Series.quantile(q, interpolation='linear') computes, so thresholds match it to the last bit
 def make_agg_df(df):
-    
-    # renames agg quantile columns
-    def rename(newname):
-        def decorator(f):
-            f.__name__ = newname
-            return f
-        return decorator
-    
-    # calculates variable quantile
-    def q_at(y):
-        @rename(f'q{y:0.2f}')
-        def q(x):
-            return x.quantile(y, interpolation='linear')
-        return q
-    
-    # creates agg dataframe with count, max, and quantile values
-    q_options = [0.99, 0.98, 0.97, 0.96, 0.95, 0.94, 0.90, 0.88, 0.80, 0.75, 0.50]
-    #q_options_small = [0.98, 0.96, 0.94, 0.85, 0.70, 0.50]
-    agg_columns = ['count', 'max']
-    for item in q_options:
-        agg_columns.append(q_at(item))
-    agg_series = {'Score': agg_columns}
-    data_df_agg = df.groupby('Test').agg(agg_series)
+    scores = df['Score'].to_numpy()
+    percentiles = np.array(q_options) * 100
+    rows = {}
+    for test, indices in sorted(df.groupby('Test').indices.items()):
+        test_scores = scores[indices]
+        rows[test] = [len(test_scores), test_scores.max()] + list(np.percentile(test_scores, percentiles, method='linear'))
+    columns = pd.MultiIndex.from_product([['Score'], ['count', 'max'] + [f'q{q:0.2f}' for q in q_options]])
+    data_df_agg = pd.DataFrame.from_dict(rows, orient='index', columns=columns)
+    data_df_agg.index.name = 'Test'
     return data_df_agg
 
+# ascending quantile thresholds of a test and the award bands lined up with the number of thresholds reached, none
+# reached wraps around to the last entry
+def award_bands(data_df_agg, test):
+    q_list = q_list_small if data_df_agg.loc[test, ('Score', 'count')] < 100 else q_list_large
+    q_ascending = q_list[::-1]
+    thresholds = data_df_agg.loc[test, [('Score', f'q{q:0.2f}') for q in q_ascending]].to_numpy(dtype=float)
+    bands = np.array([Decimal('1.00') - Decimal(str(q)) for q in q_ascending] + [Decimal('0.99')], dtype=object)
+    return thresholds, bands
+
+# award band of every test, the largest q whose quantile the score reaches (as 1 - q) and 0.99 if it reaches none
+def assign_quantiles(df, data_df_agg):
+    calc_quantiles = np.empty(len(df), dtype=object)
+    scores = df['Score'].to_numpy()
+    for test, rows in df.groupby('Test').indices.items():
+        thresholds, bands = award_bands(data_df_agg, test)
+        calc_quantiles[rows] = bands[np.searchsorted(thresholds, scores[rows], side='right') - 1]
+    return pd.Series(calc_quantiles, index=df.index, name='Calc Quantile')
+
+# np.percentile(scores, percentiles, method='linear') from counts[s], the number of times score s was scored. The k-th
+# smallest score is the first s with more than k scores at or below it, and the interpolation is done with the same
+# float operations numpy uses so the results are identical, not just close
+def histogram_percentiles(counts, percentiles):
+    n = int(counts.sum())
+    cumulative = np.cumsum(counts)
+    virtual_indexes = (n - 1) * np.true_divide(percentiles, 100)
+    previous_indexes = np.floor(virtual_indexes)
+    gamma = virtual_indexes - previous_indexes
+    previous_indexes = previous_indexes.astype(np.intp)
+    next_indexes = previous_indexes + 1
+    above = virtual_indexes >= n - 1
+    previous_indexes[above] = n - 1
+    next_indexes[above] = n - 1
+    previous_scores = np.searchsorted(cumulative, previous_indexes, side='right')
+    next_scores = np.searchsorted(cumulative, next_indexes, side='right')
+    diff = next_scores - previous_scores
+    result = previous_scores + diff * gamma
+    np.subtract(next_scores, diff * (1 - gamma), out=result, where=gamma >= 0.5)
+    return result
+
+# standings kept up to date one sheet at a time. Scores are small integers, so each test keeps a histogram of its
+# scores for every school, and a new or corrected sheet only changes a couple of counts. Quantiles, award bands and
+# school points are then recomputed from the histograms of the tests that changed, which costs the number of distinct
+# scores and schools rather than the number of sheets. Gives exactly what make_agg_df, assign_quantiles and
+# assign_school_points give on the same data. Rows are identified by position, the way update mode only ever appends
+class Standings:
+    def __init__(self, df=None):
+        self.tests = np.empty(0, dtype=object)
+        self.school_ids = np.empty(0, dtype=object)
+        self.scores = np.empty(0, dtype=object)
+        self.school_dtype = None
+        # row 0 of every histogram is for sheets without a school id
+        self.school_rows = {}
+        self.school_sheets = np.zeros(1, dtype=np.int64)
+        self.histograms = {}
+        self.stale = set()
+        self.rows = {}
+        self.score_bands = {}
+        self.test_points = {}
+        if df is not None: self.update(df)
+    
+    # histogram row of every school id, adding rows for new schools
+    def school_rows_of(self, school_ids):
+        rows = np.zeros(len(school_ids), dtype=np.intp)
+        known = ~pd.isna(school_ids)
+        for school_id in pd.unique(school_ids[known]):
+            self.school_rows.setdefault(school_id, len(self.school_rows) + 1)
+        rows[known] = pd.Index(list(self.school_rows)).get_indexer(school_ids[known]) + 1
+        if len(self.school_rows) + 1 > len(self.school_sheets):
+            self.school_sheets = np.pad(self.school_sheets, (0, len(self.school_rows) + 1 - len(self.school_sheets)))
+        return rows
+    
+    # adds (count 1) or takes away (count -1) sheets
+    def add(self, tests, school_ids, scores, count=1):
+        rows = self.school_rows_of(school_ids)
+        np.add.at(self.school_sheets, rows, count)
+        graded = ~(pd.isna(tests) | pd.isna(scores))
+        for test in pd.unique(tests[graded]):
+            sheets = graded & (tests == test)
+            test_scores = scores[sheets].astype(np.intp)
+            if test_scores.min() < 0: raise ValueError(f'Scores have to be 0 or more, not {test_scores.min()}')
+            histogram = self.histograms.get(test, np.zeros((1, 0), dtype=np.int64))
+            shape = (len(self.school_sheets), max(histogram.shape[1], test_scores.max() + 1))
+            if histogram.shape != shape:
+                histogram = np.pad(histogram, [(0, shape[0] - histogram.shape[0]), (0, shape[1] - histogram.shape[1])])
+            np.add.at(histogram, (rows[sheets], test_scores), count)
+            self.histograms[test] = histogram
+            if not histogram.any(): del self.histograms[test]
+            self.stale.add(test)
+    
+    # brings the histograms in line with df (columns Test, School ID and Score), returns the number of sheets that changed.
+    # Only new rows and rows whose test, school or score differ from last time are counted again
+    def update(self, df):
+        tests, school_ids, scores = (df[column].to_numpy(copy=True) for column in ['Test', 'School ID', 'Score'])
+        if len(tests) < len(self.tests): raise ValueError('Rows can only be added, not removed')
+        self.school_dtype = df['School ID'].dtype
+        changed = np.zeros(len(tests), dtype=bool)
+        changed[len(self.tests):] = True
+        old = slice(0, len(self.tests))
+        for new_values, old_values in [(tests, self.tests), (school_ids, self.school_ids), (scores, self.scores)]:
+            different = np.flatnonzero(new_values[old] != old_values)
+            different = different[~(pd.isna(new_values[different]) & pd.isna(old_values[different]))]
+            changed[different] = True
+        positions = np.flatnonzero(changed)
+        removed = positions[positions < len(self.tests)]
+        if len(removed):
+            self.add(self.tests[removed], self.school_ids[removed], self.scores[removed], -1)
+        if len(positions):
+            self.add(tests[positions], school_ids[positions], scores[positions])
+        self.tests, self.school_ids, self.scores = tests, school_ids, scores
+        return len(positions)
+    
+    # recomputes the quantiles, award band of each score and points of each school for the tests that changed
+    def refresh(self):
+        percentiles = np.array(q_options) * 100
+        for test in self.stale:
+            self.rows.pop(test, None)
+            self.score_bands.pop(test, None)
+            self.test_points.pop(test, None)
+            if test not in self.histograms: continue
+            histogram = self.histograms[test].sum(axis=0)
+            count = int(histogram.sum())
+            self.rows[test] = [count, np.int64(np.flatnonzero(histogram)[-1])] + list(histogram_percentiles(histogram, percentiles))
+            thresholds, bands = award_bands(self.agg(test), test)
+            self.score_bands[test] = bands[np.searchsorted(thresholds, np.arange(len(histogram)), side='right') - 1]
+            points_mapping = points_mapping_small if count < 100 else points_mapping_large
+            points = np.array([points_mapping.get(str(float(band)), 0) for band in self.score_bands[test]], dtype=np.int64)
+            self.test_points[test] = self.histograms[test] @ points
+        self.stale = set()
+    
+    # same as make_agg_df, for one test or all of them
+    def agg(self, test=None):
+        if test is None:
+            self.refresh()
+            tests = sorted(self.rows)
+        else:
+            tests = [test]
+        columns = pd.MultiIndex.from_product([['Score'], ['count', 'max'] + [f'q{q:0.2f}' for q in q_options]])
+        data_df_agg = pd.DataFrame.from_dict({test: self.rows[test] for test in tests}, orient='index', columns=columns)
+        data_df_agg.index.name = 'Test'
+        return data_df_agg
+    
+    # same as assign_quantiles, the Calc Quantile of every row of df
+    def calc_quantiles(self, df):
+        self.refresh()
+        calc_quantiles = np.empty(len(df), dtype=object)
+        scores = df['Score'].to_numpy()
+        for test, rows in df.groupby('Test').indices.items():
+            calc_quantiles[rows] = self.score_bands[test][scores[rows].astype(np.intp)]
+        return pd.Series(calc_quantiles, index=df.index, name='Calc Quantile')
+    
+    # same as rank_schools on assign_school_points, the School Points total of each school highest first
+    def school_points(self):
+        self.refresh()
+        totals = np.zeros(len(self.school_sheets), dtype=np.int64)
+        for test_points in self.test_points.values():
+            totals[:len(test_points)] += test_points
+        school_ids = sorted(school_id for school_id, row in self.school_rows.items() if self.school_sheets[row])
+        index = pd.Index(school_ids, dtype=self.school_dtype, name='School ID')
+        school_points = pd.Series(totals[[self.school_rows[school_id] for school_id in school_ids]], index=index, name='School Points')
+        return school_points.sort_values(ascending=False)
+
+# -- Scantron ASCII --
+
+# fixed-width layout of a Scantron ASCII line
+ascii_id_columns = (40, 45) # 3 digit school id followed by 2 digit student id
+ascii_test_columns = (50, 56) # test number
+ascii_answers_column = 56 # answer block runs from here to the end of the line
+ascii_chunk_lines = 100000 # lines decoded at a time, bounds memory use for very large files
+ascii_form_column = None # column of the form code for tests with scrambled versions, None when there is none
+
+# byte lookup table to map answer bubbles 1-5 to letters A-E, everything else is left alone
+def multchoice_table():
+    table = np.arange(256, dtype=np.uint8)
+    table[np.frombuffer(b'12345', dtype=np.uint8)] = np.frombuffer(b'ABCDE', dtype=np.uint8)
+    return table
+
+# a form column (counted from 0) has to sit in front of the answer block and outside the id and test number fields
+def check_form_column(form_column):
+    if form_column is None: return
+    taken = set(range(*ascii_id_columns)) | set(range(*ascii_test_columns))
+    if not 0 <= form_column < ascii_answers_column or form_column in taken:
+        raise ValueError(f'Form column {form_column+1} has to be between 1 and {ascii_answers_column} and outside the id columns '
+                         f'{ascii_id_columns[0]+1}-{ascii_id_columns[1]} and test columns {ascii_test_columns[0]+1}-{ascii_test_columns[1]}')
+
+# decodes a list of raw ascii lines (bytes, no line endings) at once with byte slicing of a 2-D character matrix
+def parse_ascii_lines(lines, form_column=None):
+    check_form_column(form_column)
+    packed = np.array(lines, dtype='S')
+    width = max(packed.dtype.itemsize, ascii_answers_column + 1, (form_column or 0) + 1)
+    matrix = packed.astype(f'S{width}').view(np.uint8).reshape(len(packed), width)
+    
+    # a blank (or anything that isn't a digit) in the id sets school and student id to 000 and 00 which will flag later for user input
+    ids = matrix[:, ascii_id_columns[0]:ascii_id_columns[1]].astype(np.int64) - ord('0')
+    blank_id = ((ids < 0) | (ids > 9)).any(axis=1)
+    ids[blank_id] = 0
+    school_ids = ids[:, 0]*100 + ids[:, 1]*10 + ids[:, 2]
+    student_ids = ids[:, 3]*10 + ids[:, 4]
+    
+    # a blank test number becomes 0 which will flag later for user input
+    test_ids = np.ascontiguousarray(matrix[:, ascii_test_columns[0]:ascii_test_columns[1]]).view(f'S{ascii_test_columns[1]-ascii_test_columns[0]}').ravel()
+    test_ids = np.char.strip(test_ids)
+    test_ids[test_ids == b''] = b'0'
+    test_names = pd.Series(test_ids.astype('U')).map(tests).fillna('None') # to replace test number with name
+    
+    answers = np.ascontiguousarray(multchoice_table()[matrix[:, ascii_answers_column:]])
+    answers = answers.view(f'S{width-ascii_answers_column}').ravel().astype('U')
+    
+    df = pd.DataFrame({'School ID': school_ids, 'Student ID': student_ids, 'Test': test_names.to_numpy(dtype=object),
+                       'Answers': answers.astype(object), 'Score': 0})
+    # form bubbles read 1-5 like the answers, a blank form is left empty and flags later if the test has several forms
+    if form_column is not None:
+        forms = np.ascontiguousarray(multchoice_table()[matrix[:, form_column]]).view('S1').astype('U')
+        df.insert(3, 'Form', np.char.strip(forms).astype(object))
+    return df
+
+# streams the ascii file from Scantron and yields one DataFrame per chunk of lines, blank lines are ignored
+def read_ascii_chunks(ascii_file, chunk_lines=None, form_column=None):
+    chunk_lines = chunk_lines or ascii_chunk_lines
+    with open(ascii_file, 'rb') as f:
+        while True:
+            lines = [line.rstrip(b'\r\n') for line in islice(f, chunk_lines)]
+            if not lines: break
+            lines = [line for line in lines if line.strip()]
+            if lines: yield parse_ascii_lines(lines, form_column)
+
+# whole ascii file as one DataFrame
+def read_ascii(ascii_file, form_column=None):
+    chunks = list(read_ascii_chunks(ascii_file, form_column=form_column))
+    if not chunks: return pd.DataFrame(columns=['School ID','Student ID','Test'] + (['Form'] if form_column is not None else []) + ['Answers','Score'])
+    return pd.concat(chunks, ignore_index=True)
+
+# expands files, directories (every .dat file inside) and glob patterns into a sorted list of ascii files
+def expand_ascii_files(patterns):
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '*.dat')))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        files.extend(match for match in matches if match not in files)
+    return files
+
+# parses several ascii files in a process pool, returns a DataFrame or the exception raised for each file in order
+def read_ascii_files(files, workers=None, form_column=None):
+    if len(files) < 2 or workers == 1:
+        results = []
+        for file in files:
+            try:
+                results.append(read_ascii(file, form_column))
+            except Exception as e:
+                results.append(e)
+        return results
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(read_ascii, file, form_column) for file in files]:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+    return results
+
+# -- Ingest manifest --
+
+# content hash of every ascii file already added to the data file so the same batch is never appended twice
+manifest_filename = 'MaST-ingest'+file_date_tag+'.json'
+
+def file_hash(file):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(manifest, filename):
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+# -- Grading --
+
+# packs answer sheets (lists or strings of letters) into a 2-D uint8 matrix of character codes, padded with zeros
+def answers_to_matrix(answers, width=0):
+    answers = pd.Series(answers, dtype=object)
+    if len(answers) and not isinstance(answers.iloc[0], str):
+        answers = answers.str.join('')
+    packed = np.array(answers.tolist(), dtype='S')
+    width = max(width, packed.dtype.itemsize)
+    packed = packed.astype(f'S{width}')
+    return packed.view(np.uint8).reshape(len(packed), width)
+
+# key columns are named after a test (Biology) or, for scrambled versions of a test, the test and a one character form
+# code (Biology A, Biology B). A column named after a key column and ' weights' gives the points for each question of
+# that key. Weights have to be whole numbers so scores stay whole, a blank weight counts 1
+def split_key_column(column):
+    test, _, form = str(column).rpartition(' ')
+    if test in tests.values() and len(form) == 1: return test, form
+    return str(column), ''
+
+def key_column_name(test, form):
+    return test+' '+form if form else test
+
+# packs keys_df into a key matrix with one row per key column, blank or odd key cells become 0 so they never match.
+# Returns the key columns as a (Test, Form) index, the key matrix and the matching matrix of question weights
+def keys_to_matrix(keys_df):
+    weight_columns = [column for column in keys_df.columns if str(column).endswith(' weights')]
+    key_df = keys_df.drop(columns=weight_columns)
+    cells = np.array(key_df.astype(str).to_numpy(), dtype='U')
+    cells[key_df.isna().to_numpy() | (np.char.str_len(cells) != 1)] = ''
+    key_matrix = np.array(cells.T, dtype='S1').view(np.uint8)
+    key_index = pd.MultiIndex.from_tuples([split_key_column(column) for column in key_df.columns], names=['Test', 'Form'])
+    weights = np.ones(key_matrix.shape, dtype=np.int64)
+    key_names = [str(column) for column in key_df.columns]
+    for column in weight_columns:
+        key_name = str(column)[:-len(' weights')]
+        if key_name not in key_names:
+            raise ValueError(f"Weights column '{column}' has no key column '{key_name}'")
+        column_weights = pd.to_numeric(keys_df[column]).fillna(1).to_numpy(dtype=float)
+        if (column_weights != np.round(column_weights)).any() or (column_weights < 0).any():
+            raise ValueError(f"Weights in '{column}' have to be whole numbers of 0 or more")
+        weights[key_names.index(key_name)] = column_weights.astype(np.int64)
+    return key_index, key_matrix, weights
+
+# form codes of the tests with more than one key, a sheet of one of these tests needs one of its forms
+def key_forms(keys_df):
+    key_index = keys_to_matrix(keys_df)[0]
+    forms = pd.Series(key_index.get_level_values('Form'), index=key_index.get_level_values('Test'))
+    return {test: set(test_forms) for test, test_forms in forms.groupby(level=0) if len(test_forms) > 1}
+
+# row of the key matrix for every sheet, -1 if there is no key for it. A sheet is graded with the key of its test and
+# form, and a test with a single key grades every sheet of that test whatever form was bubbled
+def sheet_key_rows(df, key_index):
+    sheet_tests = df['Test'].astype(str).to_numpy()
+    sheet_forms = df['Form'].fillna('').astype(str).to_numpy() if 'Form' in df else np.full(len(df), '')
+    rows = key_index.get_indexer(pd.MultiIndex.from_arrays([sheet_tests, sheet_forms]))
+    single = pd.Series(np.arange(len(key_index)), index=key_index.get_level_values('Test'))
+    single = single[~single.index.duplicated(keep=False)]
+    missing = rows == -1
+    rows[missing] = single.reindex(sheet_tests[missing]).fillna(-1).to_numpy(dtype=np.intp)
+    return rows
+
+# grades every sheet at once whatever its test and form, returns scores and the per-question correctness matrix
+def grade_tests(df, keys_df):
+    key_index, key_matrix, weights = keys_to_matrix(keys_df)
+    answer_matrix = answers_to_matrix(df['Answers'], key_matrix.shape[1])
+    # pad keys to the widest sheet and add an all-blank row at the end for sheets without a key (indexed by -1)
+    padding = ((0, 1), (0, answer_matrix.shape[1] - key_matrix.shape[1]))
+    key_matrix = np.pad(key_matrix, padding)
+    rows = sheet_key_rows(df, key_index)
+    sheet_keys = key_matrix[rows]
+    correct = (answer_matrix == sheet_keys) & (sheet_keys != 0)
+    if (weights == 1).all():
+        scores = correct.sum(axis=1)
+    else:
+        # weights fit in a byte for any sensible key, which keeps the per sheet weight matrix as small as correct
+        weights = np.pad(weights, padding).astype(np.uint8 if weights.max() < 256 else np.int64)
+        scores = (correct * weights[rows]).sum(axis=1, dtype=np.int64)
+    return pd.Series(scores, index=df.index, name='Score'), correct
+
+# fingerprint of the key names, key letters and weights, re-saving an unchanged keys file keeps the same fingerprint
+def keys_fingerprint(keys_df):
+    key_index, key_matrix, weights = keys_to_matrix(keys_df)
+    digest = hashlib.sha256('\x00'.join(key_column_name(test, form) for test, form in key_index).encode())
+    digest.update(str(key_matrix.shape).encode())
+    digest.update(key_matrix.tobytes())
+    if (weights != 1).any(): digest.update(weights.tobytes())
+    return digest.hexdigest()
+
+# per-sheet fingerprint of everything the score depends on
+def sheet_fingerprints(df):
+    columns = ['Test', 'Answers', 'Form'] if 'Form' in df else ['Test', 'Answers']
+    return pd.util.hash_pandas_object(df[columns].astype(str), index=False).to_numpy(dtype=np.uint64)
+
+# every question whose answer or weight differs between two versions of the keys, matching key columns by name. A key
+# column only in one version is compared against a blank key
+def key_changes(old_keys_df, new_keys_df):
+    old_index, old_matrix, old_weights = keys_to_matrix(old_keys_df)
+    new_index, new_matrix, new_weights = keys_to_matrix(new_keys_df)
+    width = max(old_matrix.shape[1], new_matrix.shape[1])
+    old_keys = {key_column_name(*key): (old_matrix[row], old_weights[row]) for row, key in enumerate(old_index)}
+    new_keys = {key_column_name(*key): (new_matrix[row], new_weights[row]) for row, key in enumerate(new_index)}
+    blank = (np.zeros(width, dtype=np.uint8), np.ones(width, dtype=np.int64))
+    changes = []
+    for name in list(old_keys) + [name for name in new_keys if name not in old_keys]:
+        (old_key, old_weight), (new_key, new_weight) = [
+            (np.pad(key, (0, width - len(key))), np.pad(weight, (0, width - len(weight)), constant_values=1))
+            for key, weight in [old_keys.get(name, blank), new_keys.get(name, blank)]]
+        for question in np.flatnonzero((old_key != new_key) | ((old_weight != new_weight) & ((old_key != 0) | (new_key != 0)))):
+            changes.append({'Key': name, 'Question': int(question) + 1,
+                            'Old Answer': chr(old_key[question]) if old_key[question] else '', 'New Answer': chr(new_key[question]) if new_key[question] else '',
+                            'Old Weight': int(old_weight[question]), 'New Weight': int(new_weight[question])})
+    return pd.DataFrame(changes, columns=['Key', 'Question', 'Old Answer', 'New Answer', 'Old Weight', 'New Weight'])
+
+# scores for new_keys_df from the scores graded with old_keys_df, by adding the change in points of every changed question
+# to the sheets graded with that key. Only the changed questions of the affected sheets are compared. Returns the new
+# scores and a mask of the sheets rescored
+def rekey_tests(df, old_keys_df, new_keys_df):
+    old_index, old_matrix, old_weights = keys_to_matrix(old_keys_df)
+    new_index, new_matrix, new_weights = keys_to_matrix(new_keys_df)
+    width = max(old_matrix.shape[1], new_matrix.shape[1])
+    # same width for both, and a blank key at the end for sheets without one (indexed by -1)
+    old_matrix, old_weights = np.pad(old_matrix, ((0, 1), (0, width - old_matrix.shape[1]))), np.pad(old_weights, ((0, 1), (0, width - old_weights.shape[1])))
+    new_matrix, new_weights = np.pad(new_matrix, ((0, 1), (0, width - new_matrix.shape[1]))), np.pad(new_weights, ((0, 1), (0, width - new_weights.shape[1])))
+    old_rows, new_rows = sheet_key_rows(df, old_index), sheet_key_rows(df, new_index)
+    scores = df['Score'].to_numpy(dtype=np.int64, copy=True)
+    rescored = np.zeros(len(df), dtype=bool)
+    # sheets graded with the same old and new key all change by the same questions
+    for (old_row, new_row), sheets in pd.Series(old_rows).groupby([old_rows, new_rows]).indices.items():
+        old_key, new_key = old_matrix[old_row], new_matrix[new_row]
+        questions = np.flatnonzero((old_key != new_key) | ((old_weights[old_row] != new_weights[new_row]) & ((old_key != 0) | (new_key != 0))))
+        if not len(questions): continue
+        answers = answers_to_matrix(df['Answers'].iloc[sheets], width)[:, questions]
+        old_key, new_key = old_key[questions], new_key[questions]
+        scores[sheets] += ((answers == new_key) & (new_key != 0)) @ new_weights[new_row, questions] - ((answers == old_key) & (old_key != 0)) @ old_weights[old_row, questions]
+        rescored[sheets] = True
+    return pd.Series(scores, index=df.index, name='Score'), rescored
+
+# grades only sheets that are new or were edited since they were last graded, or every sheet if the keys changed
+def regrade_tests(df, keys_df, graded, keys_hash, full=False):
+    new_keys_hash = keys_fingerprint(keys_df)
+    fingerprints = sheet_fingerprints(df)
+    if full or keys_hash != new_keys_hash:
+        stale = np.ones(len(df), dtype=bool)
+    else:
+        stale = fingerprints != graded
+    scores = df['Score'].to_numpy(copy=True)
+    if stale.any():
+        new_scores, _ = grade_tests(df[stale], keys_df)
+        scores[stale] = new_scores.to_numpy()
+    return pd.Series(scores, index=df.index, name='Score'), fingerprints, new_keys_hash, int(stale.sum())
+
+# -- Data store --
+
+# cumulative data for the day, answers are kept as a fixed-width byte block so loading needs no per-row parsing
+data_filename = 'MaST-data'+file_date_tag+'.npz'
+
+# writes the cumulative data to a temporary file first so an interrupted run never leaves a half written store
+# graded and keys_hash are the grading cache from regrade_tests, without them every sheet is regraded next run
+# keys_df, the keys the scores were graded with, is kept as text so rekey can tell which questions changed
+def save_data(df, filename, graded=None, keys_hash='', keys_df=None):
+    if graded is None: graded = np.zeros(len(df), dtype=np.uint64)
+    arrays = {
+        'index': df.index.to_numpy(dtype=np.int64),
+        # ids are kept as they are in memory, a narrower type would quietly turn a mistyped id into a different valid one
+        'school_id': df['School ID'].to_numpy(dtype=np.int64),
+        'student_id': df['Student ID'].to_numpy(dtype=np.int64),
+        'test': np.array(df['Test'].astype(str).tolist(), dtype='U'),
+        'answers': np.array(df['Answers'].tolist(), dtype='S'),
+        'score': df['Score'].to_numpy(),
+        'graded': np.asarray(graded, dtype=np.uint64),
+        'keys_hash': np.array(keys_hash),
+    }
+    if 'Form' in df: arrays['form'] = np.array(df['Form'].fillna('').astype(str).tolist(), dtype='U')
+    if keys_df is not None:
+        arrays['keys_columns'] = np.array([str(column) for column in keys_df.columns], dtype='U')
+        arrays['keys_cells'] = np.array(keys_df.astype(object).where(keys_df.notna(), '').astype(str).to_numpy(), dtype='U').reshape(keys_df.shape)
+    folder = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(dir=folder, suffix='.npz', delete=False) as f:
+        np.savez(f, **arrays)
+    os.replace(f.name, filename)
+
+# raises FileNotFoundError like pd.read_csv if there is no data yet
+def load_data(filename):
+    with np.load(filename) as arrays:
+        df = pd.DataFrame({
+            'School ID': arrays['school_id'].astype(np.int64),
+            'Student ID': arrays['student_id'].astype(np.int64),
+            'Test': arrays['test'].astype(object),
+            'Answers': arrays['answers'].astype('U').astype(object),
+            'Score': arrays['score'],
+        }, index=arrays['index'])
+        if 'form' in arrays.files: df.insert(3, 'Form', arrays['form'].astype(object))
+    return df
+
+# sheet fingerprints and keys fingerprint saved with the data, files from before the cache return an empty cache
+def load_grading_cache(filename):
+    with np.load(filename) as arrays:
+        if 'graded' not in arrays.files:
+            return np.zeros(len(arrays['index']), dtype=np.uint64), ''
+        return arrays['graded'], str(arrays['keys_hash'])
+
+# keys the saved scores were graded with, None for files written before they were kept
+def load_graded_keys(filename):
+    with np.load(filename) as arrays:
+        if 'keys_columns' not in arrays.files: return None
+        keys_df = pd.DataFrame(arrays['keys_cells'].astype(object), columns=arrays['keys_columns'].tolist())
+    keys_df = keys_df.where(keys_df != '', np.nan)
+    # weights come back as text like the rest of the cells
+    for column in keys_df.columns:
+        if column.endswith(' weights'): keys_df[column] = pd.to_numeric(keys_df[column])
+    return keys_df
+
+# one-time conversion of the old MaST-data-YEAR-DAY.csv format where Answers is the repr of a list
+def migrate_csv_data(csv_file, filename):
+    df = pd.read_csv(csv_file, index_col=0, keep_default_na=False)
+    import ast
+    df['Answers'] = df['Answers'].apply(lambda answers: ''.join(ast.literal_eval(answers)) if answers.startswith('[') else answers)
+    save_data(df, filename)
+    return df
+
+# plain csv copy of the data file for opening in Excel
+def export_csv_data(filename, csv_file):
+    df = load_data(filename)
+    df.to_csv(csv_file)
+    return df
+
+# -- Registry --
+
+# registered students and schools indexed once by (school id, student id) and school id
+class Registry:
+    def __init__(self, students_df, schools_df=None):
+        self.students_df = students_df
+        self.schools_df = schools_df
+        # the first registration wins if a student is listed twice, same as the old .values[0] lookups
+        students = students_df.drop_duplicates(['school id', 'student id'])
+        self.student_index = pd.MultiIndex.from_arrays([students['school id'], students['student id']], names=['School ID', 'Student ID'])
+        self.names = pd.Series(students['name'].to_numpy(), index=self.student_index)
+        self.tests = dict(zip(self.student_index, zip(students['test 1'], students['test 2'])))
+        self.school_names = {}
+        if schools_df is not None:
+            schools = schools_df.drop_duplicates('id')
+            self.school_names = dict(zip(schools['id'], schools['school']))
+        # one row per registered (school id, student id, test), students signed up for one test have no second row
+        registrations = pd.melt(students, id_vars=['school id', 'student id'], value_vars=['test 1', 'test 2'], value_name='Test').dropna(subset=['Test'])
+        registrations = registrations.rename(columns={'school id': 'School ID', 'student id': 'Student ID'})
+        self.registrations = registrations[['School ID', 'Student ID', 'Test']].sort_values(['School ID', 'Student ID'], kind='stable')
+    
+    def is_registered(self, school_id, student_id):
+        return (school_id, student_id) in self.tests
+    
+    def name(self, school_id, student_id, default=None):
+        return self.names.get((school_id, student_id), default)
+    
+    def registered_tests(self, school_id, student_id):
+        return [test for test in self.tests.get((school_id, student_id), ()) if isinstance(test, str)]
+    
+    def school_name(self, school_id, default=None):
+        return self.school_names.get(school_id, default)
+    
+    # student names lined up with the rows of df, '' if the student isn't registered
+    def names_for(self, df):
+        keys = pd.MultiIndex.from_arrays([df['School ID'], df['Student ID']])
+        return pd.Series(self.names.reindex(keys).fillna('').to_numpy(), index=df.index, name='name')
+    
+    # boolean mask of the tests in df with no matching registered student
+    def lost_students(self, df):
+        keys = pd.MultiIndex.from_arrays([df['School ID'], df['Student ID']])
+        return pd.Series(~keys.isin(self.student_index), index=df.index)
+    
+    # registrations with no matching test in df, with student names
+    def lost_tests(self, df):
+        taken = pd.MultiIndex.from_frame(df[['School ID', 'Student ID', 'Test']])
+        registered = pd.MultiIndex.from_frame(self.registrations)
+        lost_df = self.registrations[~registered.isin(taken)].reset_index(drop=True)
+        lost_df.insert(2, 'name', self.names_for(lost_df))
+        return lost_df
+
+# -- Validation --
+
+# one problem found in the data - kind of check, index of the row, and the offending values of that row
+Issue = namedtuple('Issue', ['kind', 'index', 'values'])
+
+# every check in the order they are resolved
+issue_kinds = ['student_id', 'school_id', 'test', 'form', 'three_plus', 'same_test', 'lost_student']
+
+# runs the requested checks over the whole DataFrame at once and returns the issues sorted by check then index.
+# forms is key_forms of the keys, the form check only applies to tests with more than one key
+def validate(df, kinds=issue_kinds, registry=None, forms=None):
+    school_ids = df['School ID'].to_numpy()
+    student_ids = df['Student ID'].to_numpy()
+    masks = {}
+    # 99 and 999 are the codes a user enters to skip a student or school id permanently
+    if 'student_id' in kinds:
+        masks['student_id'] = ((student_ids < 1) | (student_ids > num_students_per_school)) & (student_ids != 99)
+    if 'school_id' in kinds:
+        masks['school_id'] = ((school_ids < 100) | (school_ids > max_school_id)) & (school_ids != 999)
+    if 'test' in kinds:
+        masks['test'] = ~df['Test'].isin(list(tests.values())).to_numpy()
+    if 'form' in kinds and forms:
+        sheet_forms = df['Form'].fillna('').astype(str) if 'Form' in df else pd.Series('', index=df.index)
+        valid = pd.MultiIndex.from_tuples([(test, form) for test in forms for form in sorted(forms[test])])
+        masks['form'] = (df['Test'].isin(list(forms)) & ~pd.MultiIndex.from_arrays([df['Test'], sheet_forms]).isin(valid)).to_numpy()
+    if 'three_plus' in kinds:
+        counts = df.value_counts(['School ID', 'Student ID'])
+        masks['three_plus'] = counts.reindex(pd.MultiIndex.from_arrays([school_ids, student_ids])).to_numpy() >= 3
+    if 'same_test' in kinds:
+        masks['same_test'] = df.duplicated(['School ID', 'Student ID', 'Test'], keep=False).to_numpy()
+    if 'lost_student' in kinds and registry is not None:
+        masks['lost_student'] = registry.lost_students(df).to_numpy()
+    issues = []
+    for kind in issue_kinds:
+        if kind not in masks: continue
+        flagged = df[masks[kind]]
+        for index, school_id, student_id, test in zip(flagged.index, flagged['School ID'], flagged['Student ID'], flagged['Test']):
+            issues.append(Issue(kind, index, {'School ID': school_id, 'Student ID': student_id, 'Test': test}))
+    return issues
+
+# after edits only the rows sharing a (school id, student id) with an edited record, before or after the edit, are checked again
+def recheck_issues(df, issues, edited_keys, kinds=issue_kinds, registry=None, forms=None):
+    if not edited_keys: return issues
+    rows = pd.MultiIndex.from_arrays([df['School ID'], df['Student ID']]).isin(pd.MultiIndex.from_tuples(edited_keys))
+    affected_df = df[rows]
+    affected = set(affected_df.index)
+    kept = [issue for issue in issues if issue.kind not in kinds or issue.index not in affected]
+    rechecked = validate(affected_df, kinds, registry, forms)
+    return sorted(kept + rechecked, key=lambda issue: (issue_kinds.index(issue.kind), issue.index))
+
+# -- Similarity --
+
+# a pair of sheets is flagged when it shares at least 'same wrong' identical wrong answers and that is 'z' standard
+# deviations above what students answering independently would share. A rescan under another id is identical throughout
+similarity_limits = {'z': 6.0, 'same wrong': 5}
+similarity_filename = 'MaST-similar'+file_date_tag+'.csv'
+similarity_block_rows = 1024 # rows of the pair matrices computed at a time, bounds memory for very large tests
+
+# one-hot encoding of the sheets graded with one key, as float32 so the pair counts are BLAS matrix products. Returns
+# every answer chosen (sheets x questions*5), every wrong answer chosen (same shape), the questions answered wrong
+# (sheets x questions), and for each question the chance two students who both got it wrong picked the same wrong answer,
+# from how often each wrong answer was picked over the whole test
+def similarity_encoding(answer_matrix, key):
+    letters = np.frombuffer(answer_letters.encode(), dtype=np.uint8)
+    chosen = answer_matrix[:, :len(key), None] == letters
+    wrong = chosen & (letters != key[:, None]) & (key != 0)[:, None]
+    picked = wrong.mean(axis=0)
+    total = picked.sum(axis=1)
+    same = np.divide((picked ** 2).sum(axis=1), total ** 2, out=np.zeros(len(key)), where=total > 0)
+    num_sheets = len(answer_matrix)
+    return (chosen.reshape(num_sheets, -1).astype(np.float32), wrong.reshape(num_sheets, -1).astype(np.float32),
+            wrong.any(axis=2).astype(np.float32), same.astype(np.float32))
+
+# flagged pairs among rows start:stop and every later row of one encoded group. Identical wrong answers are compared
+# with their expected count and variance over the questions both got wrong, which are matrix products too
+def similar_block(encoding, start, stop, limits):
+    chosen, wrong, answered_wrong, same = encoding
+    same_wrong = wrong[start:stop] @ wrong[start:].T
+    expected = (answered_wrong[start:stop] * same) @ answered_wrong[start:].T
+    variance = (answered_wrong[start:stop] * (same * (1 - same))) @ answered_wrong[start:].T
+    z = np.divide(same_wrong - expected, np.sqrt(variance), out=np.where(same_wrong > expected, np.inf, 0).astype(np.float32), where=variance > 0)
+    later = np.arange(start, stop)[:, None] < np.arange(start, len(chosen))
+    rows, columns = np.nonzero(later & (same_wrong >= limits['same wrong']) & (z >= limits['z']))
+    # identical answers right or wrong, only needed for the few flagged pairs
+    identical = (chosen[rows + start] * chosen[columns + start]).sum(axis=1)
+    return (rows + start, columns + start, identical.astype(int), same_wrong[rows, columns].astype(int),
+            expected[rows, columns].astype(float), z[rows, columns].astype(float))
+
+# answer matrix, key and row blocks of every group being scanned plus the limits, handed to each worker process once
+# so a task is only (group, block, start, stop). The encoding of the group and block in use is kept between tasks
+similarity_groups = None
+similarity_cache = {}
+
+def init_similarity(groups, limits):
+    global similarity_groups
+    similarity_groups = (groups, limits)
+    similarity_cache.clear()
+
+def similar_block_task(task):
+    group, block, start, stop = task
+    groups, limits = similarity_groups
+    answer_matrix, key, blocks = groups[group]
+    if similarity_cache.get('block') != (group, block):
+        if similarity_cache.get('group') != group:
+            similarity_cache['group'], similarity_cache['encoding'] = group, similarity_encoding(answer_matrix, key)
+        encoding = similarity_cache['encoding']
+        # by test the block is the whole group and the encoding is used as it is
+        if len(blocks) > 1:
+            encoding = tuple(array[blocks[block]] for array in encoding[:3]) + (encoding[3],)
+        similarity_cache['block'], similarity_cache['block encoding'] = (group, block), encoding
+    return similar_block(similarity_cache['block encoding'], start, stop, limits)
+
+# pairs of sheets graded with the same key that share far more identical wrong answers than chance, e.g. a sheet scanned
+# again under a mis-bubbled id or two students copying. by='school' only compares sheets of the same school. The chance
+# of matching is always taken from the whole test. Returns one row per pair, most unlikely first
+def similar_sheets(df, keys_df, by=None, workers=None, limits=None):
+    limits = limits or similarity_limits
+    key_index, key_matrix, _ = keys_to_matrix(keys_df)
+    answer_matrix = answers_to_matrix(df['Answers'], key_matrix.shape[1])
+    key_rows = sheet_key_rows(df, key_index)
+    tasks, groups, task_sheets = [], [], []
+    for row, sheets in pd.Series(key_rows).groupby(key_rows).indices.items():
+        if row < 0: continue
+        blocks = [np.arange(len(sheets))] if by != 'school' else list(pd.Series(np.arange(len(sheets))).groupby(df['School ID'].to_numpy()[sheets]).indices.values())
+        groups.append((answer_matrix[sheets], key_matrix[row], blocks))
+        for block_number, block in enumerate(blocks):
+            if len(block) < 2: continue
+            for start in range(0, len(block), similarity_block_rows):
+                tasks.append((len(groups) - 1, block_number, start, min(start + similarity_block_rows, len(block))))
+                task_sheets.append((key_column_name(*key_index[row]), sheets[block]))
+    if workers == 1 or len(tasks) < 2:
+        init_similarity(groups, limits)
+        results = [similar_block_task(task) for task in tasks]
+        init_similarity(None, None)
+    else:
+        # tasks go out in order, two runs of them per worker, so each worker only encodes the few groups its runs cover
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_similarity, initargs=(groups, limits)) as pool:
+            results = list(pool.map(similar_block_task, tasks, chunksize=-(-len(tasks) // (2 * (workers or os.cpu_count() or 1)))))
+    frames = []
+    for (test, sheets), (rows, columns, identical, same_wrong, expected, z) in zip(task_sheets, results):
+        if not len(rows): continue
+        first, second = df.iloc[sheets[rows]], df.iloc[sheets[columns]]
+        frames.append(pd.DataFrame({
+            'Test': test,
+            'Index': first.index, 'School ID': first['School ID'].to_numpy(), 'Student ID': first['Student ID'].to_numpy(),
+            'Other Index': second.index, 'Other School ID': second['School ID'].to_numpy(), 'Other Student ID': second['Student ID'].to_numpy(),
+            'Identical': identical, 'Same Wrong': same_wrong, 'Expected': np.round(expected, 2), 'z': np.round(z, 1),
+        }))
+    columns = ['Test', 'Index', 'School ID', 'Student ID', 'Other Index', 'Other School ID', 'Other Student ID', 'Identical', 'Same Wrong', 'Expected', 'z']
+    if not frames: return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True).sort_values(['z', 'Same Wrong'], ascending=False, kind='stable', ignore_index=True)
+
+# -- Corrections journal --
+
+# every correction made to a record, replayed automatically on later runs so nothing has to be entered twice
+journal_filename = 'MaST-corrections'+file_date_tag+'.jsonl'
+# issues left for the user by a --non_interactive run
+issues_filename = 'MaST-issues'+file_date_tag+'.csv'
+
+# per-record fingerprint of the scanned fields, a correction applies to the record whose fields match it before the edit
+def record_fingerprints(df):
+    return pd.util.hash_pandas_object(df[['School ID', 'Student ID', 'Test', 'Answers']].astype(str), index=False).to_numpy(dtype=np.uint64)
+
+def load_journal(filename):
+    try:
+        with open(filename) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+# journal entry for changing field of the record at index to new_value
+def correction_entry(df, index, field, new_value):
+    old_value = df.at[index, field]
+    return {
+        'fingerprint': '{:016x}'.format(record_fingerprints(df.loc[[index]])[0]),
+        'field': field,
+        'old': old_value.item() if isinstance(old_value, np.generic) else old_value,
+        'new': new_value.item() if isinstance(new_value, np.generic) else new_value,
+        'time': str(datetime.now()),
+    }
+
+# appends one correction to the journal file right away so it survives an interrupted run
+def record_correction(df, index, field, new_value, filename=None):
+    entry = correction_entry(df, index, field, new_value)
+    with open(filename or journal_filename, 'a') as f:
+        f.write(json.dumps(entry)+'\n')
+    return entry
+
+# replays the journal in order, returns the number of corrections applied
+def apply_corrections(df, journal):
+    if not journal or df.empty: return 0
+    fingerprints = pd.Series(df.index, index=record_fingerprints(df))
+    applied = 0
+    for entry in journal:
+        fingerprint = np.uint64(int(entry['fingerprint'], 16))
+        if fingerprint not in fingerprints.index: continue
+        for index in fingerprints.loc[[fingerprint]]:
+            if df.at[index, entry['field']] == entry['old']:
+                df.at[index, entry['field']] = entry['new']
+                fingerprints = pd.concat([fingerprints[fingerprints != index], pd.Series([index], index=record_fingerprints(df.loc[[index]]))])
+                applied += 1
+                break
+    return applied
+
+# writes the issues that still need a decision so a non-interactive run can be resolved later
+def write_issues_report(df, issues, filename):
+    report_df = pd.DataFrame({
+        'Issue': [issue.kind for issue in issues],
+        'Index': [issue.index for issue in issues],
+        'School ID': [issue.values['School ID'] for issue in issues],
+        'Student ID': [issue.values['Student ID'] for issue in issues],
+        'Test': [issue.values['Test'] for issue in issues],
+    })
+    report_df['Fingerprint'] = ['{:016x}'.format(fingerprint) for fingerprint in record_fingerprints(df.loc[report_df['Index']])]
+    report_df.to_csv(filename, index=False)
+    return report_df
+
+# -- SQLite store --
+
+# optional store (--db) that keeps every tournament day of every year in one file, so days and years can be queried
+# together instead of opening a spreadsheet per day. A tournament is named by its file_date_tag, e.g. 2026-Sun
+db_filename = 'MaST.db'
+db_schema = """
+CREATE TABLE IF NOT EXISTS tournaments (
+    tournament TEXT PRIMARY KEY, year INTEGER, day TEXT, keys_hash TEXT NOT NULL DEFAULT '', updated TEXT);
+CREATE TABLE IF NOT EXISTS sheets (
+    tournament TEXT NOT NULL, row INTEGER NOT NULL, school_id INTEGER, student_id INTEGER, test TEXT, answers TEXT,
+    score INTEGER, graded TEXT, calc_quantile REAL, award_quantile REAL, form TEXT, PRIMARY KEY (tournament, row));
+CREATE INDEX IF NOT EXISTS sheets_student_test ON sheets (tournament, school_id, student_id, test);
+CREATE TABLE IF NOT EXISTS students (
+    tournament TEXT NOT NULL, school_id INTEGER, student_id INTEGER, name TEXT, test_1 TEXT, test_2 TEXT,
+    PRIMARY KEY (tournament, school_id, student_id));
+CREATE TABLE IF NOT EXISTS schools (
+    tournament TEXT NOT NULL, school_id INTEGER, school TEXT, PRIMARY KEY (tournament, school_id));
+CREATE TABLE IF NOT EXISTS keys (
+    tournament TEXT NOT NULL, test TEXT, question INTEGER, answer TEXT, PRIMARY KEY (tournament, test, question));
+CREATE TABLE IF NOT EXISTS batches (
+    tournament TEXT NOT NULL, digest TEXT, file TEXT, tests INTEGER, loaded TEXT, PRIMARY KEY (tournament, digest));
+CREATE TABLE IF NOT EXISTS corrections (
+    id INTEGER PRIMARY KEY, tournament TEXT NOT NULL, fingerprint TEXT, field TEXT, old TEXT, new TEXT, time TEXT);
+CREATE INDEX IF NOT EXISTS corrections_tournament ON corrections (tournament, id);
+CREATE TABLE IF NOT EXISTS school_points (
+    tournament TEXT NOT NULL, school_id INTEGER, points INTEGER, rank INTEGER, PRIMARY KEY (tournament, school_id));
+CREATE INDEX IF NOT EXISTS school_points_school ON school_points (school_id, tournament);
+"""
+
+# plain python values for json and sqlite, numpy scalars and missing values included
+def json_value(value):
+    if isinstance(value, np.generic): value = value.item()
+    if isinstance(value, float) and value != value: return None
+    return value
+
+# columns of a sheet written to the database, Form only once answer key forms are in use
+def sheet_columns(df):
+    return ['School ID', 'Student ID', 'Test', 'Form', 'Answers', 'Score'] if 'Form' in df else ['School ID', 'Student ID', 'Test', 'Answers', 'Score']
+
+# a column as a list of plain python values with None for missing ones, much faster than json_value on every value
+def sql_values(series):
+    return series.astype(object).where(series.notna(), None).tolist()
+
+# one tournament in a SQLite file. Every write is a single transaction with the rows sent in one executemany
+class Database:
+    def __init__(self, filename=None, tournament=None):
+        import sqlite3
+        self.filename = filename or db_filename
+        self.tournament = tournament or file_date_tag[1:]
+        # serve mode uses the database from its http threads, always one at a time under the service lock
+        self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+        self.connection.executescript(db_schema)
+        # databases from before answer key forms
+        if 'form' not in [column[1] for column in self.connection.execute('PRAGMA table_info(sheets)')]:
+            self.connection.execute('ALTER TABLE sheets ADD COLUMN form TEXT')
+        year, _, day = self.tournament.partition('-')
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO tournaments (tournament, year, day) VALUES (?, ?, ?)', (self.tournament, int(year) if year.isdigit() else None, day))
+        # hash of every row as last written, so a save only sends the rows that changed
+        self.saved_rows = np.zeros(0, dtype=np.uint64)
+    
+    def close(self):
+        self.connection.close()
+    
+    def execute(self, sql, *parameters):
+        return self.connection.execute(sql, (self.tournament,) + parameters)
+    
+    # replaces the rows of this tournament in table with rows, a list of tuples without the tournament
+    def replace(self, table, columns, rows):
+        with self.connection:
+            self.execute(f'DELETE FROM {table} WHERE tournament = ?')
+            self.connection.executemany(f"INSERT INTO {table} (tournament, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})",
+                                        ((self.tournament,) + tuple(json_value(value) for value in row) for row in rows))
+    
+    def has_sheets(self):
+        return self.execute('SELECT 1 FROM sheets WHERE tournament = ? LIMIT 1').fetchone() is not None
+    
+    # writes the rows of df that are new or changed since the last save or load, along with the grading cache
+    def save_sheets(self, df, graded=None, keys_hash=''):
+        if graded is None: graded = np.zeros(len(df), dtype=np.uint64)
+        graded = np.concatenate([graded, np.zeros(len(df) - len(graded), dtype=np.uint64)])
+        hashes = pd.util.hash_pandas_object(df[sheet_columns(df)].astype(str), index=True).to_numpy() ^ graded
+        changed = np.ones(len(df), dtype=bool)
+        changed[:len(self.saved_rows)] = hashes[:len(self.saved_rows)] != self.saved_rows[:len(df)]
+        rows = df.iloc[np.flatnonzero(changed)]
+        with self.connection:
+            columns = [rows.index.tolist()] + [sql_values(rows[column]) for column in ['School ID', 'Student ID', 'Test', 'Answers', 'Score']]
+            forms = sql_values(rows['Form']) if 'Form' in rows else [None] * len(rows)
+            fingerprints = ['{:016x}'.format(fingerprint) for fingerprint in graded[changed].tolist()]
+            self.connection.executemany('INSERT OR REPLACE INTO sheets (tournament, row, school_id, student_id, test, answers, score, graded, form) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        ((self.tournament,) + row for row in zip(*columns, fingerprints, forms)))
+            self.execute('UPDATE tournaments SET keys_hash = ?2, updated = ?3 WHERE tournament = ?1', keys_hash, str(datetime.now()))
+        self.saved_rows = hashes
+        return int(changed.sum())
+    
+    # the data, sheet fingerprints and keys fingerprint like load_data and load_grading_cache, None if there are no sheets
+    def load_sheets(self):
+        rows = self.execute('SELECT row, school_id, student_id, test, form, answers, score, graded FROM sheets WHERE tournament = ? ORDER BY row').fetchall()
+        if not rows: return None
+        df = pd.DataFrame.from_records(rows, columns=['row', 'School ID', 'Student ID', 'Test', 'Form', 'Answers', 'Score', 'graded'])
+        graded = np.array([int(fingerprint, 16) for fingerprint in df.pop('graded')], dtype=np.uint64)
+        df = df.set_index('row').rename_axis(None)
+        if df['Form'].isna().all(): df = df.drop(columns='Form')
+        keys_hash = self.execute('SELECT keys_hash FROM tournaments WHERE tournament = ?').fetchone()[0]
+        self.saved_rows = pd.util.hash_pandas_object(df[sheet_columns(df)].astype(str), index=True).to_numpy() ^ graded
+        return df, graded, keys_hash
+    
+    # keys saved by update mode, in the layout of the keys workbook. None if there are none
+    def load_keys(self):
+        # rows go in column by column, so rowid order gives back the column order of the workbook
+        rows = self.execute('SELECT test, question, answer FROM keys WHERE tournament = ? ORDER BY rowid').fetchall()
+        if not rows: return None
+        keys = pd.DataFrame.from_records(rows, columns=['test', 'question', 'answer'])
+        keys_df = keys.pivot(index='question', columns='test', values='answer')[keys['test'].unique()].reset_index(drop=True).rename_axis(None, axis=1)
+        for column in keys_df.columns:
+            if column.endswith(' weights'): keys_df[column] = pd.to_numeric(keys_df[column])
+        return keys_df
+    
+    def save_keys(self, keys_df):
+        # blank cells are left out but keep the question numbers of the cells after them
+        self.replace('keys', ['test', 'question', 'answer'], ((test, question, answer) for test in keys_df.columns for question, answer in enumerate(keys_df[test], start=1) if pd.notna(answer)))
+    
+    # registered students (the first registration of a student wins, as in Registry) and school names
+    def save_registrations(self, students_df, schools_df=None):
+        students = students_df.drop_duplicates(['school id', 'student id'])
+        self.replace('students', ['school_id', 'student_id', 'name', 'test_1', 'test_2'], zip(*(students[column] for column in ['school id', 'student id', 'name', 'test 1', 'test 2'])))
+        if schools_df is not None:
+            schools = schools_df.drop_duplicates('id')
+            self.replace('schools', ['school_id', 'school'], zip(schools['id'], schools['school']))
+    
+    # ingest manifest of the ascii files loaded into this tournament, same layout as load_manifest
+    def manifest(self):
+        return {digest: {'file': file, 'tests': tests, 'loaded': loaded} for digest, file, tests, loaded in self.execute('SELECT digest, file, tests, loaded FROM batches WHERE tournament = ?')}
+    
+    def save_manifest(self, batches):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO batches (tournament, digest, file, tests, loaded) VALUES (?, ?, ?, ?, ?)',
+                                        ((self.tournament, digest, batch['file'], batch['tests'], batch['loaded']) for digest, batch in batches.items()))
+    
+    # corrections journal kept in the database, entries like record_correction writes
+    def add_correction(self, entry):
+        with self.connection:
+            self.execute('INSERT INTO corrections (tournament, fingerprint, field, old, new, time) VALUES (?, ?, ?, ?, ?, ?)', entry['fingerprint'], entry['field'], json.dumps(entry['old']), json.dumps(entry['new']), entry['time'])
+    
+    def corrections(self):
+        rows = self.execute('SELECT fingerprint, field, old, new, time FROM corrections WHERE tournament = ? ORDER BY id')
+        return [{'fingerprint': fingerprint, 'field': field, 'old': json.loads(old), 'new': json.loads(new), 'time': time} for fingerprint, field, old, new, time in rows]
+    
+    # rows that share a school id, student id and test with another row, found with the sheets_student_test index
+    def duplicate_sheets(self):
+        rows = self.execute("""
+            SELECT s.row FROM sheets s JOIN (
+                SELECT school_id, student_id, test FROM sheets WHERE tournament = ?1
+                GROUP BY school_id, student_id, test HAVING COUNT(*) > 1) d
+            ON s.school_id = d.school_id AND s.student_id = d.student_id AND s.test IS d.test
+            WHERE s.tournament = ?1 ORDER BY s.row""")
+        return [row for row, in rows]
+    
+    # registrations with no matching sheet, like Registry.lost_tests. Each registration is one indexed lookup
+    def lost_tests(self):
+        rows = self.execute("""
+            SELECT r.school_id, r.student_id, r.name, r.test FROM (
+                SELECT school_id, student_id, name, test_1 AS test, 1 AS number FROM students WHERE tournament = ?1 AND test_1 IS NOT NULL
+                UNION ALL
+                SELECT school_id, student_id, name, test_2 AS test, 2 AS number FROM students WHERE tournament = ?1 AND test_2 IS NOT NULL) r
+            WHERE NOT EXISTS (SELECT 1 FROM sheets s WHERE s.tournament = ?1 AND s.school_id = r.school_id AND s.student_id = r.student_id AND s.test = r.test)
+            ORDER BY r.school_id, r.student_id, r.number""").fetchall()
+        return pd.DataFrame.from_records(rows, columns=['School ID', 'Student ID', 'name', 'Test'])
+    
+    # quantiles from the edited final Excel file, whose first column is the row, and the school ranking
+    def save_results(self, data_df_final, sorted_school_points):
+        with self.connection:
+            if data_df_final.columns[0] == 'Unnamed: 0':
+                self.connection.executemany('UPDATE sheets SET calc_quantile = ?, award_quantile = ? WHERE tournament = ? AND row = ?', (
+                    (json_value(calc), json_value(award), self.tournament, json_value(row)) for row, calc, award in zip(data_df_final.iloc[:, 0], data_df_final['Calc Quantile'], data_df_final['Award Quantile'])))
+            self.execute('DELETE FROM school_points WHERE tournament = ?')
+            self.connection.executemany('INSERT INTO school_points (tournament, school_id, points, rank) VALUES (?, ?, ?, ?)',
+                                        ((self.tournament, json_value(school_id), json_value(points), rank) for rank, (school_id, points) in enumerate(sorted_school_points.items(), start=1)))
+
+# points and rank of every school (or just school_id) at every tournament in the database, oldest first
+def school_history(filename=None, school_id=None):
+    import sqlite3
+    connection = sqlite3.connect(filename or db_filename)
+    try:
+        connection.executescript(db_schema)
+        rows = connection.execute("""
+            SELECT p.school_id, s.school, p.tournament, t.year, t.day, p.points, p.rank
+            FROM school_points p JOIN tournaments t USING (tournament)
+            LEFT JOIN schools s ON s.tournament = p.tournament AND s.school_id = p.school_id
+            WHERE ?1 IS NULL OR p.school_id = ?1
+            ORDER BY p.school_id, t.year, t.day""", (school_id,)).fetchall()
+    finally:
+        connection.close()
+    return pd.DataFrame.from_records(rows, columns=['School ID', 'school', 'tournament', 'year', 'day', 'School Points', 'rank'])
+
+# -- Pipeline --
+
+# spreadsheets can be given as DataFrames or as paths, paths go through the parse cache
+def read_frame(frame):
+    if frame is None or isinstance(frame, pd.DataFrame): return frame
+    return cached_read(frame, 'read_csv' if str(frame).lower().endswith('.csv') else 'read_excel')
+
+# the update and results steps without any printing or prompts, for use from other scripts or a long running process.
+# Keys, registry, data and grading state stay in memory between calls so each new batch only costs its own work.
+# keys, students and schools are DataFrames or paths. Problems raise exceptions instead of exiting
+class Pipeline:
+    def __init__(self, keys=None, students=None, schools=None, data_file=None, journal_file=None, manifest_file=None, db_file=None, form_column=None):
+        self.data_file = data_file or data_filename
+        self.journal_file = journal_file or journal_filename
+        self.manifest_file = manifest_file or manifest_filename
+        self.keys_df = None
+        self.forms = {}
+        # column of the form code in the ascii files, like ascii_form_column
+        self.form_column = form_column if form_column is not None else ascii_form_column
+        check_form_column(self.form_column)
+        self.students_df, self.schools_df, self.registry = None, None, Registry(pd.DataFrame(columns=['school id', 'student id', 'name', 'test 1', 'test 2']))
+        self.data_df = pd.DataFrame(columns=['School ID', 'Student ID', 'Test', 'Answers', 'Score'])
+        self.graded = np.zeros(0, dtype=np.uint64)
+        self.keys_hash = ''
+        # with a database, whether its sheets hold the records of data_df as they are now (scores are written on save), so
+        # issues and lost_tests can query it without writing
+        self.synced = False
+        self.manifest = None
+        self.new_batches = {}
+        self.data_df_agg = None
+        self.tally = Standings()
+        # with a database the data, manifest and corrections live there instead of in the day's files
+        self.db = Database(db_file) if db_file else None
+        if keys is not None: self.set_keys(keys)
+        if students is not None: self.set_students(students, schools)
+    
+    # both read everything before changing anything, so a file that can't be read leaves the previous inputs in place
+    def set_keys(self, keys):
+        keys_df = read_frame(keys)
+        self.forms = key_forms(keys_df)
+        self.keys_df = keys_df
+        if self.db is not None: self.db.save_keys(self.keys_df)
+    
+    def set_students(self, students, schools=None):
+        students_df, schools_df = read_frame(students), read_frame(schools)
+        self.registry = Registry(students_df, schools_df)
+        self.students_df, self.schools_df = students_df, schools_df
+        if self.db is not None: self.db.save_registrations(self.students_df, self.schools_df)
+    
+    # appends parsed answer sheets (columns School ID, Student ID, Test, Answers), returns their new index
+    def add_sheets(self, sheets_df):
+        start = len(self.data_df)
+        frames = [self.data_df, sheets_df] if start else [sheets_df]
+        self.data_df = pd.concat(frames, ignore_index=True)
+        if 'Form' in self.data_df: self.data_df['Form'] = self.data_df['Form'].fillna('')
+        self.synced = False
+        return self.data_df.index[start:]
+    
+    # reads ascii files (files, folders or patterns) in parallel and appends them, skipping any already added to the
+    # data file. Returns (file, status, detail) for each file: 'loaded' with the number of tests, 'skipped' with where
+    # it was loaded before, or 'failed' with the error
+    def add_ascii(self, ascii_files, workers=None):
+        # a manifest without its data file is left over from an old run so it is ignored
+        if self.manifest is None and self.db is not None:
+            self.manifest = self.db.manifest()
+        elif self.manifest is None:
+            self.manifest = load_manifest(self.manifest_file) if os.path.exists(self.data_file) else {}
+        summary, to_read = [], []
+        for ascii_file in expand_ascii_files(ascii_files):
+            try:
+                digest = file_hash(ascii_file)
+            except Exception as e:
+                summary.append((ascii_file, 'failed', e))
+                continue
+            if digest in self.manifest or digest in self.new_batches or digest in [d for _, d in to_read]:
+                loaded_as = self.manifest[digest]['file'] if digest in self.manifest else 'this run'
+                summary.append((ascii_file, 'skipped', loaded_as))
+                continue
+            to_read.append((ascii_file, digest))
+        for (ascii_file, digest), result in zip(to_read, read_ascii_files([file for file, _ in to_read], workers, self.form_column)):
+            if isinstance(result, Exception):
+                summary.append((ascii_file, 'failed', result))
+            else:
+                self.add_sheets(result)
+                self.new_batches[digest] = {'file': ascii_file, 'tests': len(result), 'loaded': str(datetime.now())}
+                summary.append((ascii_file, 'loaded', len(result)))
+        return summary
+    
+    # converts an old MaST-data-YEAR-DAY.csv next to a missing data file, returns the csv file name if it did
+    def migrate(self, csv_file=None):
+        csv_file = csv_file or 'MaST-data'+file_date_tag+'.csv'
+        if os.path.exists(self.data_file) or not os.path.exists(csv_file): return None
+        migrate_csv_data(csv_file, self.data_file)
+        return csv_file
+    
+    # puts the saved data in front of anything added so far, returns False if there is no data yet. The first run with a
+    # database starts from the day's data file if there is one
+    def load(self):
+        stored = self.db.load_sheets() if self.db is not None else None
+        if stored is not None:
+            og_data_df, graded, self.keys_hash = stored
+        else:
+            try:
+                og_data_df = load_data(self.data_file)
+            except FileNotFoundError:
+                # nothing is stored yet, so whatever was added so far is all there is
+                if self.db is not None: self.sync()
+                return False
+            graded, self.keys_hash = load_grading_cache(self.data_file)
+        self.graded = np.concatenate([graded, np.zeros(len(self.data_df), dtype=np.uint64)])
+        self.data_df = pd.concat([og_data_df, self.data_df], ignore_index=True) if len(self.data_df) else og_data_df
+        if 'Form' in self.data_df: self.data_df['Form'] = self.data_df['Form'].fillna('')
+        if self.db is not None: self.sync()
+        return True
+    
+    # saved corrections in the order they were made
+    def journal(self):
+        return self.db.corrections() if self.db is not None else load_journal(self.journal_file)
+    
+    # replays saved corrections, returns the number applied
+    def apply_journal(self, journal=None):
+        if journal is None: journal = self.journal()
+        num_applied = apply_corrections(self.data_df, journal)
+        if num_applied and self.db is not None: self.sync()
+        return num_applied
+    
+    # writes the current records to the database so it can be queried, scores of new records are filled in by grade.
+    # Called where the records change: loading, replaying the journal, corrections and saving
+    def sync(self):
+        self.db.save_sheets(self.data_df, self.graded, self.keys_hash)
+        self.synced = True
+    
+    # with a database, duplicate tests are found with an indexed query of what is stored instead of in memory. Nothing is
+    # written, so serve mode can ask for issues as often as it likes
+    def issues(self, kinds=issue_kinds):
+        if self.db is None or not self.synced or 'same_test' not in kinds:
+            return validate(self.data_df, kinds, self.registry, self.forms)
+        issues = validate(self.data_df, [kind for kind in kinds if kind != 'same_test'], self.registry, self.forms)
+        for index in self.db.duplicate_sheets():
+            row = self.data_df.loc[index]
+            issues.append(Issue('same_test', index, {'School ID': row['School ID'], 'Student ID': row['Student ID'], 'Test': row['Test']}))
+        return sorted(issues, key=lambda issue: (issue_kinds.index(issue.kind), issue.index))
+    
+    # issues again after corrections, only looking at the students in edited_keys
+    def recheck(self, issues, edited_keys, kinds=issue_kinds):
+        return recheck_issues(self.data_df, issues, edited_keys, kinds, self.registry, self.forms)
+    
+    # changes one field of one record and journals it. Returns the (School ID, Student ID) keys before and after
+    def correct(self, index, field, value):
+        if index not in self.data_df.index: raise KeyError(f'No record with index {index}')
+        if field not in ['School ID', 'Student ID', 'Test', 'Form']: raise ValueError(f'Cannot correct field {field}')
+        old_key = (self.data_df.at[index, 'School ID'], self.data_df.at[index, 'Student ID'])
+        if self.db is not None:
+            self.db.add_correction(correction_entry(self.data_df, index, field, value))
+        else:
+            record_correction(self.data_df, index, field, value, self.journal_file)
+        self.data_df.at[index, field] = value
+        if self.db is not None: self.sync()
+        return old_key, (self.data_df.at[index, 'School ID'], self.data_df.at[index, 'Student ID'])
+    
+    # pairs of sheets with far more identical wrong answers than chance, see similar_sheets
+    def similar(self, by=None, workers=None):
+        if self.keys_df is None: raise ValueError('No keys to compare answers with')
+        return similar_sheets(self.data_df, self.keys_df, by, workers)
+    
+    def lost_tests(self):
+        if self.db is None or not self.synced: return self.registry.lost_tests(self.data_df)
+        return self.db.lost_tests()
+    
+    def write_issues(self, issues, filename=None):
+        return write_issues_report(self.data_df, issues, filename or issues_filename)
+    
+    # grades new and edited tests, or all of them with full or new keys. Returns the number graded
+    def grade(self, full=False):
+        if self.keys_df is None: raise ValueError('No keys to grade with')
+        graded = np.concatenate([self.graded, np.zeros(len(self.data_df) - len(self.graded), dtype=np.uint64)])
+        self.data_df['Score'], self.graded, self.keys_hash, num_graded = regrade_tests(self.data_df, self.keys_df, graded, self.keys_hash, full)
+        return num_graded
+    
+    # keys the saved scores were graded with, None if they weren't kept
+    def graded_keys(self):
+        if self.db is not None: return self.db.load_keys()
+        try:
+            return load_graded_keys(self.data_file)
+        except FileNotFoundError:
+            return None
+    
+    # switches to new keys by adding the change of every changed question to the scores of the sheets that took it, instead
+    # of grading everything again. Every sheet is graded if the keys the scores were graded with aren't known. Returns the
+    # changed questions and a mask of the sheets rescored
+    def rekey(self, keys):
+        new_keys_df = read_frame(keys)
+        old_keys_df = self.graded_keys()
+        if old_keys_df is None:
+            self.set_keys(new_keys_df)
+            self.grade(full=True)
+            return None, np.ones(len(self.data_df), dtype=bool)
+        changes = key_changes(old_keys_df, new_keys_df)
+        graded = np.concatenate([self.graded, np.zeros(len(self.data_df) - len(self.graded), dtype=np.uint64)])
+        if keys_fingerprint(old_keys_df) != self.keys_hash:
+            self.set_keys(new_keys_df)
+            self.grade(full=True)
+            return changes, np.ones(len(self.data_df), dtype=bool)
+        # sheets that weren't graded with the old keys are graded in full by grade below
+        stale = sheet_fingerprints(self.data_df) != graded
+        self.data_df['Score'], rescored = rekey_tests(self.data_df, old_keys_df, new_keys_df)
+        self.set_keys(new_keys_df)
+        self.keys_hash = keys_fingerprint(new_keys_df)
+        self.grade()
+        return changes, rescored | stale
+    
+    # saves the data file (or database) and remembers the ascii files added since the last save
+    def save(self):
+        if self.db is not None:
+            self.sync()
+            self.db.save_manifest(self.new_batches)
+        else:
+            save_data(self.data_df, self.data_file, self.graded, self.keys_hash, self.keys_df)
+        if self.new_batches:
+            if self.manifest is None: self.manifest = {}
+            self.manifest.update(self.new_batches)
+            if self.db is None: save_manifest(self.manifest, self.manifest_file)
+            self.new_batches = {}
+    
+    # fills Calc Quantile and Award Quantile for every test, returns the per test aggregate (count, max and quantiles).
+    # Only the sheets added or changed since the last call are counted again
+    def standings(self):
+        self.tally.update(self.data_df)
+        self.data_df_agg = self.tally.agg()
+        self.data_df['Calc Quantile'] = self.tally.calc_quantiles(self.data_df)
+        self.data_df['Award Quantile'] = self.data_df['Calc Quantile']
+        return self.data_df_agg
+    
+    # all data sorted for the final Excel file
+    def final(self):
+        return self.data_df.sort_values(by=['Test', 'Score'], ascending=[True, False])
+    
+    def write_final(self, filename=None):
+        data_df_sorted = self.final()
+        data_df_sorted.to_excel(filename or 'MaST-data-final'+file_date_tag+'.xlsx')
+        return data_df_sorted
+    
+    # School Points total of each school highest first, from the current standings
+    def school_points(self):
+        self.tally.update(self.data_df)
+        return self.tally.school_points()
+
 # -- Update --
 
-def update_main(ascii_file, keys_file, students_file, no_lost):
+# keys with several forms are graded by the bubbled form code, without --form_column no sheet has one and every sheet
+# of those tests would be flagged one at a time, so stop once up front
+def require_form_column(pipeline):
+    if pipeline.forms and pipeline.form_column is None:
+        print('\n'+red('**')+' The keys have several forms for '+', '.join(sorted(pipeline.forms))+'. Give the position of the form code in the ascii lines with --form_column '+red('**'))
+        print('\nExiting')
+        logging.info('Keys have several forms for '+', '.join(sorted(pipeline.forms))+' but no --form_column was given. Script will exit.')
+        sys.exit()
+
+def update_main(ascii_files, keys_file, students_file, no_lost, full_regrade=False, skip_final=False, workers=None, non_interactive=False, db_file=None, form_column=None, similar=None):
+    pipeline = Pipeline(db_file=db_file, form_column=form_column)
     
-    # load raw ascii data file from Scantron
+    # load raw ascii data files from Scantron
     print('Reading in files...\n')
     sleep(sleep_time)
     ascii_exist = True # sets that there's a new ascii file to load, analyze, and append
+    stage = begin_stage('ingest')
     
-    # read in new ascii file if it can be found
-    if ascii_file != 'None' and ascii_file != 'none':
-        try:
-            f = open(ascii_file, 'r')
-        except:
-            print('-a '+ascii_file.ljust(30)+red('Fail').ljust(18)+'Continuing')
-            logging.info('Tried and failed to load '+ascii_file)
-            ascii_exist = False
-        else:
-            data = f.read().splitlines()
-            f.close()
-            print('-a '+ascii_file.ljust(30)+green('Success'))
-            logging.info('Loaded '+ascii_file)
+    # read in new ascii files if they can be found, skipping files already added in a previous run
+    if [file.lower() for file in ascii_files] != ['none']:
+        summary = pipeline.add_ascii(ascii_files, workers)
+        if not summary:
+            print('-a '+' '.join(ascii_files).ljust(30)+red('Fail').ljust(18)+'No files found. Continuing')
+            logging.info('Tried and failed to find ascii files '+' '.join(ascii_files))
+        for ascii_file, status, detail in summary:
+            if status == 'skipped':
+                print('-a '+ascii_file.ljust(30)+blue('Skipped').ljust(18)+'Already loaded ('+detail+')')
+                logging.info('Skipped '+ascii_file+' because it was already loaded ('+detail+')')
+        for ascii_file, status, detail in summary:
+            if status == 'failed':
+                print('-a '+ascii_file.ljust(30)+red('Fail').ljust(18)+'Continuing')
+                logging.info('Tried and failed to load '+ascii_file)
+            elif status == 'loaded':
+                print('-a '+ascii_file.ljust(30)+green('Success'))
+                logging.info('Loaded '+ascii_file)
+        ascii_exist = len(pipeline.data_df) > 0
     else:
-        print('-a '+ascii_file.ljust(30)+blue('Skipped'))
+        print('-a '+ascii_files[0].ljust(30)+blue('Skipped'))
         logging.info('User specified '"--ascii None"' flag so no ASCII file loaded')
         ascii_exist = False
+    end_stage(stage, len(pipeline.data_df))
     sleep(sleep_time)
     
     # load keys and students file
+    stage = begin_stage('load inputs')
     keys_df = safe_open_excel('-k', keys_file)
     students_df = safe_open_excel('-i', students_file)
-    
-    # cleanup raw data file - remove unneeded columns, split id num into school id and student id, map number to mult choice letter
-    def ascii_cleanup(data):
-        # checks if there's a blank for test number and puts in a 0 instead which will flag later for user input
-        data = [(line[:50]+'0'+line[51:]) if line[50] == ' ' else line for line in data]
-        # checks if there's a blank in the school id or test id and if so replaces with 000 and 00 for each respectively
-        data = [(line[:40]+'00000'+line[46:]) if ' ' in line[40:45] else line for line in data]
-        data = [line.split(None, 6)[4:] for line in data]
-        for i in range(len(data)):
-            school_id = data[i][0][0:3]
-            student_id = data[i][0][3:5]
-            test_id = data[i][1]
-            test_id = tests.get(test_id,'None') # to replace test number with name 
-            answers = list(data[i][2])
-            multchoice = {'1':'A', '2':'B', '3':'C', '4':'D', '5':'E'}
-            answers = list(map(lambda char: multchoice.get(char,char), answers))
-            data[i] = [int(school_id), int(student_id)] + [test_id] + [answers] + [0]
-        return data
+    pipeline.set_keys(keys_df)
+    pipeline.set_students(students_df)
+    end_stage(stage, len(students_df))
+    require_form_column(pipeline)
     
     # check for improper test id
     def check_and_update_test_ids(df):
         flag_improper = False
-        for index, row in df.iterrows():
-            student_id = int(row['Student ID'])
-            school_id = int(row['School ID'])
-            test = row['Test']
-            if test not in tests.values():
-                flag_improper = True
-                print(f"\n\nInvalid Test '{test}' for student {student_id} school {school_id} at index {index}.\n")
-                print('  Test -> Type exactly Biology, Chemistry, Computer Science, Mathematics, or Physics\n')
+        for issue in pipeline.issues(['test']):
+            index, test = issue.index, issue.values['Test']
+            student_id, school_id = issue.values['Student ID'], issue.values['School ID']
+            flag_improper = True
+            print(f"\n\nInvalid Test '{test}' for student {student_id} school {school_id} at index {index}.\n")
+            if non_interactive: continue
+            print('  Test -> Type exactly Biology, Chemistry, Computer Science, Mathematics, or Physics\n')
+            new_test = input(' > Overwrite Test name: ')
+            while new_test not in tests.values():
+                print('\nInvalid input. Try again.\n')
                 new_test = input(' > Overwrite Test name: ')
-                while new_test not in tests.values():
-                    print('\nInvalid input. Try again.\n')
-                    new_test = input(' > Overwrite Test name: ')
-                df.at[index, 'Test'] = new_test
-                logging.info("In ASCII data - updated Test field from '"+str(test)+"' to '"+str(new_test)+"' for student "+str(student_id)+" school "+str(school_id)+" at index "+str(index))
+            pipeline.correct(index, 'Test', new_test)
+            logging.info("In ASCII data - updated Test field from '"+str(test)+"' to '"+str(new_test)+"' for student "+str(student_id)+" school "+str(school_id)+" at index "+str(index))
+        flag_improper_total.append(flag_improper)
+        return df
+    
+    # check for a missing or unknown form on tests with more than one answer key
+    def check_and_update_forms(df):
+        flag_improper = False
+        for issue in pipeline.issues(['form']):
+            index, test = issue.index, issue.values['Test']
+            student_id, school_id = issue.values['Student ID'], issue.values['School ID']
+            form = df.at[index, 'Form'] if 'Form' in df else ''
+            forms = sorted(pipeline.forms[test])
+            flag_improper = True
+            print(f"\n\nInvalid Form '{form}' on {test} for student {student_id} school {school_id} at index {index}.\n")
+            if non_interactive: continue
+            print('  Form -> Type exactly '+', '.join(forms[:-1])+' or '+forms[-1]+'\n')
+            new_form = input(' > Overwrite Form: ')
+            while new_form not in forms:
+                print('\nInvalid input. Try again.\n')
+                new_form = input(' > Overwrite Form: ')
+            if 'Form' not in df: df['Form'] = ''
+            pipeline.correct(index, 'Form', new_form)
+            logging.info("In ASCII data - updated Form field from '"+str(form)+"' to '"+str(new_form)+"' on "+str(test)+" for student "+str(student_id)+" school "+str(school_id)+" at index "+str(index))
         flag_improper_total.append(flag_improper)
         return df
     
     # check for improper school id
     def check_and_update_school_ids(df):
         flag_improper = False
-        for index, row in df.iterrows():
-            student_id = int(row['Student ID'])
-            school_id = int(row['School ID'])
-            if school_id < 100 or school_id > max_school_id:
-                flag_improper = True
-                if school_id == 0: school_id = 'has blank'
-                print(f"\n\nInvalid School ID '{school_id}' for student {student_id} at index {index}. Please enter a valid School ID (100-{max_school_id}). Enter 999 to skip permanently.\n")
+        for issue in pipeline.issues(['school_id']):
+            index, student_id, school_id = issue.index, issue.values['Student ID'], issue.values['School ID']
+            flag_improper = True
+            if school_id == 0: school_id = 'has blank'
+            print(f"\n\nInvalid School ID '{school_id}' for student {student_id} at index {index}. Please enter a valid School ID (100-{max_school_id}). Enter 999 to skip permanently.\n")
+            if non_interactive: continue
+            new_school_id = int(input(' > Overwrite School ID: '))           
+            while new_school_id < 1 or new_school_id > max_school_id and new_school_id != 999:
+                print(f"\nInvalid input. Please enter a School ID between 100 and {max_school_id}.\n")
                 new_school_id = int(input(' > Overwrite School ID: '))           
-                while new_school_id < 1 or new_school_id > max_school_id and new_school_id != 999:
-                    print(f"\nInvalid input. Please enter a School ID between 100 and {max_school_id}.\n")
-                    new_school_id = int(input(' > Overwrite School ID: '))           
-                df.at[index, 'School ID'] = new_school_id
-                logging.info("In ASCII data - updated School ID field from '"+str(school_id)+"' to '"+str(new_school_id)+"' for student "+str(student_id)+" at index "+str(index))
+            pipeline.correct(index, 'School ID', new_school_id)
+            logging.info("In ASCII data - updated School ID field from '"+str(school_id)+"' to '"+str(new_school_id)+"' for student "+str(student_id)+" at index "+str(index))
         flag_improper_total.append(flag_improper)
         return df
     
     # check for improper student id
     def check_and_update_student_ids(df):
         flag_improper = False
-        for index, row in df.iterrows():
-            student_id = int(row['Student ID'])
-            school_id = int(row['School ID'])
-            if student_id < 1 or student_id > num_students_per_school:
-                flag_improper = True
-                if student_id == 0: student_id = 'has blank'
-                print(f"\n\nInvalid Student ID '{student_id}' for school {school_id} at index {index}. Please enter a valid Student ID (1-12). Enter 99 to skip permanently.\n")
+        for issue in pipeline.issues(['student_id']):
+            index, student_id, school_id = issue.index, issue.values['Student ID'], issue.values['School ID']
+            flag_improper = True
+            if student_id == 0: student_id = 'has blank'
+            print(f"\n\nInvalid Student ID '{student_id}' for school {school_id} at index {index}. Please enter a valid Student ID (1-12). Enter 99 to skip permanently.\n")
+            if non_interactive: continue
+            new_student_id = int(input(' > Overwrite Student ID: '))           
+            while new_student_id < 1 or new_student_id > num_students_per_school and new_student_id != 99:
+                print("\nInvalid input. Please enter a Student ID between 1 and 12.\n")
                 new_student_id = int(input(' > Overwrite Student ID: '))           
-                while new_student_id < 1 or new_student_id > num_students_per_school and new_student_id != 99:
-                    print("\nInvalid input. Please enter a Student ID between 1 and 12.\n")
-                    new_student_id = int(input(' > Overwrite Student ID: '))           
-                df.at[index, 'Student ID'] = new_student_id
-                logging.info("In ASCII data - updated Student ID field from '"+str(student_id)+"' to '"+str(new_student_id)+"' for school "+str(school_id)+" at index "+str(index))
+            pipeline.correct(index, 'Student ID', new_student_id)
+            logging.info("In ASCII data - updated Student ID field from '"+str(student_id)+"' to '"+str(new_student_id)+"' for school "+str(school_id)+" at index "+str(index))
         flag_improper_total.append(flag_improper)
         return df    
  
-    # Grade - function to count matches based on the test number
-    def grade(row, keys_df):
-        test_name = row['Test']
-    #    test_name = tests.get(test_number,'None')
-        answers = row['Answers']
-        keys = keys_df[str(test_name)]
-        match_count = sum(1 for answer, key in zip(answers, keys) if answer == key)
-        return match_count
-    
-    # cleanup & check for improper data - calls functions above
-    flag_improper_total = []
-    if ascii_exist:
-        print('\nCleaning ASCII file & checking for improper School and Student IDs...', end=' ')
-        sleep(sleep_time)
-        data = ascii_cleanup(data)
-        data_df = pd.DataFrame(data, columns=['School ID','Student ID','Test','Answers','Score'])
-        data_df = check_and_update_student_ids(data_df)
-        data_df = check_and_update_school_ids(data_df)
-        data_df = check_and_update_test_ids(data_df)
-        data_df['Score'] = data_df.apply(lambda row: grade(row, keys_df), axis=1)
-        if True not in flag_improper_total: print(green('Done'))
-    
-    # Add new data to old data batch saved in csv file in same folder
-    filename = 'MaST-data-'+str(current_year)+'-'+current_weekday+'.csv'
+    # Add new data to old data batch saved in the data file in same folder
+    stage = begin_stage('load data')
+    filename = pipeline.db.filename if pipeline.db is not None else pipeline.data_file
+    csv_filename = pipeline.migrate()
+    if csv_filename is not None:
+        print(f'\nMigrating previous data from {csv_filename} to {filename}...', end=' ')
+        print(green('Done'))
+        logging.info('Migrated '+csv_filename+' to '+filename)
     if ascii_exist:
         print(f'\nAttempting to add new data from ASCII file to previous data in {filename}...', end=' ')
         sleep(sleep_time)
-        try:
-            og_data_df = pd.read_csv(filename, index_col=0)
-        except:
+        if not pipeline.load():
             print(purple('Fail\n'))
             print(f'** Did not find previous file {filename}. Creating new file. **\n')
             logging.info('Did not find previous file '+filename+'. Created file.')
         else:
             print(green('Done\n'))
-            og_data_df['Answers'] = og_data_df['Answers'].apply(ast.literal_eval)
-            data_df = pd.concat([og_data_df, data_df], ignore_index=True)
-            data_df.to_csv(filename)
             logging.info('Loaded '+filename+'. Appended ASCII data to end of file.')
     else:
         print(f'\nAttemping to load previous data from {filename}...', end=' ')
         sleep(sleep_time)
-        try:
-            og_data_df = pd.read_csv(filename, index_col=0)
-        except:
+        if not pipeline.load():
             print(red('Fail\n'))
             print(f'** Did not find previous file {filename}. **\n')
             print('No data to analyze. Exiting script.')
@@ -284,16 +1635,47 @@ def update_main(ascii_file, keys_file, students_file, no_lost):
             sys.exit()
         else:
             print(green('Done\n'))
-            og_data_df['Answers'] = og_data_df['Answers'].apply(ast.literal_eval)
-            data_df = og_data_df
             logging.info('Loaded '+filename+'. Appended ASCII data to end of file.')
-
+    data_df = pipeline.data_df
+    end_stage(stage, len(data_df))
+    
+    # replay corrections saved by earlier runs, e.g. when a batch is loaded again into a new data file
+    stage = begin_stage('cleanup')
+    journal = pipeline.journal()
+    journal_file = pipeline.db.filename if pipeline.db is not None else pipeline.journal_file
+    if journal:
+        print('Applying saved corrections from '+journal_file+'...', end=' ')
+        num_applied = pipeline.apply_journal(journal)
+        print(green('Done')+f' ({num_applied} applied)\n')
+        if num_applied: logging.info('Applied '+str(num_applied)+' saved corrections from '+journal_file)
+    
+    # check for improper data - calls functions above. new data and anything left unresolved by a --non_interactive run
+    flag_improper_total = []
+    print('Cleaning ASCII data & checking for improper School and Student IDs...', end=' ')
+    sleep(sleep_time)
+    data_df = check_and_update_student_ids(data_df)
+    data_df = check_and_update_school_ids(data_df)
+    data_df = check_and_update_test_ids(data_df)
+    data_df = check_and_update_forms(data_df)
+    if True not in flag_improper_total: print(green('Done\n'))
+    else: print('')
+    end_stage(stage, len(data_df))
+    
+    # issues over all the data, rechecked only for the records touched after every update_record edit
+    stage = begin_stage('validation')
+    record_edits = []
+    issues = pipeline.issues(['three_plus', 'same_test', 'lost_student'])
+    def recheck(df, issues):
+        issues = pipeline.recheck(issues, record_edits, ['three_plus', 'same_test', 'lost_student'])
+        record_edits.clear()
+        return issues
+    
     # check that a student didn't take 3 or more tests
-    def find_three_plus_same_student(df):
+    def find_three_plus_same_student(df, issues):
         cont = False
         print('Checking that one student ID did not take 3 or more tests...', end=' ')
         sleep(sleep_time)
-        bool_series = df.groupby(['School ID', 'Student ID']).filter(lambda group: group.shape[0] >= 3)[['School ID', 'Student ID', 'Test', 'Answers']]
+        bool_series = df.loc[[issue.index for issue in issues if issue.kind == 'three_plus'], ['School ID', 'Student ID', 'Test', 'Answers']]
         if not bool_series.empty:
             print('\n\n'+red('**')+' The following school-student combinations show up 3 or more times '+red('**')+'\n')
             print(bool_series)
@@ -302,11 +1684,11 @@ def update_main(ascii_file, keys_file, students_file, no_lost):
         return cont
     
     # after find_three_plus_same_student, checks that a student didn't take the same test twice
-    def find_same_student_test(df):
+    def find_same_student_test(df, issues):
         cont = False
         print('Checking that one student did not take the same test twice...', end=' ')
         sleep(sleep_time)
-        bool_series = df.groupby(['School ID', 'Student ID', 'Test']).filter(lambda group: group.shape[0] >= 2)[['School ID', 'Student ID', 'Test', 'Answers']]
+        bool_series = df.loc[[issue.index for issue in issues if issue.kind == 'same_test'], ['School ID', 'Student ID', 'Test', 'Answers']]
         if not bool_series.empty:
             print('\n\n'+red('**')+' The following school-student-test combinations show up 2 or more times '+red('**')+'\n')
             print(bool_series)
@@ -319,6 +1701,9 @@ def update_main(ascii_file, keys_file, students_file, no_lost):
         cont = True
         print('To update a record first enter the index number of the record to update. Enter -1 to continue with no further edits.\n')
         index = int(input(' > Index: '))
+        while index != -1 and index not in df.index:
+            print('\nNo record with that index. Try again.\n')
+            index = int(input(' > Index: '))
         if index != -1:
             print('\nWhich field would you like to update? Enter number\n')
             print('   1 - School ID')
@@ -341,7 +1726,7 @@ def update_main(ascii_file, keys_file, students_file, no_lost):
             if field == 1: column = 'School ID'
             elif field == 2: column = 'Student ID'
             elif field == 3: column = 'Test'
-            df.at[index, column] = value
+            record_edits.extend(pipeline.correct(index, column, value))
             print('\n** Record updated successfully **\n')
             logging.info('Record updated - Index '+str(index)+' '+column+' updated to '+str(value)+'.')
         else: cont = False
@@ -349,59 +1734,72 @@ def update_main(ascii_file, keys_file, students_file, no_lost):
     
     cont = True
     while cont == True:
-        cont = find_three_plus_same_student(data_df)
-        if not cont: break
+        cont = find_three_plus_same_student(data_df, issues)
+        if not cont or non_interactive: break
         cont, data_df = update_record(data_df)
+        issues = recheck(data_df, issues)
     
     cont = True
     while cont == True:
-        cont = find_same_student_test(data_df)
-        if not cont: break
+        cont = find_same_student_test(data_df, issues)
+        if not cont or non_interactive: break
         cont, data_df = update_record(data_df)
+        issues = recheck(data_df, issues)
+    
+    # sheets of one test with far more identical wrong answers than chance, e.g. a rescan under a mis-bubbled id or copying
+    def find_similar_sheets():
+        print('Comparing answer sheets of the same test for near-identical answers...', end=' ')
+        sleep(sleep_time)
+        similar_df = pipeline.similar(similar, workers)
+        similar_df.to_csv(similarity_filename, index=False)
+        if similar_df.empty:
+            print(green('Done\n'))
+            return False
+        print('\n\n'+red('**')+f" The following pairs share more identical wrong answers than chance (z of {similarity_limits['z']:g} or more) "+red('**')+'\n')
+        print(similar_df.to_markdown(index=False))
+        print(f'\nSaved to {similarity_filename}\n')
+        logging.info(str(len(similar_df))+' pairs of similar answer sheets written to '+similarity_filename)
+        return True
+    
+    if similar:
+        stage_similar = begin_stage('similarity')
+        found_one = find_similar_sheets()
+        end_stage(stage_similar, len(data_df))
+        if found_one and not non_interactive:
+            cont = True
+            while cont == True:
+                cont, data_df = update_record(data_df)
+            issues = recheck(data_df, issues)
    
     # find lost students - have test but not matching registered student
     # does the list of lost students need to be reprinted each time update_record is called? 
     # If so, structure like while loop above...
-    def find_lost_student(df):
-        found_one = False
-        for index, row in df.iterrows():
-            student_id = int(row['Student ID'])
-            school_id = int(row['School ID'])
-            found = students_df.loc[(students_df['school id'] == school_id) & (students_df['student id'] == student_id)]
-            if found.empty:
-                if not found_one: print('\n')
-                print(purple('**')+f' Test exists, but no student found for school id {school_id} student id {student_id} at index {index}.\n')
-                found_one = True
-        return found_one
+    def find_lost_student(df, issues):
+        lost = [issue for issue in issues if issue.kind == 'lost_student']
+        if lost: print('\n')
+        for issue in lost:
+            print(purple('**')+f" Test exists, but no student found for school id {issue.values['School ID']} student id {issue.values['Student ID']} at index {issue.index}.\n")
+        return len(lost) > 0
     
     print('Searching for lost students...', end=' ')
-    found_one = find_lost_student(data_df)
+    found_one = find_lost_student(data_df, issues)
     if found_one:
-        cont = True
+        cont = not non_interactive
         while cont == True:
             cont, data_df = update_record(data_df)
+        issues = recheck(data_df, issues)
         print('')
     else: print(green('Done\n'))
    
     # find lost tests - have a registered student but missing test for said student
     def find_lost_test(df):
-        # Reshape students_df to long format
-        students_long_df = pd.melt(students_df, id_vars=['school id', 'student id'], value_vars=['test 1', 'test 2'], var_name='test_type', value_name='Test')
-        # Rename columns for consistent naming
-        students_long_df.rename(columns={'school id': 'School ID', 'student id': 'Student ID'}, inplace=True)
-        # Merge with data_df
-        merged_df = pd.merge(students_long_df, df, how='left', on=['School ID', 'Student ID', 'Test'], indicator=True)
-        # Check for non-matches
-        non_matches_df = merged_df[merged_df['_merge'] == 'left_only']
-        non_matches_df = non_matches_df[['School ID', 'Student ID', 'Test']]
-        # Display the non-matching rows
-        merged_df = pd.merge(non_matches_df, students_df, left_on=['School ID', 'Student ID'], right_on=['school id', 'student id'])      
-        if merged_df.empty:
+        lost_df = pipeline.lost_tests()
+        if lost_df.empty:
             print(green('Done'))
             print('')
         else:
             print('\n\nHere is a list of all missing tests sorted by School ID\n')
-            print(merged_df[['School ID', 'Student ID', 'name', 'Test']])
+            print(lost_df[['School ID', 'Student ID', 'name', 'Test']])
             print('')
 
     print('Searching for lost tests...', end=' ')
@@ -409,32 +1807,38 @@ def update_main(ascii_file, keys_file, students_file, no_lost):
         find_lost_test(data_df)
     else: print(blue('Skipped\n'))
     
+    # queue everything still unresolved to a report instead of asking
+    if non_interactive:
+        print(f'Writing unresolved issues to {issues_filename}...', end=' ')
+        unresolved = pipeline.issues()
+        pipeline.write_issues(unresolved, issues_filename)
+        print(green('Done')+f' ({len(unresolved)} issues)\n')
+        logging.info(str(len(unresolved))+' unresolved issues written to '+issues_filename)
+    end_stage(stage, len(data_df))
+    
     
-    # Now I need to grade things
-    print('Regrading all tests and saving to .csv file...', end=' ')
+    # Now I need to grade things - only new or edited tests unless the keys changed
+    print('Grading new and edited tests and saving to data file...', end=' ')
     sleep(sleep_time)
-    data_df['Score'] = data_df.apply(lambda row: grade(row, keys_df), axis=1)
-    data_df.to_csv(filename)
-    logging.info('All tests regraded and written to '+filename)
-    print(green('Done\n'))
+    stage = begin_stage('grading')
+    num_graded = pipeline.grade(full_regrade)
+    end_stage(stage, num_graded)
+    stage = begin_stage('write data')
+    pipeline.save()
+    end_stage(stage, len(data_df))
+    if num_graded == len(data_df):
+        logging.info('All tests regraded and written to '+filename)
+    else:
+        logging.info(str(num_graded)+' new or edited tests graded and written to '+filename)
+    print(green('Done')+f' ({num_graded} of {len(data_df)} graded)\n')
     
     # put quantile values in data_df for every test
-    def determine_q(score):
-        if data_df_agg.loc[test, ('Score', 'count')] < 100:
-            q_list = [0.98, 0.96, 0.94, 0.88, 0.75, 0.50]
-        else: q_list = [0.99, 0.98, 0.97, 0.90, 0.80, 0.50]
-    #    q_list = [0.99, 0.98, 0.97, 0.90, 0.80, 0.50] # all of these HAVE to be in q_options
-        for q in q_list:
-            if score >= data_df_agg.loc[test, ('Score', 'q'+'{:.2f}'.format(q))]: # the format makes sure there's a zero at the end of the float number from q_list
-                return Decimal('1.00') - Decimal(str(q))
-        return Decimal('0.99')
-    
     print('Calculating quantiles and total test count...', end=' ')
     sleep(sleep_time)
     # create agg df
-    data_df_agg = make_agg_df(data_df)
-    for test in data_df['Test'].unique():
-        data_df.loc[data_df['Test'] == test, 'Calc Quantile'] = data_df.loc[data_df['Test'] == test, 'Score'].apply(determine_q)
+    stage = begin_stage('quantiles')
+    data_df_agg = pipeline.standings()
+    end_stage(stage, len(data_df))
     print(green('Done\n'))
     print('Current test totals\n')
     test_totals = data_df_agg[('Score', 'count')]
@@ -443,18 +1847,21 @@ def update_main(ascii_file, keys_file, students_file, no_lost):
     print_tests = print_tests.rename('Count')
     print(print_tests.to_markdown())
     print('')        
- 
-    # copy Calc Quantile column to Award Quantile
-    data_df['Award Quantile'] = data_df['Calc Quantile']
     
     # sort data and write final file for user edits
     filename = 'MaST-data-final'+file_date_tag+'.xlsx'
-    print(f'Sorting by Test & Score then saving all data to {filename}...', end=' ')
-    sleep(sleep_time)
-    data_df_sorted = data_df.sort_values(by=['Test', 'Score'], ascending=[True, False])
-    data_df_sorted.to_excel(filename)
-    logging.info(f'Quantiles computed, data sorted, and data written to {filename}')
-    print(green('Done\n'))
+    if not skip_final:
+        print(f'Sorting by Test & Score then saving all data to {filename}...', end=' ')
+        sleep(sleep_time)
+        stage = begin_stage('write final')
+        data_df_sorted = pipeline.write_final(filename)
+        end_stage(stage, len(data_df_sorted))
+        logging.info(f'Quantiles computed, data sorted, and data written to {filename}')
+        print(green('Done\n'))
+    else:
+        print(f'Saving all data to {filename}...', end=' ')
+        print(blue('Skipped\n'))
+        logging.info(f'Quantiles computed. User specified --skip_final so {filename} not written')
     
     # final print
     print("If there are further scantron ascii files to process, rerun this script by\n")
@@ -464,18 +1871,354 @@ def update_main(ascii_file, keys_file, students_file, no_lost):
     print("    python MaST.py results\n")
     print('-- Program completed successfully. --')
 
+# --- Rekey ---
+
+# every test whose score, Calc Quantile or School Points changed with the new keys, or whose award was edited by hand.
+# before_df and after_df have the Score, Calc Quantile, Award Quantile and School Points of every test
+def rekey_report(before_df, after_df, manual_awards, reset_awards=False):
+    old_calc, new_calc = before_df['Calc Quantile'].astype(float), after_df['Calc Quantile'].astype(float)
+    changed = (before_df['Score'] != after_df['Score']) | ~np.isclose(old_calc, new_calc, equal_nan=True) | (before_df['School Points'] != after_df['School Points'])
+    report_df = pd.DataFrame({
+        'School ID': after_df['School ID'],
+        'Student ID': after_df['Student ID'],
+        'Test': after_df['Test'],
+        'Old Score': before_df['Score'],
+        'New Score': after_df['Score'],
+        'Old Calc Quantile': old_calc,
+        'New Calc Quantile': new_calc,
+        'Award Quantile': after_df['Award Quantile'].astype(float),
+        'Manual Award': pd.Series('', index=after_df.index).mask(after_df.index.isin(manual_awards.index), 'reset' if reset_awards else 'kept'),
+        'Old School Points': before_df['School Points'],
+        'New School Points': after_df['School Points'],
+    })
+    return report_df[changed | (report_df['Manual Award'] != '')].rename_axis('Index')
+
+# School Points total and place of every school before and after, only the schools that changed
+def rekey_school_report(before_points, after_points):
+    schools_df = pd.DataFrame({'Old Points': before_points, 'New Points': after_points}).fillna(0).astype(int)
+    schools_df['Change'] = schools_df['New Points'] - schools_df['Old Points']
+    schools_df['Old Rank'] = schools_df['Old Points'].rank(method='min', ascending=False).astype(int)
+    schools_df['New Rank'] = schools_df['New Points'].rank(method='min', ascending=False).astype(int)
+    schools_df = schools_df[(schools_df['Change'] != 0) | (schools_df['Old Rank'] != schools_df['New Rank'])]
+    return schools_df.sort_values('New Rank').rename_axis('School ID')
+
+def rekey_main(keys_file, final_file, reset_awards=False, db_file=None, skip_final=False):
+    print('-- Rekey --\n')
+    pipeline = Pipeline(db_file=db_file)
+    stage = begin_stage('load inputs')
+    keys_df = safe_open_excel('-k', keys_file)
+    filename = pipeline.db.filename if pipeline.db is not None else pipeline.data_file
+    if not pipeline.load():
+        print('-f '+filename.ljust(30)+red('Fail'))
+        print('\nRun update mode first. Exiting')
+        logging.info('Tried and failed to load '+filename+'. Script will exit.')
+        sys.exit()
+    print('-f '+filename.ljust(30)+green('Success'))
+    # awards edited by hand in the final file are the ones that differ from its Calc Quantile
+    manual_awards = pd.Series(dtype=float)
+    if os.path.exists(final_file):
+        final_df = safe_open_excel('-d', final_file)
+        final_df = final_df.set_index(final_df.columns[0])
+        edited = ~np.isclose(final_df['Award Quantile'].astype(float), final_df['Calc Quantile'].astype(float), equal_nan=True)
+        manual_awards = final_df.loc[edited & final_df.index.isin(pipeline.data_df.index), 'Award Quantile']
+    else:
+        print('-d '+final_file.ljust(30)+blue('Skipped').ljust(18)+'No final file, so no award edits to keep')
+    end_stage(stage, len(pipeline.data_df))
+    
+    # standings before and after, the scores change by the change of every edited question instead of a full regrade
+    print('\nRescoring tests with changed questions...', end=' ')
+    stage = begin_stage('rekey')
+    pipeline.standings()
+    before_df = pipeline.data_df[['School ID', 'Student ID', 'Test', 'Score', 'Calc Quantile']].copy()
+    before_df['School Points'] = assign_school_points(pipeline.data_df, pipeline.data_df_agg)
+    before_points = pipeline.school_points()
+    changes, rescored = pipeline.rekey(keys_df)
+    pipeline.standings()
+    if not reset_awards:
+        pipeline.data_df.loc[manual_awards.index, 'Award Quantile'] = manual_awards
+    after_df = pipeline.data_df[['School ID', 'Student ID', 'Test', 'Score', 'Calc Quantile', 'Award Quantile']].copy()
+    after_df['School Points'] = assign_school_points(pipeline.data_df, pipeline.data_df_agg)
+    after_points = pipeline.school_points()
+    seconds = end_stage(stage, int(rescored.sum()))['wall']
+    print(green('Done')+f' ({int(rescored.sum())} of {len(pipeline.data_df)} rescored in {seconds*1000:.0f} ms)\n')
+    
+    if changes is None:
+        print(purple('**')+' The keys these scores were graded with were not saved, so every test was graded again '+purple('**')+'\n')
+        changes = pd.DataFrame(columns=['Key', 'Question', 'Old Answer', 'New Answer', 'Old Weight', 'New Weight'])
+    elif rescored.all() and len(rescored):
+        print(purple('**')+' The saved scores were not graded with the saved keys, so every test was graded again '+purple('**')+'\n')
+    if changes.empty:
+        print('No questions changed.\n')
+    else:
+        print('Changed questions\n')
+        print(changes.to_markdown(index=False))
+        print('')
+    for change in changes.itertuples(index=False):
+        logging.info(f"Rekey - {change.Key} question {change.Question} changed from '{change[2]}' (weight {change[4]}) to '{change[3]}' (weight {change[5]})")
+    
+    tests_df = rekey_report(before_df, after_df, manual_awards, reset_awards)
+    schools_df = rekey_school_report(before_points, after_points)
+    num_quantiles = int((~np.isclose(tests_df['Old Calc Quantile'], tests_df['New Calc Quantile'], equal_nan=True)).sum())
+    print(f"{int((tests_df['Old Score'] != tests_df['New Score']).sum())} scores and {num_quantiles} Calc Quantiles changed.", end=' ')
+    if reset_awards: print(f'{len(manual_awards)} hand edited Award Quantiles reset to the Calc Quantile.\n')
+    else: print(f'{len(manual_awards)} hand edited Award Quantiles kept.\n')
+    if not schools_df.empty:
+        print('School Points changes\n')
+        print(schools_df.to_markdown())
+        print('')
+    
+    # the report is kept next to the data as the record of what the rekey changed
+    report_file = 'MaST-rekey'+file_date_tag+'-'+datetime.now().strftime('%H%M%S')+'.xlsx'
+    stage = begin_stage('write report')
+    with pd.ExcelWriter(report_file, engine='xlsxwriter') as writer:
+        changes.to_excel(writer, sheet_name='Questions', index=False)
+        tests_df.to_excel(writer, sheet_name='Tests')
+        schools_df.to_excel(writer, sheet_name='Schools')
+    end_stage(stage, len(tests_df))
+    print(f'Saving changes to {report_file}...', end=' ')
+    print(green('Done'))
+    logging.info(f'Rekeyed with {keys_file}: {len(changes)} questions changed, {int(rescored.sum())} tests rescored, report written to {report_file}')
+    
+    stage = begin_stage('write data')
+    pipeline.save()
+    end_stage(stage, len(pipeline.data_df))
+    print(f'Saving new scores to {filename}...', end=' ')
+    print(green('Done'))
+    if not skip_final:
+        stage = begin_stage('write final')
+        pipeline.write_final(final_file)
+        end_stage(stage, len(pipeline.data_df))
+        print(f'Saving all data to {final_file}...', end=' ')
+        print(green('Done\n'))
+        logging.info(f'Rekeyed data written to {final_file}')
+    else:
+        print(f'Saving all data to {final_file}...', end=' ')
+        print(blue('Skipped\n'))
+    print('-- Program completed successfully. --')
+
 
 
 # --- Results --- 
 
-def results_main(data_file, students_file, schools_file):
+# award percentiles that get a sheet of names in each winners workbook
+award_percentiles = [0.01, 0.02, 0.03, 0.10]
+#award_percentiles = [0.02, 0.04, 0.06, 0.12]
+
+# points mapping for school points, all of these options HAVE to show up in q_options
+points_mapping_large = {
+    '0.01': 10,
+    '0.02': 8,
+    '0.03': 6,
+    '0.10': 4,
+    '0.20': 2,
+    '0.50': 1,
+}
+points_mapping_small = {
+    '0.02': 10,
+    '0.04': 8,
+    '0.06': 6,
+    '0.12': 4,                              
+    '0.25': 2,
+    '0.50': 1,
+}
+
+# School Points for every test from its Calc Quantile, using the large mapping for tests taken 100 or more times.
+# Tests with no scores (e.g. an improper test left by a --non_interactive run) get 0. Quantiles are looked up as the
+# str of a float, the way they read back from the final Excel file, so Decimals from update mode score the same
+def assign_school_points(data_df_final, data_df_agg=None):
+    if data_df_agg is None: data_df_agg = make_agg_df(data_df_final)
+    counts = data_df_final['Test'].map(data_df_agg[('Score', 'count')])
+##    quantiles = data_df_final['Calc Quantile'].astype(float).map('{:.2f}'.format)
+    quantiles = data_df_final['Calc Quantile'].astype(float).map(str)
+    large = quantiles.map(points_mapping_large).fillna(0).astype(int)
+    small = quantiles.map(points_mapping_small).fillna(0).astype(int)
+    return pd.Series(np.select([counts >= 100, counts < 100], [large, small], 0), index=data_df_final.index)
+
+# total School Points of each school, highest first
+def rank_schools(data_df_final):
+    school_points = data_df_final.groupby('School ID')['School Points'].sum()
+    return school_points.sort_values(ascending=False)
+
+# school rankings workbook, sorted_school_points is the School Points total of each school highest first
+def write_rankings(sorted_school_points, schools_df, file_path):
+    merge_df = pd.merge(sorted_school_points, schools_df, left_on=['School ID'], right_on=['id'])
+    merge_df = merge_df[['id', 'School Points', 'school']]
+    merge_df.to_excel(file_path)
+
+# every test with an award percentile, in the order of the final file, with the student name from one lookup in the
+# registry. Tests of students that aren't registered are left out since there is no name to print
+def award_winners(data_df_final, registry):
+    winners_df = data_df_final.loc[data_df_final['Award Quantile'].isin(award_percentiles), ['Test', 'Award Quantile', 'School ID', 'Student ID']]
+    keys = pd.MultiIndex.from_arrays([winners_df['School ID'], winners_df['Student ID']])
+    registered = keys.isin(registry.student_index)
+    return winners_df[registered].assign(name=registry.names.reindex(keys[registered]).to_numpy())
+
+# winners workbook for one test with a sheet of names for each award percentile, used for a mailmerge to print certificates.
+# winners_df is the award_winners rows of the test. Sheets are streamed row by row so memory stays flat for any size
+def write_winners(winners_df, file_path):
+    import xlsxwriter
+    bands = winners_df.groupby('Award Quantile').indices
+    names = winners_df['name'].astype(object).where(winners_df['name'].notna(), None).to_numpy()
+    workbook = xlsxwriter.Workbook(file_path, {'constant_memory': True})
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    for percentile in award_percentiles:
+        worksheet = workbook.add_worksheet(str(percentile*100)+'%')
+        worksheet.write(0, 0, 'Name', header_format)
+        worksheet.write_column(1, 0, names[bands.get(percentile, [])].tolist())
+    workbook.close()
+
+# every winner of every test in one file for the certificate printer's mail merge, tests in the order of the final file
+# and the award percentiles highest first
+def write_certificates(winners_df, school_names, file_path):
+    certificates_df = winners_df.sort_values('Award Quantile', kind='stable')
+    certificates_df = certificates_df.iloc[np.argsort(pd.factorize(certificates_df['Test'])[0], kind='stable')]
+    pd.DataFrame({
+        'Test': certificates_df['Test'],
+        'Award': certificates_df['Award Quantile'].map(lambda percentile: f'{percentile*100:g}%'),
+        'School ID': certificates_df['School ID'],
+        'School': certificates_df['School ID'].map(school_names),
+        'Student ID': certificates_df['Student ID'],
+        'Name': certificates_df['name'],
+    }).to_csv(file_path, index=False)
+
+# printouts for teachers, one page per school listing every test taken by its students
+# the title and table header are built once and redrawn by header() on every page, including overflow pages.
+# fpdf is slow to import, so the class is only built the first time a report is drawn
+school_report_class = None
+
+def load_school_report_class():
+    global school_report_class
+    if school_report_class is None:
+        from fpdf import FPDF
+        
+        class SchoolReport(FPDF):
+            current_date = str(current_month)+' '+str(current_day)+', '+str(current_year)
+            columns = [(10, "ID", 'C'), (60, "Student Name", ''), (60, "Test", ''), (20, "Score", 'C'), (20, "Percentile", 'C')]
+            
+            def __init__(self):
+                super().__init__(unit="mm", format="Letter")
+                self.school_title = ''
+            
+            def header(self):
+                # Set title
+                self.set_font("Helvetica", size=12)
+                self.cell(200, 8, text="Mississippi College", new_x="LMARGIN", new_y="NEXT", align='C')
+                self.cell(200, 8, text="Math & Science Tournament", new_x="LMARGIN", new_y="NEXT", align='C')
+                self.cell(200, 8, text=self.current_date, new_x="LMARGIN", new_y="NEXT", align='C')
+                self.ln(4)
+                self.cell(200, 8, text=self.school_title, new_x="LMARGIN", new_y="NEXT", align='C')
+                
+                # Set column headers
+                self.set_font("Helvetica", size=10)
+                for width, title, align in self.columns:
+                    self.cell(width, 8, text=title, border=1, align=align)
+                self.ln()
+            
+            def add_school(self, school_id, school_name, group):
+                self.school_title = f"{school_name} (ID: {school_id})"
+                self.add_page()
+                # Add rows
+                for student_id, name, test, score, calc_quantile in zip(group['Student ID'], group['name'], group['Test'], group['Score'], group['Calc Quantile']):
+                    self.cell(10, 8, text=str(student_id), border=1, align='C')
+                    self.cell(60, 8, text=name, border=1)
+                    self.cell(60, 8, text=str(test), border=1)
+                    self.cell(20, 8, text=str(score), border=1, align='C')
+                    self.cell(20, 8, text="{:.0f}".format(calc_quantile*100), border=1, align='C')
+                    self.ln()
+        
+        school_report_class = SchoolReport
+    return school_report_class
+
+# a new empty school report, the class itself comes from load_school_report_class
+def new_school_report_pdf():
+    return load_school_report_class()()
+
+# whole school report in one file. data_df_final needs the 'name' column from Registry.names_for
+def write_school_report(data_df_final, school_names, file_path):
+    pdf = new_school_report_pdf()
+    for school_id, group in data_df_final.groupby('School ID'):
+        pdf.add_school(school_id, school_names.get(school_id), group)
+    pdf.output(file_path)
+
+# one pdf per school in school_folder, e.g. for emailing each school its own page
+def write_per_school_reports(data_df_final, school_names, school_folder):
+    for school_id, group in data_df_final.groupby('School ID'):
+        pdf = new_school_report_pdf()
+        pdf.add_school(school_id, school_names.get(school_id), group)
+        pdf.output(os.path.join(school_folder, f'MaST-School_Report-{school_id}'+file_date_tag+'.pdf'))
+
+# per school pdfs of one run of schools, file_path names the run inside the folder the pdfs go to
+def write_per_school_shard(shard_df, school_names, file_path):
+    write_per_school_reports(shard_df, school_names, os.path.dirname(file_path))
+
+# one shard of the school report to be merged later, plus its per school pdfs if school_folder is given
+def write_school_report_shard(shard_df, school_names, school_folder, file_path):
+    write_school_report(shard_df, school_names, file_path)
+    if school_folder is not None:
+        write_per_school_reports(shard_df, school_names, school_folder)
+
+# splits the data into at most num_shards runs of whole schools in School ID order
+def school_report_shards(data_df_final, num_shards):
+    school_ids = np.sort(data_df_final['School ID'].unique())
+    shards = []
+    for shard_ids in np.array_split(school_ids, max(1, min(num_shards, len(school_ids)))):
+        if len(shard_ids): shards.append(data_df_final[data_df_final['School ID'].isin(shard_ids)])
+    return shards
+
+# pypdf is optional, without it the report is rendered as a single file instead of being merged from shards
+def can_merge_pdfs():
+    return importlib.util.find_spec('pypdf') is not None
+
+# merges shard pdfs in order into file_path and removes the shards
+def merge_pdfs(shard_paths, file_path):
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for shard_path in shard_paths:
+        writer.append(shard_path)
+    with open(file_path, 'wb') as f:
+        writer.write(f)
+    writer.close()
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+# runs one artifact writer and returns its stage measurements, profiled into profile if given
+def timed_call(function, args, file_path, profile=None):
+    record = measure_start('write '+os.path.basename(file_path), profile)
+    function(*args, file_path)
+    return measure_stop(record, len(args[0]) if args and hasattr(args[0], '__len__') else None)
+
+# builds result files concurrently in a process pool. artifacts is a list of (file_path, function, args), each function
+# is called as function(*args, file_path) and writes only its own file so the output doesn't depend on scheduling.
+# Returns (file_path, stage measurements, error) in the given order, the measurements are None if it failed
+def build_artifacts(artifacts, workers=None):
+    summary = []
+    if workers == 1 or len(artifacts) < 2:
+        for file_path, function, args in artifacts:
+            try:
+                summary.append((file_path, timed_call(function, args, file_path, profile_folder), None))
+            except Exception as e:
+                summary.append((file_path, None, e))
+        return summary
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(timed_call, function, args, file_path, profile_folder) for file_path, function, args in artifacts]
+        for (file_path, _, _), future in zip(artifacts, futures):
+            try:
+                summary.append((file_path, future.result(), None))
+            except Exception as e:
+                summary.append((file_path, None, e))
+    return summary
+
+def results_main(data_file, students_file, schools_file, workers=None, per_school=False, db_file=None, mail_merge=False):
     # general printing
     print('-- Results --\n')
 
     # load data-final, schools, and students
+    stage = begin_stage('load inputs')
     data_df_final = safe_open_excel('-d', data_file)
     schools_df = safe_open_excel('-s', schools_file)
     students_df = safe_open_excel('-i', students_file)
+    registry = Registry(students_df, schools_df)
+    end_stage(stage, len(data_df_final))
     
     # create results folder
     results_folder = 'MaST-results'+file_date_tag
@@ -485,180 +2228,775 @@ def results_main(data_file, students_file, schools_file):
     except Exception as e:
         print(f"An error occurred: {e}")
     
-    # points mapping for school points, all of these options HAVE to show up in q_options
-    points_mapping_large = {
-        '0.01': 10,
-        '0.02': 8,
-        '0.03': 6,
-        '0.10': 4,
-        '0.20': 2,
-        '0.50': 1,
-    }
-    points_mapping_small = {
-        '0.02': 10,
-        '0.04': 8,
-        '0.06': 6,
-        '0.12': 4,                              
-        '0.25': 2,
-        '0.50': 1,
-    }
-    
-    # make agg df
-    data_df_agg = make_agg_df(data_df_final)
-    
-    # Function to map points based on subject and quantile
-    def assign_school_points(row):
-        if data_df_agg.loc[row['Test'], ('Score', 'count')] >= 100:
-    ##        return points_mapping_large.get('{:.2f}'.format(row['Calc Quantile']), 0)
-            return points_mapping_large.get(str(row['Calc Quantile']), 0)
-        elif data_df_agg.loc[row['Test'], ('Score', 'count')] < 100:
-    ##        return points_mapping_small.get('{:.2f}'.format(row['Calc Quantile']), 0)
-            return points_mapping_small.get(str(row['Calc Quantile']), 0)
-        else:
-            return 0
-    
-    # Add a new column "School Points" using the apply method
-    print('Assigning School Points, ranking, and saving file...', end=' ')
+    # school points for every test from its quantile
+    stage = begin_stage('school points')
+    print('Assigning School Points and ranking...', end=' ')
     sleep(sleep_time)
-    data_df_final['School Points'] = data_df_final.apply(assign_school_points, axis=1)
+    data_df_final['School Points'] = assign_school_points(data_df_final)
         
     # Sum the total points for each school
-    school_points = data_df_final.groupby('School ID')['School Points'].sum()
-    sorted_school_points = school_points.sort_values(ascending=False)
-    merge_df = pd.merge(sorted_school_points, schools_df, left_on=['School ID'], right_on=['id'])
-    merge_df = merge_df[['id', 'School Points', 'school']]
-    file_path = os.path.join(results_folder, "MaST-School_Rankings"+file_date_tag+".xlsx")
-    merge_df.to_excel(file_path)
+    sorted_school_points = rank_schools(data_df_final)
+    end_stage(stage, len(data_df_final))
     print(green('Done\n'))
+    
+    # award quantiles and points kept with the tournament for later years
+    if db_file:
+        stage = begin_stage('write database')
+        print(f'Saving quantiles and school points to {db_file}...', end=' ')
+        db = Database(db_file)
+        db.save_registrations(students_df, schools_df)
+        db.save_results(data_df_final, sorted_school_points)
+        db.close()
+        end_stage(stage, len(data_df_final))
+        print(green('Done\n'))
+        logging.info('Saved quantiles and school points to '+db_file)
 
     # print top schools
     print('Top 5 Schools\n')
     print('    ID   Points   Name')
     rank = 1
     for index, value in sorted_school_points.head(5).items():
-        school_name = schools_df.loc[schools_df['id'] == index, 'school'].values[0]
+        school_name = registry.school_name(index)
         print(f' {rank}. {index}  {str(value).rjust(3)}      {school_name}')
         rank += 1
     print('')
     
+    # rankings, certificate workbooks for each test, and the pdf printouts for teachers are independent so they are built at the same time
+    data_df_final['name'] = registry.names_for(data_df_final)
+    report_path = os.path.join(results_folder, "MaST-School_Report"+file_date_tag+".pdf")
+    school_folder = None
+    if per_school:
+        school_folder = os.path.join(results_folder, 'MaST-School_Reports'+file_date_tag)
+        os.makedirs(school_folder, exist_ok=True)
     
-    # now make excel/csv file for printing certificates
-    print('Creating .csv files for printing student certificates...', end=' ')
+    # the school report is the slowest file, so it is split into shards of schools that are rendered in parallel and merged
+    num_shards = workers or os.cpu_count() or 1
+    shard_paths = []
+    artifacts = []
+    if num_shards > 1 and can_merge_pdfs():
+        for number, shard_df in enumerate(school_report_shards(data_df_final, num_shards), start=1):
+            shard_path = os.path.join(results_folder, "MaST-School_Report"+file_date_tag+f"-part{number}.pdf")
+            shard_paths.append(shard_path)
+            artifacts.append((shard_path, write_school_report_shard, (shard_df, registry.school_names, school_folder)))
+    else:
+        artifacts.append((report_path, write_school_report, (data_df_final, registry.school_names)))
+        if per_school:
+            # each run of schools is listed on its own, named by its first and last school
+            for shard_df in school_report_shards(data_df_final, num_shards):
+                first, last = shard_df['School ID'].min(), shard_df['School ID'].max()
+                artifacts.append((os.path.join(school_folder, f'schools {first}-{last}'), write_per_school_shard, (shard_df, registry.school_names)))
+    artifacts.append((os.path.join(results_folder, "MaST-School_Rankings"+file_date_tag+".xlsx"), write_rankings, (sorted_school_points, schools_df)))
+    # winners of every test from one lookup, each workbook only gets its own rows. Tests without winners still get a workbook
+    winners_df = award_winners(data_df_final, registry)
+    test_winners = dict(tuple(winners_df.groupby('Test', sort=False)))
+    for test in data_df_final['Test'].dropna().unique():
+        artifacts.append((os.path.join(results_folder, f'MaST-{test}_winners'+file_date_tag+'.xlsx'), write_winners, (test_winners.get(test, winners_df.iloc[:0]),)))
+    if mail_merge:
+        artifacts.append((os.path.join(results_folder, 'MaST-Certificates'+file_date_tag+'.csv'), write_certificates, (winners_df, registry.school_names)))
+    
+    # import fpdf here once so worker processes started by fork already have it
+    load_school_report_class()
+    print('Creating school rankings, certificate .xlsx files, and school report .pdf...\n')
     sleep(sleep_time)
+    failed = False
+    shard_failed = False
+    for file_path, result, error in build_artifacts(artifacts, workers):
+        file_name = os.path.relpath(file_path, results_folder)
+        if error is None:
+            print('   '+file_name.ljust(45)+green('Success').ljust(18)+f"{result['wall']:.2f} s")
+            logging.info(f"Results file {file_path} written in {result['wall']:.2f} s")
+            log_stage(result)
+        else:
+            failed = True
+            if file_path in shard_paths: shard_failed = True
+            print('   '+file_name.ljust(45)+red('Fail').ljust(18)+str(error))
+            logging.info(f'Tried and failed to write results file {file_path}: {error}')
     
-    # Define the list of percentiles to create tabs for
-    percentiles = [0.01, 0.02, 0.03, 0.10]
-    #percentiles = [0.02, 0.04, 0.06, 0.12]
-    
-    # Group the data by 'Subject'
-    tests_unique = data_df_final['Test'].unique()
-    
-    # Create an Excel file for each subject
-    for test in tests_unique:
-        # Filter data for the current subject
-        test_df = data_df_final[data_df_final['Test'] == test]
-
-        # Create an Excel writer object
-        file_path = os.path.join(results_folder, f'MaST-{test}_winners'+file_date_tag+'.xlsx')
-        with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
-            # Create a sheet for each percentile
-            for percentile in percentiles:
-                # Filter data for the current percentile
-                percentile_df = test_df[test_df['Award Quantile'] == percentile]
-
-                # Create a DataFrame with just the 'School ID' and 'Student ID' columns
-                ids_df = percentile_df[['School ID', 'Student ID']]
-                merged_df = pd.merge(ids_df, students_df, left_on=['School ID', 'Student ID'], right_on=['school id', 'student id'])
-                names_df = merged_df[['name']]
-##                names_df.reset_index(drop=True, inplace=True)
-                
-                # Write the DataFrame to the Excel sheet
-                names_df.to_excel(writer, sheet_name=str(percentile*100)+'%', index=False, header=['Name'])
+    # put the school report shards back together
+    if shard_paths:
+        file_name = os.path.basename(report_path)
+        if shard_failed:
+            print('   '+file_name.ljust(45)+red('Fail').ljust(18)+'Not all parts were written')
+            logging.info(f'Did not merge {report_path} because not all parts were written')
+        else:
+            stage = begin_stage('merge '+file_name)
+            merge_pdfs(shard_paths, report_path)
+            seconds = end_stage(stage, len(shard_paths))['wall']
+            print('   '+file_name.ljust(45)+green('Success').ljust(18)+f'{seconds:.2f} s to merge {len(shard_paths)} parts')
+            logging.info(f'Results file {report_path} merged from {len(shard_paths)} parts in {seconds:.2f} s')
+    print('')
+    
+    # final printing
+    print(f'** All result files can be found in the {results_folder} folder **\n')
+    if failed:
+        print(red('Some result files could not be written. See above.')+'\n')
+    else:
+        print('-- Program completed successfully. --')
+    
+
+# --- Combine ---
+
+# several sessions (tournament days) ranked together. Workbooks get a fixed created date so the same sessions always
+# give the same bytes, however many workers were used
+combine_folder = 'MaST-combined-'+str(current_year)
+combine_created = datetime(current_year, 1, 1)
+
+# session name from a data file name, MaST-data-2026-Sat.npz is 2026-Sat
+def session_name(data_file):
+    name = os.path.splitext(os.path.basename(data_file))[0]
+    return name[len('MaST-data-'):] if name.startswith('MaST-data-') else name
+
+# one session in a worker process: loads its data, grades any sheet not graded with the keys saved with it, and adds the
+# session's own Calc Quantile and School Points. With normalize, Normalized Score is the percentile rank of the score
+# within the session's sheets of that test so sessions with harder keys count the same. Returns the sheets and the
+# number graded
+def combine_session(data_file, normalize=False):
+    df = load_data(data_file)
+    graded, keys_hash = load_grading_cache(data_file)
+    keys_df = load_graded_keys(data_file)
+    num_graded = 0
+    if keys_df is not None:
+        df['Score'], _, _, num_graded = regrade_tests(df, keys_df, graded, keys_hash)
+    session_agg = make_agg_df(df)
+    df['Session Quantile'] = assign_quantiles(df, session_agg)
+    df['Session Points'] = assign_school_points(df.assign(**{'Calc Quantile': df['Session Quantile']}), session_agg)
+    if normalize:
+        df['Normalized Score'] = df.groupby('Test')['Score'].rank(method='average', pct=True)
+    df.insert(0, 'Session', session_name(data_file))
+    return df[[column for column in ['Session', 'School ID', 'Student ID', 'Test', 'Score', 'Normalized Score', 'Session Quantile', 'Session Points'] if column in df]], num_graded
+
+def combine_session_task(task):
+    return combine_session(*task)
+
+# all sessions in the order given, each graded and aggregated in its own process. Results come back in order so the
+# combined data is the same for any number of workers
+def combine_sessions(data_files, normalize=False, workers=None):
+    tasks = [(data_file, normalize) for data_file in data_files]
+    if workers == 1 or len(tasks) < 2:
+        return [combine_session_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(combine_session_task, tasks))
+
+# Calc Quantile and School Points over every session together, from the scores or the normalized scores. Returns the
+# combined sheets sorted like the final file and the quantiles of every test
+def combine_standings(sessions_df, normalize=False):
+    ranked_df = sessions_df.assign(Score=sessions_df['Normalized Score']) if normalize else sessions_df
+    combined_agg = make_agg_df(ranked_df)
+    combined_df = sessions_df.copy()
+    combined_df['Calc Quantile'] = assign_quantiles(ranked_df, combined_agg)
+    combined_df['School Points'] = assign_school_points(ranked_df.assign(**{'Calc Quantile': combined_df['Calc Quantile']}), combined_agg)
+    sort_column = 'Normalized Score' if normalize else 'Score'
+    return combined_df.sort_values(['Test', sort_column], ascending=[True, False], kind='stable'), combined_agg
+
+# School Points of every school in every session and combined, highest total first. Sessions are the session names in
+# the order the data files were given, which is the column order
+def combine_rankings(combined_df, sessions, school_names=None):
+    rankings_df = combined_df.pivot_table(index='School ID', columns='Session', values='School Points', aggfunc='sum', fill_value=0, sort=False)
+    rankings_df = rankings_df[sessions]
+    rankings_df['Total'] = combined_df.groupby('School ID')['School Points'].sum()
+    rankings_df = rankings_df.sort_values('Total', ascending=False, kind='stable')
+    rankings_df.insert(0, 'Rank', rankings_df['Total'].rank(method='min', ascending=False).astype(int))
+    if school_names is not None:
+        rankings_df.insert(1, 'school', rankings_df.index.map(school_names))
+    return rankings_df.rename_axis(None, axis=1)
+
+# workbook with one sheet per frame and the fixed created date
+def write_combined_workbook(sheets, file_path, index=True):
+    with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
+        writer.book.set_properties({'created': combine_created})
+        for sheet_name, frame in sheets.items():
+            frame.to_excel(writer, sheet_name=sheet_name, index=index)
+
+def combine_main(data_files, schools_file, normalize=False, workers=None):
+    print('-- Combine --\n')
+    data_files = [file for pattern in data_files for file in (sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])]
+    data_files = list(dict.fromkeys(data_files))
+    if len(data_files) < 2:
+        print(red('**')+' Combine needs the data files of at least two sessions, e.g. -f MaST-data-'+str(current_year)+'-Sat.npz MaST-data-'+str(current_year)+'-Sun.npz '+red('**'))
+        sys.exit()
+    for data_file in data_files:
+        if not os.path.exists(data_file):
+            print('-f '+data_file.ljust(30)+red('Fail'))
+            print('\nExiting')
+            logging.info('Tried and failed to find '+data_file+'. Script will exit.')
+            sys.exit()
+    school_names = None
+    if os.path.exists(schools_file):
+        schools_df = safe_open_excel('-s', schools_file)
+        school_names = Registry(pd.DataFrame(columns=['school id', 'student id', 'name', 'test 1', 'test 2']), schools_df).school_names
+    
+    # grading and per session standings run in parallel, one session per process
+    stage = begin_stage('sessions')
+    sessions = combine_sessions(data_files, normalize, workers)
+    for data_file, (session_df, num_graded) in zip(data_files, sessions):
+        print('-f '+data_file.ljust(30)+green('Success').ljust(18)+f'{len(session_df)} tests, {num_graded} graded')
+        logging.info(f'Combined {data_file} as session {session_name(data_file)} ({len(session_df)} tests, {num_graded} graded)')
+    sessions_df = pd.concat([session_df for session_df, _ in sessions], ignore_index=True)
+    session_names = list(sessions_df['Session'].unique())
+    end_stage(stage, len(sessions_df))
+    
+    print('\nCalculating combined quantiles and School Points...', end=' ')
+    stage = begin_stage('combined standings')
+    combined_df, combined_agg = combine_standings(sessions_df, normalize)
+    rankings_df = combine_rankings(combined_df, session_names, school_names)
+    end_stage(stage, len(combined_df))
     print(green('Done\n'))
-        
-    # make printouts for teachers
-    print('Creating .pdf file for school result summaries...', end=' ')
-    sleep(sleep_time)
-    data_df_final_grouped_schoolid = data_df_final.groupby('School ID')
-    pdf = FPDF(unit="mm", format="Letter")
+    print('Combined test totals\n')
+    totals = combined_df.pivot_table(index='Test', columns='Session', values='Score', aggfunc='count', fill_value=0, sort=True)[session_names]
+    totals['Total'] = totals.sum(axis=1)
+    print(totals.rename_axis(None, axis=1).to_markdown())
+    print('')
+    
+    print('Top 5 Schools\n')
+    print(rankings_df.head(5).to_markdown())
+    print('')
+    
+    os.makedirs(combine_folder, exist_ok=True)
+    stage = begin_stage('write combined')
+    year = str(current_year)
+    write_combined_workbook({'Rankings': rankings_df}, os.path.join(combine_folder, 'MaST-Combined_Rankings-'+year+'.xlsx'))
+    write_combined_workbook({'Data': combined_df, 'Quantiles': combined_agg.droplevel(0, axis=1)}, os.path.join(combine_folder, 'MaST-Combined_Data-'+year+'.xlsx'))
+    end_stage(stage, len(combined_df))
+    for file_name in ['MaST-Combined_Rankings-'+year+'.xlsx', 'MaST-Combined_Data-'+year+'.xlsx']:
+        print('   '+file_name.ljust(45)+green('Success'))
+        logging.info('Combined results written to '+os.path.join(combine_folder, file_name))
+    print(f'\n** Combined result files can be found in the {combine_folder} folder **\n')
+    print('-- Program completed successfully. --')
+
+# --- Data ---
+
+def data_main(data_file, migrate_file, export_file, db_file=None, history=None):
+    print('-- Data --\n')
+    if migrate_file is None and export_file is None and history is None:
+        print('Nothing to do. Specify --migrate, --export and/or --history.')
+        return
+    if migrate_file is not None:
+        print(f'Migrating {migrate_file} to {data_file}...', end=' ')
+        try:
+            df = migrate_csv_data(migrate_file, data_file)
+        except Exception as e:
+            print(red('Fail\n'))
+            print(f'An error occurred: {e}')
+            logging.info('Tried and failed to migrate '+migrate_file+'. Script will exit.')
+            sys.exit()
+        print(green('Done\n'))
+        logging.info('Migrated '+migrate_file+' to '+data_file+' ('+str(len(df))+' tests)')
+    if export_file is not None:
+        print(f'Exporting {data_file} to {export_file}...', end=' ')
+        try:
+            df = export_csv_data(data_file, export_file)
+        except Exception as e:
+            print(red('Fail\n'))
+            print(f'An error occurred: {e}')
+            logging.info('Tried and failed to export '+data_file+'. Script will exit.')
+            sys.exit()
+        print(green('Done\n'))
+        logging.info('Exported '+data_file+' to '+export_file+' ('+str(len(df))+' tests)')
+    if history is not None:
+        db_file = db_file or db_filename
+        if not os.path.exists(db_file):
+            print(red('**')+f' Did not find {db_file}. Run update and results mode with --db first. '+red('**'))
+            sys.exit()
+        history_df = school_history(db_file, int(history) if history != 'all' else None)
+        if history_df.empty:
+            print('No school points saved yet. Run results mode with --db first.\n')
+        else:
+            # one row per school and one column per tournament, oldest first
+            points = history_df.pivot(index='School ID', columns='tournament', values='School Points')
+            points = points[history_df.sort_values(['year', 'day'])['tournament'].unique()]
+            points.insert(0, 'school', history_df.groupby('School ID')['school'].last())
+            print(f'School Points by tournament from {db_file}\n')
+            print(points.to_markdown())
+            print('')
+    print('-- Program completed successfully. --')
+
+# --- Analyze ---
+
+# answer letters counted for each question, anything else (blank, double bubbled) counts as no answer
+answer_letters = 'ABCDE'
+# questions outside these limits are flagged in the analysis workbook
+analysis_limits = {'hard': 0.20, 'easy': 0.95, 'discrimination': 0.15}
+
+# statistics for every keyed question of one test at once. answer_matrix has one row of character codes per sheet
+# and key is the key row from keys_to_matrix (0 where a question has no key). Returns the per question table and the
+# summary of the whole test
+def item_analysis(answer_matrix, key):
+    questions = np.flatnonzero(key)
+    answers = answer_matrix[:, questions]
+    correct = (answers == key[questions]).astype(float)
+    num_sheets, num_questions = correct.shape
+    scores = correct.sum(axis=1)
+    
+    # difficulty is the fraction answering right, discrimination the correlation between answering right and the score,
+    # both with the whole score (point-biserial) and with the score on the other questions (item-rest)
+    p = correct.mean(axis=0)
+    item_var = p * (1 - p)
+    score_var = scores.var()
+    cov = (correct - p).T @ (scores - scores.mean()) / max(num_sheets, 1)
+    # the variance of the rest score comes out a rounding error away from 0 when it is 0, e.g. a one question key
+    rest_var = score_var - 2*cov + item_var
+    rest_var[rest_var < 1e-9 * max(score_var, 1)] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        point_biserial = cov / np.sqrt(item_var * score_var)
+        item_rest = np.where(rest_var > 0, (cov - item_var) / np.sqrt(item_var * rest_var), np.nan)
+        kr20 = num_questions / (num_questions - 1) * (1 - item_var.sum() / score_var) if num_questions > 1 and score_var > 0 else np.nan
+    
+    # share of sheets choosing each letter, compared all at once as a sheets x questions x letters cube
+    letters = np.frombuffer(answer_letters.encode(), dtype=np.uint8)
+    chosen = (answers[:, :, None] == letters).mean(axis=0)
+    
+    questions_df = pd.DataFrame({
+        'Question': questions + 1,
+        'Key': key[questions].view('S1').astype(str),
+        'Difficulty': p,
+        'Point Biserial': point_biserial,
+        'Item-Rest': item_rest,
+    })
+    for number, letter in enumerate(answer_letters):
+        questions_df[letter] = chosen[:, number]
+    questions_df['No Answer'] = (~np.isin(answers, letters)).mean(axis=0)
+    
+    # reasons to take a second look at a question
+    flags = [
+        (p < analysis_limits['hard'], 'hard'),
+        (p > analysis_limits['easy'], 'easy'),
+        (item_rest < analysis_limits['discrimination'], 'low discrimination'),
+        (item_rest < 0, 'negative discrimination'),
+        (chosen.max(axis=1, initial=0) > p, 'distractor chosen more than key'),
+    ]
+    questions_df['Check'] = [', '.join(reason for mask, reason in flags if mask[question]) for question in range(num_questions)]
     
-    # Function to add school data to the PDF
-    def add_school_to_pdf(school_id, group, pdf):
-        pdf.add_page()
+    sd = np.sqrt(score_var)
+    summary = {
+        'Sheets': num_sheets,
+        'Questions': num_questions,
+        'Mean Score': scores.mean() if num_sheets else np.nan,
+        'Standard Deviation': sd,
+        'KR-20': kr20,
+        'Standard Error of Measurement': sd * np.sqrt(1 - kr20) if kr20 <= 1 else np.nan,
+        'Questions to Check': int((questions_df['Check'] != '').sum()),
+    }
+    return questions_df, summary
+
+# item analysis of every key that graded sheets in df, as {key column: (questions_df, summary)}. Every form of a test is
+# analyzed on its own since its questions are in a different order
+def analyze_tests(df, keys_df):
+    key_index, key_matrix, _ = keys_to_matrix(keys_df)
+    answer_matrix = answers_to_matrix(df['Answers'], key_matrix.shape[1])
+    key_rows = sheet_key_rows(df, key_index)
+    rows = pd.Series(key_rows).groupby(key_rows).indices
+    return {key_column_name(test, form): item_analysis(answer_matrix[rows[number]], key_matrix[number]) for number, (test, form) in enumerate(key_index) if number in rows}
+
+# one workbook per test, the question table and the test summary on their own sheets
+def write_analysis(questions_df, summary, file_path):
+    with pd.ExcelWriter(file_path, engine='xlsxwriter') as writer:
+        questions_df.to_excel(writer, sheet_name='Questions', index=False)
+        pd.Series(summary, name='Value').rename_axis('Statistic').to_excel(writer, sheet_name='Summary')
+
+def analyze_main(data_file, keys_file, db_file=None):
+    print('-- Analyze --\n')
+    stage = begin_stage('load inputs')
+    if db_file:
+        db = Database(db_file)
+        stored = db.load_sheets()
+        keys_df = db.load_keys()
+        db.close()
+        if stored is None:
+            print(red('**')+f' No data for {file_date_tag[1:]} in {db_file}. Run update mode with --db first. '+red('**'))
+            sys.exit()
+        data_df = stored[0]
+        print('-d '+db_file.ljust(30)+green('Success'))
+        if keys_df is None: keys_df = safe_open_excel('-k', keys_file)
+    else:
+        try:
+            data_df = load_data(data_file)
+        except FileNotFoundError:
+            print('-d '+data_file.ljust(30)+red('Fail'))
+            print('\nRun update mode first. Exiting')
+            logging.info('Tried and failed to load '+data_file+'. Script will exit.')
+            sys.exit()
+        print('-d '+data_file.ljust(30)+green('Success'))
+        keys_df = safe_open_excel('-k', keys_file)
+    end_stage(stage, len(data_df))
+    
+    print('\nAnalyzing every question of every test...', end=' ')
+    stage = begin_stage('item analysis')
+    analysis = analyze_tests(data_df, keys_df)
+    end_stage(stage, len(data_df))
+    print(green('Done\n'))
+    summary_df = pd.DataFrame.from_dict({test: summary for test, (_, summary) in analysis.items()}, orient='index')
+    print(summary_df[['Sheets', 'Questions', 'Mean Score', 'KR-20', 'Questions to Check']].to_markdown(floatfmt=('', '.0f', '.0f', '.2f', '.2f', '.0f')))
+    print('')
+    
+    analysis_folder = 'MaST-analysis'+file_date_tag
+    os.makedirs(analysis_folder, exist_ok=True)
+    stage = begin_stage('write analysis')
+    for test, (questions_df, summary) in analysis.items():
+        file_path = os.path.join(analysis_folder, f'MaST-{test}_analysis'+file_date_tag+'.xlsx')
+        write_analysis(questions_df, summary, file_path)
+        print('   '+os.path.basename(file_path).ljust(45)+green('Success'))
+        logging.info('Item analysis written to '+file_path)
+    end_stage(stage, len(analysis))
+    print(f'\n** Item analysis files can be found in the {analysis_folder} folder **\n')
+    print('-- Program completed successfully. --')
+
+# --- Serve ---
+
+# command line flag of each input spreadsheet, for the status lines
+input_flags = {'keys': '-k', 'students': '-i', 'schools': '-s'}
+
+# long running grader. Keys, students and schools are loaded once and reloaded only when their files change, new .dat
+# files dropped in watch_folder or POSTed to /upload are graded as they arrive, and the standings are kept current for the
+# json endpoints. All pipeline access goes through lock since the http server answers from its own threads
+class GradingService:
+    def __init__(self, pipeline, input_files, watch_folder, workers=None):
+        self.pipeline = pipeline
+        self.input_files = input_files
+        self.input_mtimes = {name: os.path.getmtime(file) for name, file in input_files.items() if file}
+        self.watch_folder = watch_folder
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.seen = {}
+        self.batches = []
+        self.updated = None
+        # modification time of each input file that failed to load, so the failure is only reported once per save
+        self.failed_inputs = {}
+    
+    # grades whatever is new and refreshes the standings, call with lock held
+    def refresh(self):
+        pipeline = self.pipeline
+        if len(pipeline.data_df):
+            pipeline.apply_journal()
+            num_graded = pipeline.grade()
+            pipeline.save()
+            pipeline.standings()
+        else:
+            num_graded = 0
+        self.updated = str(datetime.now())
+        return num_graded
+    
+    # reloads any input spreadsheet whose file changed, new keys regrade everything on the next refresh. A file that is
+    # missing, half saved or not a spreadsheet keeps the previous keys or registrations and is tried again on the next
+    # poll, so the service keeps running while someone fixes it. Returns the names reloaded
+    def reload_inputs(self):
+        mtimes = {}
+        for name in self.input_mtimes:
+            try:
+                mtimes[name] = os.path.getmtime(self.input_files[name])
+            except OSError:
+                mtimes[name] = None
+        changed = [name for name, mtime in self.input_mtimes.items() if mtimes[name] != mtime]
+        reloaded = []
+        for names, load in [(['keys'], lambda: self.pipeline.set_keys(self.input_files['keys'])),
+                            (['students', 'schools'], lambda: self.pipeline.set_students(self.input_files['students'], self.input_files.get('schools')))]:
+            names = [name for name in names if name in changed]
+            if not names: continue
+            try:
+                for name in names:
+                    if mtimes[name] is None: raise FileNotFoundError('No such file '+self.input_files[name])
+                load()
+            except Exception as e:
+                failed = {name: mtimes[name] for name in names}
+                if any(self.failed_inputs.get(name, 0) != mtime for name, mtime in failed.items()):
+                    print(input_flags[names[0]]+' '+self.input_files[names[0]].ljust(30)+red('Fail').ljust(18)+'Keeping the previous version: '+str(e))
+                    logging.info('serve: could not reload '+', '.join(self.input_files[name] for name in names)+', keeping the previous version: '+repr(e))
+                self.failed_inputs.update(failed)
+                continue
+            for name in names:
+                self.input_mtimes[name] = mtimes[name]
+                self.failed_inputs.pop(name, None)
+                print(input_flags[name]+' '+self.input_files[name].ljust(30)+green('Reloaded'))
+                logging.info('Reloaded '+self.input_files[name])
+            reloaded += names
+        return reloaded
+    
+    # adds and grades one batch of ascii files, returns a summary of it
+    def process(self, files):
+        with self.lock:
+            stage = begin_stage('serve batch')
+            start = perf_counter()
+            summary = self.pipeline.add_ascii(files, self.workers)
+            num_graded = self.refresh() if any(status == 'loaded' for _, status, _ in summary) else 0
+            batch = {
+                'files': [{'file': file, 'status': status, 'detail': str(detail) if status == 'failed' else detail} for file, status, detail in summary],
+                'graded': num_graded,
+                'tests': len(self.pipeline.data_df),
+                'seconds': perf_counter() - start,
+                'time': self.updated,
+            }
+            end_stage(stage, num_graded)
+            self.batches.append(batch)
+        for file, status, detail in summary:
+            flag = {'loaded': green('Success'), 'skipped': blue('Skipped'), 'failed': red('Fail')}[status]
+            print('-a '+os.path.basename(file).ljust(30)+flag)
+            logging.info(f'serve: {status} {file} ({detail})')
+        print(f"   {num_graded} graded, {batch['tests']} tests in total, {batch['seconds']*1000:.0f} ms\n")
+        return batch
+    
+    # looks for .dat files in the watch folder that are new or changed since the last look
+    def poll(self):
+        with self.lock:
+            if self.reload_inputs():
+                self.refresh()
+        found = []
+        for file in sorted(glob.glob(os.path.join(self.watch_folder, '*.dat'))):
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                continue
+            if self.seen.get(file) != (stat.st_mtime_ns, stat.st_size):
+                self.seen[file] = (stat.st_mtime_ns, stat.st_size)
+                found.append(file)
+        if found: return self.process(found)
+        return None
+    
+    # saves an uploaded file to the watch folder and grades it right away
+    def upload(self, name, content):
+        name = os.path.basename(name)
+        if not name.lower().endswith('.dat'): raise ValueError('Only .dat files can be uploaded')
+        file = os.path.join(self.watch_folder, name)
+        with tempfile.NamedTemporaryFile(dir=self.watch_folder, suffix='.part', delete=False) as f:
+            f.write(content)
+        os.replace(f.name, file)
+        stat = os.stat(file)
+        self.seen[file] = (stat.st_mtime_ns, stat.st_size)
+        return self.process([file])
+    
+    def status(self):
+        with self.lock:
+            data_df = self.pipeline.data_df
+            counts = data_df['Test'].value_counts().sort_index() if len(data_df) else pd.Series(dtype=int)
+            return {
+                'tests': {str(test): int(count) for test, count in counts.items()},
+                'total': len(data_df),
+                'batches': len(self.batches),
+                'last_batch': self.batches[-1] if self.batches else None,
+                'updated': self.updated,
+                'data_file': self.pipeline.db.filename if self.pipeline.db is not None else self.pipeline.data_file,
+                'watch_folder': self.watch_folder,
+            }
+    
+    def issues(self):
+        with self.lock:
+            return [{'kind': issue.kind, 'index': json_value(issue.index), **{field: json_value(value) for field, value in issue.values.items()}} for issue in self.pipeline.issues()]
+    
+    # provisional rankings from the calculated quantiles, final rankings still come from results mode
+    def rankings(self):
+        with self.lock:
+            if not len(self.pipeline.data_df): return []
+            school_points = self.pipeline.school_points()
+            return [{'rank': rank, 'School ID': json_value(school_id), 'school': self.pipeline.registry.school_name(school_id), 'points': json_value(points)}
+                    for rank, (school_id, points) in enumerate(school_points.items(), start=1)]
+
+# GET /status, /issues and /rankings return json, POST /upload?name=FILE.dat with the file as the body adds a batch
+def make_request_handler(service):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+    
+    class RequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            content = json.dumps(body, indent=2).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
         
-        # Set title
-        pdf.set_font("Helvetica", size=12)
-        pdf.cell(200, 8, text="Mississippi College", new_x="LMARGIN", new_y="NEXT", align='C')
-        pdf.cell(200, 8, text="Math & Science Tournament", new_x="LMARGIN", new_y="NEXT", align='C')
-        current_date = str(current_month)+' '+str(current_day)+', '+str(current_year)
-        pdf.cell(200, 8, text=current_date, new_x="LMARGIN", new_y="NEXT", align='C')
-        pdf.ln(4)
-        school_name = schools_df.loc[schools_df['id'] == school_id, 'school'].values[0]
-        pdf.cell(200, 8, text=f"{school_name} (ID: {school_id})", new_x="LMARGIN", new_y="NEXT", align='C')
+        def do_GET(self):
+            routes = {'/status': service.status, '/issues': service.issues, '/rankings': service.rankings}
+            path = urlparse(self.path).path.rstrip('/') or '/status'
+            if path not in routes:
+                self.send_json(404, {'error': 'Unknown path '+path, 'paths': list(routes)+['/upload']})
+                return
+            try:
+                self.send_json(200, routes[path]())
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
         
-        # Set column headers
-        pdf.set_font("Helvetica", size=10)
-        pdf.cell(10, 8, text="ID", border=1, align='C')
-        pdf.cell(60, 8, text="Student Name", border=1)
-        pdf.cell(60, 8, text="Test", border=1)
-        pdf.cell(20, 8, text="Score", border=1, align='C')
-        pdf.cell(20, 8, text="Percentile", border=1, align='C')
-        pdf.ln()
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path.rstrip('/') != '/upload':
+                self.send_json(404, {'error': 'Unknown path '+url.path})
+                return
+            name = parse_qs(url.query).get('name', ['upload-'+datetime.now().strftime('%H%M%S%f')+'.dat'])[0]
+            try:
+                content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.send_json(200, service.upload(name, content))
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
         
-        # Add rows
-        for index, row in group.iterrows():
-            pdf.cell(10, 8, text=str(row['Student ID']), border=1, align='C')
-            pdf.cell(60, 8, text=students_df.loc[(students_df['school id'] == school_id) & (students_df['student id'] == row['Student ID']), 'name'].values[0], border=1)
-            pdf.cell(60, 8, text=str(row['Test']), border=1)
-            pdf.cell(20, 8, text=str(row['Score']), border=1, align='C')
-            pdf.cell(20, 8, text="{:.0f}".format(row['Calc Quantile']*100), border=1, align='C')
-            pdf.ln()
-    
-    # Add each school's data to the PDF
-    for school_id, group in data_df_final_grouped_schoolid:
-        add_school_to_pdf(school_id, group, pdf)
-    
-    # Save the PDF
-    file_path = os.path.join(results_folder, "MaST-School_Report"+file_date_tag+".pdf")
-    pdf.output(file_path)
-    print(green('Done\n'))
+        def log_message(self, format, *args):
+            logging.info('serve: '+self.address_string()+' '+format % args)
     
-    # final printing
-    print(f'** All result files can be found in the {results_folder} folder **\n')
-    print('-- Program completed successfully. --')
+    return RequestHandler
+
+def serve_main(keys_file, students_file, schools_file, watch_folder, host='127.0.0.1', port=8765, interval=2.0, workers=None, db_file=None, form_column=None):
+    print('-- Serve --\n')
+    keys_df = safe_open_excel('-k', keys_file)
+    students_df = safe_open_excel('-i', students_file)
+    schools_df = safe_open_excel('-s', schools_file)
+    pipeline = Pipeline(keys_df, students_df, schools_df, db_file=db_file, form_column=form_column)
+    require_form_column(pipeline)
+    
+    # pick up where update mode left off
+    if pipeline.migrate() is not None:
+        logging.info('Migrated old .csv data to '+pipeline.data_file)
+    if pipeline.load():
+        print(f'\nLoaded {len(pipeline.data_df)} tests from {db_file or pipeline.data_file}')
+    os.makedirs(watch_folder, exist_ok=True)
+    service = GradingService(pipeline, {'keys': keys_file, 'students': students_file, 'schools': schools_file}, watch_folder, workers)
+    with service.lock:
+        service.refresh()
     
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), make_request_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'\nWatching {watch_folder} for new .dat files every {interval:g} s')
+    print(f'Serving http://{host}:{server.server_address[1]}/status, /issues, /rankings and POST /upload?name=FILE.dat')
+    print('Press Ctrl+C to stop\n')
+    logging.info(f'Serving on {host}:{server.server_address[1]}, watching {watch_folder}')
+    
+    try:
+        while True:
+            service.poll()
+            sleep(interval)
+    except KeyboardInterrupt:
+        print('\nStopping')
+    finally:
+        server.shutdown()
+        server.server_close()
+    print('\nRun update mode with --ascii none'+(' --db '+db_file if db_file else '')+' to write the final Excel file.\n')
+    print('-- Program completed successfully. --')
+
 
 def main():
     # command line argparser
     parser = argparse.ArgumentParser(description= "MC Math & Science Tournament Grader & Analysis.")
-    subparsers = parser.add_subparsers(dest='command', help="Specify either 'update' or 'results'.", required=True)
+    subparsers = parser.add_subparsers(dest='command', help="Specify either 'update', 'rekey', 'results', 'combine', 'analyze', 'serve', or 'data'.", required=True)
 
     # sub-parser for update function
     parser_update = subparsers.add_parser('update', help='Update data and generate CSV file.')
-    parser_update.add_argument('-a', '--ascii', type=str, default='MaST-Raw.dat', help='Location of ascii file from Scantron.\n(Default: MaST-ascii.dat')
+    parser_update.add_argument('-a', '--ascii', type=str, nargs='+', default=['MaST-Raw.dat'], help='Location of ascii files from Scantron. Accepts several files, folders of .dat files, and patterns like \'MaST-ascii-*.dat\'.\n(Default: MaST-Raw.dat')
     parser_update.add_argument('-k', '--keys', type=str, default='MaST-Keys.xlsx', help='Location of excel file with test keys.\n(Default: MaST-Keys.xlsx')
     parser_update.add_argument('-i', '--students', default='MaST-Students.xlsx', help='Location of excel file with student registration information.\n(Default: MaST-Students.xlsx')
     parser_update.add_argument('--no_lost', action='store_true', help='Specify to not print missing tests. Helpful at beginning when not all scantron files have been processed.')
+    parser_update.add_argument('--full_regrade', action='store_true', help='Specify to regrade every test. By default only new or edited tests are graded unless the keys file changed.')
+    parser_update.add_argument('-w', '--workers', type=int, default=None, help='Number of processes used to read ascii files.\n(Default: number of CPUs)')
+    parser_update.add_argument('--non_interactive', action='store_true', help='Specify to never stop for user input. Problems are written to MaST-issues-YEAR-DAY.csv to be fixed in a later run.')
+    parser_update.add_argument('--skip_final', action='store_true', help='Specify to not rewrite the final Excel file. Helpful while many scantron files are still being processed.')
+    parser_update.add_argument('--similar', nargs='?', const='test', choices=['test', 'school'], default=None, help='Specify to flag pairs of answer sheets of the same test with far more identical wrong answers than chance, e.g. a rescan under a wrong id or copying. Give school to only compare sheets from the same school. Pairs are saved to MaST-similar-YEAR-DAY.csv.')
+    parser_update.add_argument('--form_column', type=int, default=None, help='Position of the bubbled form code in each ascii line, counting the first character as 1, for tests with several answer key forms. (Default: no form code)')
+    parser_update.add_argument('--no_cache', '--no-cache', dest='no_cache', action='store_true', help='Specify to always parse the Excel files instead of using the copies saved in '+cache_folder+'.')
+    parser_update.add_argument('--db', nargs='?', const=db_filename, default=None, metavar='FILE', help='Keep the data in this SQLite database instead of the day\'s data files, for queries across days and years. (Default with no FILE: '+db_filename+')')
+    parser_update.add_argument('--profile', action='store_true', help='Specify to save cProfile data for every stage to a MaST-profile-YEAR-DAY folder.')
+
+    # sub-parser for key corrections
+    parser_rekey = subparsers.add_parser('rekey', help='Rescore only the questions changed in the keys file and report what changed.')
+    parser_rekey.add_argument('-k', '--keys', type=str, default='MaST-Keys.xlsx', help='Location of the corrected excel file with test keys.\n(Default: MaST-Keys.xlsx)')
+    parser_rekey.add_argument('-d', '--data', default='MaST-data-final'+file_date_tag+'.xlsx', help='Location of the final data excel file whose hand edited Award Quantiles are kept. It is rewritten with the new scores.\n(Default: MaST-data-final'+file_date_tag+'.xlsx)')
+    parser_rekey.add_argument('--reset_awards', action='store_true', help='Specify to replace hand edited Award Quantiles with the new Calc Quantiles.')
+    parser_rekey.add_argument('--skip_final', action='store_true', help='Specify to not rewrite the final Excel file.')
+    parser_rekey.add_argument('--no_cache', '--no-cache', dest='no_cache', action='store_true', help='Specify to always parse the Excel files instead of using the copies saved in '+cache_folder+'.')
+    parser_rekey.add_argument('--db', nargs='?', const=db_filename, default=None, metavar='FILE', help='Use the data kept in this SQLite database by update mode. (Default with no FILE: '+db_filename+')')
+    parser_rekey.add_argument('--profile', action='store_true', help='Specify to save cProfile data for every stage to a MaST-profile-YEAR-DAY folder.')
 
     # sub-parser for results parser
     parser_results = subparsers.add_parser('results', help='Read in final csv file and tally results. No new data will be configured.')
-    data_filename = 'MaST-data-final'+file_date_tag+'.xlsx'
-    parser_results.add_argument('-d', '--data', default=data_filename, help='Location of final datat excel file made with update mode.\n(Default: '+data_filename+')')
+    final_filename = 'MaST-data-final'+file_date_tag+'.xlsx'
+    parser_results.add_argument('-d', '--data', default=final_filename, help='Location of final datat excel file made with update mode.\n(Default: '+final_filename+')')
     parser_results.add_argument('-i', '--students', default='MaST-Students.xlsx', help='Location of excel file with student registration information.\n(Default: MaST-Students.xlsx')
     parser_results.add_argument('-s', '--schools', default='MaST-Schools.xlsx', help='Location of excel file with school information.\n(Default: MaST-Schools.xlsx')
+    parser_results.add_argument('-w', '--workers', type=int, default=None, help='Number of processes used to write result files.\n(Default: number of CPUs)')
+    parser_results.add_argument('--per_school', action='store_true', help='Specify to also write one school report .pdf per school, e.g. for emailing.')
+    parser_results.add_argument('--mail_merge', action='store_true', help='Specify to also write every winner of every test to MaST-Certificates-YEAR-DAY.csv for a mail merge to print certificates.')
+    parser_results.add_argument('--no_cache', '--no-cache', dest='no_cache', action='store_true', help='Specify to always parse the Excel files instead of using the copies saved in '+cache_folder+'.')
+    parser_results.add_argument('--db', nargs='?', const=db_filename, default=None, metavar='FILE', help='Also save the award quantiles and school points to this SQLite database. (Default with no FILE: '+db_filename+')')
+    parser_results.add_argument('--profile', action='store_true', help='Specify to save cProfile data for every stage to a MaST-profile-YEAR-DAY folder.')
+
+    # sub-parser for combined standings over several sessions
+    parser_combine = subparsers.add_parser('combine', help='Rank schools over several sessions, e.g. every day of the tournament, together.')
+    parser_combine.add_argument('-f', '--files', nargs='+', default=['MaST-data-'+str(current_year)+'-*.npz'], help='Data files made with update mode, one per session. Accepts patterns.\n(Default: MaST-data-'+str(current_year)+'-*.npz)')
+    parser_combine.add_argument('-s', '--schools', default='MaST-Schools.xlsx', help='Location of excel file with school information, for school names if it exists.\n(Default: MaST-Schools.xlsx)')
+    parser_combine.add_argument('--normalize', action='store_true', help='Specify to rank every test by percentile within its session instead of by raw score, so sessions with harder or easier keys count the same.')
+    parser_combine.add_argument('-w', '--workers', type=int, default=None, help='Number of processes used to grade and aggregate sessions.\n(Default: number of CPUs)')
+    parser_combine.add_argument('--no_cache', '--no-cache', dest='no_cache', action='store_true', help='Specify to always parse the Excel files instead of using the copies saved in '+cache_folder+'.')
+    parser_combine.add_argument('--profile', action='store_true', help='Specify to save cProfile data for every stage to a MaST-profile-YEAR-DAY folder.')
+
+    # sub-parser for item analysis
+    parser_analyze = subparsers.add_parser('analyze', help='Write per question difficulty, discrimination and answer choices for every test.')
+    parser_analyze.add_argument('-f', '--file', default=data_filename, help='Location of data file made with update mode.\n(Default: '+data_filename+')')
+    parser_analyze.add_argument('-k', '--keys', type=str, default='MaST-Keys.xlsx', help='Location of excel file with test keys, not needed with --db.\n(Default: MaST-Keys.xlsx)')
+    parser_analyze.add_argument('--db', nargs='?', const=db_filename, default=None, metavar='FILE', help='Read the data and keys from this SQLite database instead. (Default with no FILE: '+db_filename+')')
+    parser_analyze.add_argument('--no_cache', '--no-cache', dest='no_cache', action='store_true', help='Specify to always parse the Excel files instead of using the copies saved in '+cache_folder+'.')
+    parser_analyze.add_argument('--profile', action='store_true', help='Specify to save cProfile data for every stage to a MaST-profile-YEAR-DAY folder.')
+
+    # sub-parser for the grading service
+    parser_serve = subparsers.add_parser('serve', help='Grade new ascii files as they arrive and serve the standings as JSON on localhost.')
+    parser_serve.add_argument('-k', '--keys', type=str, default='MaST-Keys.xlsx', help='Location of excel file with test keys.\n(Default: MaST-Keys.xlsx)')
+    parser_serve.add_argument('-i', '--students', default='MaST-Students.xlsx', help='Location of excel file with student registration information.\n(Default: MaST-Students.xlsx)')
+    parser_serve.add_argument('-s', '--schools', default='MaST-Schools.xlsx', help='Location of excel file with school information.\n(Default: MaST-Schools.xlsx)')
+    parser_serve.add_argument('--watch', default='MaST-incoming', help='Folder to watch for new ascii .dat files.\n(Default: MaST-incoming)')
+    parser_serve.add_argument('--host', default='127.0.0.1', help='Address to serve on.\n(Default: 127.0.0.1, this computer only)')
+    parser_serve.add_argument('--port', type=int, default=8765, help='Port to serve on.\n(Default: 8765)')
+    parser_serve.add_argument('--interval', type=float, default=2.0, help='Seconds between looks at the watch folder.\n(Default: 2)')
+    parser_serve.add_argument('-w', '--workers', type=int, default=None, help='Number of processes used to read ascii files.\n(Default: number of CPUs)')
+    parser_serve.add_argument('--form_column', type=int, default=None, help='Position of the bubbled form code in each ascii line, counting the first character as 1, for tests with several answer key forms. (Default: no form code)')
+    parser_serve.add_argument('--db', nargs='?', const=db_filename, default=None, metavar='FILE', help='Keep the data in this SQLite database instead of the day\'s data files, for queries across days and years. (Default with no FILE: '+db_filename+')')
+    parser_serve.add_argument('--no_cache', '--no-cache', dest='no_cache', action='store_true', help='Specify to always parse the Excel files instead of using the copies saved in '+cache_folder+'.')
+
+    # sub-parser for data store maintenance
+    parser_data = subparsers.add_parser('data', help='Migrate an old .csv data file or export the data file to .csv for Excel.')
+    parser_data.add_argument('-f', '--file', default=data_filename, help='Location of data file made with update mode.\n(Default: '+data_filename+')')
+    parser_data.add_argument('--migrate', default=None, help='Convert an old MaST-data-YEAR-DAY.csv file into the data file. Overwrites the data file.')
+    parser_data.add_argument('--export', default=None, help='Write the data file out to this .csv file.')
+    parser_data.add_argument('--db', default=db_filename, metavar='FILE', help='SQLite database used by --history.\n(Default: '+db_filename+')')
+    parser_data.add_argument('--history', nargs='?', const='all', default=None, metavar='SCHOOL_ID', help='Print the School Points of every school, or just SCHOOL_ID, at every tournament saved in the database.')
 
     args = parser.parse_args()
+    global use_cache, profile_folder
+    use_cache = not getattr(args, 'no_cache', False)
+    logging.basicConfig(filename=logfile, level = logging.INFO, format="%(asctime)s %(message)s")
+    setup_terminal()
+    started = datetime.now()
+    # the form column is counted from 1 on the command line and from 0 like ascii_id_columns in the code
+    form_column = args.form_column - 1 if getattr(args, 'form_column', None) is not None else None
+    try:
+        check_form_column(form_column)
+    except ValueError as e:
+        parser.error(str(e).replace('Form column', '--form_column'))
+    if getattr(args, 'profile', False):
+        profile_folder = os.path.join('MaST-profile'+file_date_tag, args.command+'-'+started.strftime('%H%M%S'))
 
     print('\n-- MaST.py @author: D. Brandon Magers --\n')
     logging.info('--------------------')
-    logging.info('MaST.py '+args.command+' script began in '+cwd+'at '+str(datetime.now()))
+    logging.info('MaST.py '+args.command+' script began in '+cwd+'at '+str(started))
 
-    if args.command == 'update':
-        update_main(args.ascii, args.keys, args.students, args.no_lost)
-    elif args.command == 'results':
-        results_main(args.data, args.students, args.schools)
-    else:
-        parser.print_help()
+    # stage timings are saved even when the run exits early
+    try:
+        if args.command == 'update':
+            update_main(args.ascii, args.keys, args.students, args.no_lost, args.full_regrade, args.skip_final, args.workers, args.non_interactive, args.db, form_column, args.similar)
+        elif args.command == 'rekey':
+            rekey_main(args.keys, args.data, args.reset_awards, args.db, args.skip_final)
+        elif args.command == 'results':
+            results_main(args.data, args.students, args.schools, args.workers, args.per_school, args.db, args.mail_merge)
+        elif args.command == 'combine':
+            combine_main(args.files, args.schools, args.normalize, args.workers)
+        elif args.command == 'analyze':
+            analyze_main(args.file, args.keys, args.db)
+        elif args.command == 'serve':
+            serve_main(args.keys, args.students, args.schools, args.watch, args.host, args.port, args.interval, args.workers, args.db, form_column)
+        elif args.command == 'data':
+            data_main(args.file, args.migrate, args.export, args.db, args.history)
+        else:
+            parser.print_help()
+    finally:
+        if stage_records or open_stages:
+            write_stage_report(args.command, started)
+            logging.info('Stage timings written to '+stages_filename)
+        if profile_folder is not None and os.path.isdir(profile_folder):
+            print('cProfile data for every stage saved to '+profile_folder+'\n')
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Item analysis check for MaST.py
+
+analyze_tests works out the statistics of every question of every key at once from the packed answer and key
+matrices. This check builds random keys files (several forms, blank key cells, keys of different lengths) and
+random answer sheets (blanks, double bubbles, sheets shorter than the key), and compares every number analyze mode
+reports with a direct computation from the answer strings, one question at a time: difficulty, point-biserial and
+item-rest with np.corrcoef, the share choosing each letter, and KR-20, the standard error of measurement and the
+mean score from their textbook formulas. Run from anywhere with
+
+python benchmarks/check_analysis.py [--trials 40] [--seed 0]
+
+It stops at the first trial with a difference and prints what differs.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import MaST
+
+# characters a scanned answer can be besides a letter, blank and a double bubble
+other_answers = [' ', '*']
+
+# a keys file with up to three forms per test, a few blank key cells and keys of different lengths padded with blanks
+# at the bottom the way Excel reads them back
+def random_keys(rng):
+    columns = {}
+    for test in rng.choice(list(MaST.tests.values()), int(rng.integers(1, 4)), replace=False):
+        num_forms = int(rng.integers(1, 4))
+        for form in (['A', 'B', 'C'][:num_forms] if num_forms > 1 else ['']):
+            key = list(rng.choice(list(MaST.answer_letters), int(rng.integers(2, 60))).astype(object))
+            for question in rng.choice(len(key), int(rng.integers(0, 3)), replace=False):
+                key[question] = np.nan
+            columns[MaST.key_column_name(test, form)] = pd.Series(key, dtype=object)
+    return pd.DataFrame(columns)
+
+# sheets for every key column, answering right more often the better the student so the correlations mean something
+def random_sheets(rng, keys_df):
+    rows = []
+    for column in keys_df.columns:
+        test, form = MaST.split_key_column(column)
+        key = keys_df[column].dropna().index.max() + 1
+        for _ in range(int(rng.integers(2, 300))):
+            ability = rng.random()
+            length = key if rng.random() > 0.1 else int(rng.integers(0, key + 1))
+            answers = []
+            for question in range(length):
+                if keys_df[column].notna()[question] and rng.random() < ability:
+                    answers.append(keys_df[column][question])
+                else:
+                    answers.append(rng.choice(list(MaST.answer_letters) + other_answers))
+            rows.append({'Test': test, 'Form': form, 'Answers': ''.join(answers)})
+    return pd.DataFrame(rows)
+
+# the analysis of one key column straight from the answer strings
+def direct_analysis(df, keys_df, column):
+    test, form = MaST.split_key_column(column)
+    sheets = df[(df['Test'] == test) & ((df['Form'] == form) if form else True)]['Answers'].tolist()
+    key = keys_df[column]
+    questions = [question for question in range(len(key)) if isinstance(key[question], str)]
+    answer = lambda sheet, question: sheet[question] if question < len(sheet) else ''
+    correct = np.array([[answer(sheet, question) == key[question] for question in questions] for sheet in sheets], dtype=float)
+    scores = correct.sum(axis=1)
+    rows = []
+    for number, question in enumerate(questions):
+        item = correct[:, number]
+        # corrcoef warns and gives nan when every sheet answered the same way, like item_analysis
+        with np.errstate(divide='ignore', invalid='ignore'):
+            point_biserial = np.corrcoef(item, scores)[0, 1]
+            item_rest = np.corrcoef(item, scores - item)[0, 1]
+        row = {'Question': question + 1, 'Key': key[question], 'Difficulty': item.mean(), 'Point Biserial': point_biserial, 'Item-Rest': item_rest}
+        for letter in MaST.answer_letters:
+            row[letter] = np.mean([answer(sheet, question) == letter for sheet in sheets])
+        row['No Answer'] = np.mean([answer(sheet, question) not in list(MaST.answer_letters) for sheet in sheets])
+        rows.append(row)
+    k = len(questions)
+    p = correct.mean(axis=0)
+    kr20 = k / (k - 1) * (1 - (p * (1 - p)).sum() / scores.var()) if k > 1 and scores.var() > 0 else np.nan
+    summary = {'Sheets': len(sheets), 'Questions': k, 'Mean Score': scores.mean(), 'Standard Deviation': scores.std(), 'KR-20': kr20,
+               'Standard Error of Measurement': scores.std() * np.sqrt(1 - kr20) if kr20 <= 1 else np.nan}
+    return pd.DataFrame(rows), summary
+
+# raises AssertionError with what differs between analyze_tests and the direct analysis of df
+def compare(df, keys_df):
+    analysis = MaST.analyze_tests(df, keys_df)
+    assert sorted(analysis) == sorted(keys_df.columns), f'analyzed {sorted(analysis)}, keys {sorted(keys_df.columns)}'
+    for column, (questions_df, summary) in analysis.items():
+        expected_df, expected_summary = direct_analysis(df, keys_df, column)
+        # only nan and the last few bits may differ, the two compute the same sums in a different order
+        pd.testing.assert_frame_equal(questions_df[expected_df.columns], expected_df, check_dtype=False, rtol=1e-9, atol=1e-12, obj=column)
+        for name, value in expected_summary.items():
+            assert np.isclose(summary[name], value, rtol=1e-9, atol=1e-12, equal_nan=True), f'{column} {name}: {summary[name]} instead of {value}'
+
+def run_trial(rng):
+    keys_df = random_keys(rng)
+    df = random_sheets(rng, keys_df)
+    compare(df, keys_df)
+    return len(keys_df.columns), len(df)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the item analysis against a direct computation.')
+    parser.add_argument('--trials', type=int, default=40, help='Number of random keys files. (Default: 40)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. (Default: 0)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    total_keys = total_sheets = 0
+    for trial in range(args.trials):
+        try:
+            num_keys, num_sheets = run_trial(rng)
+        except AssertionError as e:
+            print(f'Trial {trial} (seed {args.seed}): item analysis differs from the direct computation\n{e}')
+            sys.exit(1)
+        total_keys += num_keys
+        total_sheets += num_sheets
+    print(f'{args.trials} trials, {total_keys} keys, {total_sheets} sheets: item analysis equals the direct computation')
+
+if __name__ == '__main__':
+    main()
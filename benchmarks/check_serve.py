@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Serve check for MaST.py
+
+Serve mode has to keep running when one of its input spreadsheets can't be read, e.g. while someone is saving it or
+after a bad copy. This check starts serve mode on the SAMPLE files in a scratch folder, grades a batch, then
+overwrites the keys file with garbage and deletes the schools file. Serve mode has to stay up, keep answering with the
+previous keys, and grade a new batch with them. Once good files are back it has to reload them. Run from anywhere with
+
+python benchmarks/check_serve.py [--port 8799]
+
+It stops at the first step that fails and prints the end of the serve output.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(repo, 'MaST.py')
+interval = 0.2
+
+def get(port, path):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=10) as response:
+        return json.loads(response.read())
+
+def upload(port, name, content):
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/upload?name={name}', data=content, method='POST')
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+# waits until condition() is true, False if it isn't after timeout seconds or serve mode exits
+def wait_for(server, condition, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        if server.poll() is not None: return False
+        try:
+            if condition(): return True
+        except OSError:
+            pass
+        time.sleep(interval)
+    return False
+
+# saves a file with a new modification time, even on file systems with coarse timestamps
+def rewrite(file, content):
+    old_mtime = os.path.getmtime(file) if os.path.exists(file) else None
+    with open(file, 'wb') as f:
+        f.write(content)
+    if old_mtime is not None and os.path.getmtime(file) == old_mtime:
+        os.utime(file, (old_mtime + 1, old_mtime + 1))
+
+def run_check(folder, port, log):
+    for name in ['MaST-Keys', 'MaST-Students', 'MaST-Schools']:
+        shutil.copy(os.path.join(repo, name+'-SAMPLE.xlsx'), os.path.join(folder, name+'.xlsx'))
+    with open(os.path.join(repo, 'MaST-ascii-1-SAMPLE.dat'), 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    good_keys = open(os.path.join(folder, 'MaST-Keys.xlsx'), 'rb').read()
+    good_schools = open(os.path.join(folder, 'MaST-Schools.xlsx'), 'rb').read()
+
+    server = subprocess.Popen([sys.executable, script, 'serve', '--port', str(port), '--interval', str(interval), '--no_cache'],
+                              cwd=folder, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        assert wait_for(server, lambda: get(port, '/status')), 'serve mode did not start'
+        first = upload(port, 'first.dat', b''.join(lines[:len(lines)//2]))
+        assert first['graded'] > 0, f'first batch was not graded: {first}'
+
+        # a keys file that isn't a spreadsheet and a schools file that is gone
+        rewrite(os.path.join(folder, 'MaST-Keys.xlsx'), b'not a spreadsheet')
+        os.remove(os.path.join(folder, 'MaST-Schools.xlsx'))
+        time.sleep(10 * interval)
+        assert server.poll() is None, f'serve mode exited with code {server.returncode} after the keys file broke'
+        second = upload(port, 'second.dat', b''.join(lines[len(lines)//2:]))
+        assert second['graded'] > 0, f'second batch was not graded with the previous keys: {second}'
+        assert get(port, '/rankings'), 'no rankings while the inputs are broken'
+
+        # good files again are picked up on the next poll
+        rewrite(os.path.join(folder, 'MaST-Keys.xlsx'), good_keys)
+        rewrite(os.path.join(folder, 'MaST-Schools.xlsx'), good_schools)
+        assert wait_for(server, lambda: log_text(log).count('Reloaded') >= 2), 'the fixed keys and schools files were not reloaded'
+        assert get(port, '/status')['total'] == len(lines), 'sheets went missing'
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+def log_text(log):
+    log.flush()
+    with open(log.name, errors='replace') as f:
+        return f.read()
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that serve mode keeps running when an input spreadsheet breaks.')
+    parser.add_argument('--port', type=int, default=8799, help='Port for the serve mode under test. (Default: 8799)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'serve.out'), 'w+') as log:
+            try:
+                run_check(folder, args.port, log)
+            except AssertionError as e:
+                print(f'Serve check failed: {e}\n')
+                print('\n'.join(log_text(log).splitlines()[-20:]))
+                sys.exit(1)
+    print('serve mode kept running with a broken keys file and a missing schools file, and reloaded them once fixed')
+
+if __name__ == '__main__':
+    main()
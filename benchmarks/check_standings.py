@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Standings check for MaST.py
+
+Standings keeps the quantiles, award bands and school points up to date from score histograms instead of recomputing
+them from every sheet. It has to give exactly what the batch functions make_agg_df, assign_quantiles and
+assign_school_points give on the same data, to the last bit. This check builds random tournaments batch by batch,
+with random corrections of the test, school id and score of earlier sheets and sheets of tests that can't be graded,
+and compares both after every step. Run from anywhere with
+
+python benchmarks/check_standings.py [--trials 40] [--seed 0]
+
+It stops at the first trial with a difference and prints what differs.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import MaST
+
+# most scores a test can have in a trial
+max_scores = {'Biology': 100, 'Chemistry': 60, 'Mathematics': 40, 'Physics': 60, 'Computer Science': 100}
+
+# sheets for num_schools schools, a few of them with an improper test that has no key and so no score
+def random_sheets(rng, num_sheets, num_schools, improper_rate):
+    tests = rng.choice(list(max_scores), num_sheets).astype(object)
+    improper = rng.random(num_sheets) < improper_rate
+    tests[improper] = 'Improper'
+    # narrow score ranges make ties on the quantile thresholds likely
+    top = np.array([max_scores.get(test, 1) for test in tests])
+    scores = np.minimum(rng.integers(0, rng.integers(5, 101), num_sheets), top).astype(float)
+    scores[improper] = np.nan
+    return pd.DataFrame({'School ID': rng.integers(100, 100 + num_schools, num_sheets), 'Test': tests, 'Score': scores})
+
+# changes the test, school id or score of a few earlier sheets, like a correction in update mode followed by a regrade
+def correct_sheets(rng, df, num_corrections, num_schools):
+    for index in rng.choice(len(df), min(num_corrections, len(df)), replace=False):
+        field = rng.choice(['Test', 'School ID', 'Score'])
+        if field == 'Test':
+            test = rng.choice(list(max_scores) + ['Improper'])
+            df.at[index, 'Test'] = test
+            df.at[index, 'Score'] = np.nan if test == 'Improper' else float(rng.integers(0, max_scores[test] + 1))
+        elif field == 'School ID':
+            df.at[index, 'School ID'] = rng.integers(100, 100 + num_schools)
+        elif df.at[index, 'Test'] != 'Improper':
+            df.at[index, 'Score'] = float(rng.integers(0, max_scores[df.at[index, 'Test']] + 1))
+
+# the batch path of update and results mode on all of df: quantiles and award bands of the graded sheets, 0 School
+# Points for the rest, and the schools ranked by their total
+def batch_standings(df):
+    graded_df = df.dropna(subset=['Score'])
+    data_df_agg = MaST.make_agg_df(graded_df)
+    calc_quantiles = MaST.assign_quantiles(graded_df, data_df_agg)
+    data_df_final = df.copy()
+    data_df_final['Calc Quantile'] = calc_quantiles
+    data_df_final['School Points'] = 0
+    data_df_final.loc[graded_df.index, 'School Points'] = MaST.assign_school_points(data_df_final.loc[graded_df.index], data_df_agg)
+    return data_df_agg, calc_quantiles, MaST.rank_schools(data_df_final)
+
+# histogram_percentiles against np.percentile on random scores, at the q_options percentiles and random ones
+def check_percentiles(rng):
+    scores = rng.integers(0, rng.integers(1, 101), int(rng.integers(1, 5000)))
+    percentiles = np.concatenate([np.array(MaST.q_options) * 100, rng.random(20) * 100, [0, 100]])
+    expected = np.percentile(scores, percentiles, method='linear')
+    result = MaST.histogram_percentiles(np.bincount(scores), percentiles)
+    assert np.array_equal(result, expected), f'percentiles of {len(scores)} scores differ at {percentiles[result != expected]}'
+
+# raises AssertionError with what differs between the incremental and batch standings of df
+def compare(tally, df):
+    data_df_agg, calc_quantiles, school_points = batch_standings(df)
+    pd.testing.assert_frame_equal(tally.agg(), data_df_agg, check_exact=True, check_dtype=False)
+    graded_df = df.dropna(subset=['Score'])
+    incremental = tally.calc_quantiles(graded_df)
+    assert (incremental.to_numpy() == calc_quantiles.to_numpy()).all(), 'Calc Quantile differs'
+    pd.testing.assert_series_equal(tally.school_points(), school_points, check_exact=True, check_dtype=False, check_index_type=False)
+    # ties in the ranking have to come out in the same order too
+    assert list(tally.school_points().index) == list(school_points.index), 'school ranking order differs'
+
+def run_trial(rng):
+    num_schools = int(rng.integers(2, 40))
+    improper_rate = rng.choice([0, 0.02, 0.1])
+    tally = MaST.Standings()
+    df = pd.DataFrame(columns=['School ID', 'Test', 'Score'])
+    for _ in range(50):
+        check_percentiles(rng)
+    steps = 0
+    for _ in range(int(rng.integers(2, 8))):
+        batch = random_sheets(rng, int(rng.integers(1, 400)), num_schools, improper_rate)
+        df = pd.concat([df, batch], ignore_index=True) if len(df) else batch
+        tally.update(df)
+        compare(tally, df)
+        correct_sheets(rng, df, int(rng.integers(0, 10)), num_schools)
+        tally.update(df)
+        compare(tally, df)
+        steps += 2
+    return steps, len(df)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that the incremental standings equal the batch standings.')
+    parser.add_argument('--trials', type=int, default=40, help='Number of random tournaments. (Default: 40)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. (Default: 0)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    total_steps = total_sheets = 0
+    for trial in range(args.trials):
+        try:
+            steps, num_sheets = run_trial(rng)
+        except AssertionError as e:
+            print(f'Trial {trial} (seed {args.seed}): incremental standings differ from the batch standings\n{e}')
+            sys.exit(1)
+        total_steps += steps
+        total_sheets += num_sheets
+    print(f'{args.trials} trials, {total_steps} steps, {total_sheets} sheets: incremental standings equal the batch standings')
+
+if __name__ == '__main__':
+    main()
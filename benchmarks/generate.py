@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic tournament generator for MaST.py
+
+Writes a schools, students and keys workbook plus Scantron ASCII files in the same formats as the SAMPLE files, so
+update and results mode can be run on tournaments of any size. Run from anywhere with
+
+python benchmarks/generate.py -o FOLDER [--schools N] [--students N] [--error_rate R] ...
+
+and then run MaST.py from inside FOLDER with the default file names. A fraction --error_rate of the answer sheets get
+one of the mistakes update mode looks for (blank school or student id, improper test number, the same sheet scanned
+twice, a student that isn't registered).
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import MaST
+
+# how many questions each test has, same as MaST-Keys-SAMPLE.xlsx
+test_lengths = {'Biology': 100, 'Chemistry': 60, 'Mathematics': 40, 'Physics': 60, 'Computer Science': 100}
+# how often each test is picked, roughly the registrations in MaST-Students-SAMPLE.xlsx
+test_weights = {'Biology': 0.20, 'Chemistry': 0.41, 'Mathematics': 0.17, 'Physics': 0.09, 'Computer Science': 0.13}
+error_kinds = ['blank_school', 'blank_student', 'improper_test', 'duplicate', 'unregistered']
+ascii_header = b'720000006001020918001   5321 #001    N  '
+letters = np.frombuffer(b'ABCDE', dtype=np.uint8)
+
+first_names = ['Liam', 'Emily', 'Michael', 'Olivia', 'James', 'Ava', 'Noah', 'Sophia', 'Riley', 'Brooklyn', 'Alexander', 'Mia']
+last_names = ['Smith', 'Johnson', 'Taylor', 'Barnes', 'Carter', 'Thomas', 'Brown', 'Davis', 'Wilson', 'Moore', 'Clark', 'Lewis']
+
+def make_schools(num_schools):
+    ids = np.arange(100, 100+num_schools)
+    return pd.DataFrame({
+        'id': ids,
+        'school': [f'SCHOOL {school_id} H.S.' for school_id in ids],
+        'address': [f'{school_id} School St' for school_id in ids],
+        'city': 'JACKSON',
+        'zip': 39201,
+        'phone': [f'555-123-{school_id:04d}' for school_id in ids],
+        'county': 'HINDS',
+        'principal': 'principal name',
+        'contact': 'contact name',
+        'div': (ids % 4 + 1).astype(float),
+        'day': np.where(ids % 2, 'T', 'F'),
+        'students': 12,
+    })
+
+# every school registers students_per_school students, each taking two different tests
+def make_students(schools_df, students_per_school, test_names, rng):
+    school_ids = np.repeat(schools_df['id'].to_numpy(), students_per_school)
+    student_ids = np.tile(np.arange(1, students_per_school+1), len(schools_df))
+    weights = np.array([test_weights.get(test, 0.1) for test in test_names])
+    weights = weights/weights.sum()
+    first = rng.choice(len(test_names), size=len(school_ids), p=weights)
+    if len(test_names) > 1:
+        second = (first + rng.integers(1, len(test_names), size=len(school_ids))) % len(test_names)
+        test_2 = np.array(test_names, dtype=object)[second]
+    else:
+        test_2 = np.full(len(school_ids), np.nan, dtype=object)
+    return pd.DataFrame({
+        'school id': school_ids,
+        'student id': student_ids,
+        'name': [first_names[i % 12]+' '+last_names[(i // 12) % 12] for i in range(len(school_ids))],
+        'address': '123 Maple Street',
+        'city': 'Jackson',
+        'zip': 39201,
+        'gender': np.where(rng.random(len(school_ids)) < 0.5, 'M', 'F'),
+        'test 1': np.array(test_names, dtype=object)[first],
+        'test 2': test_2,
+    })
+
+def make_keys(test_names, rng):
+    keys = {}
+    for test in test_names:
+        column = np.full(max(test_lengths.values()), np.nan, dtype=object)
+        column[:test_lengths[test]] = letters[rng.integers(0, 5, size=test_lengths[test])].view('S1').astype(str)
+        keys[test] = column
+    return pd.DataFrame(keys)
+
+# one ascii line per answer sheet. Every student has an ability, the chance of answering each question right
+def make_sheets(students_df, keys_df, rng):
+    test_numbers = {test: number for number, test in MaST.tests.items()}
+    sheets = []
+    ability = rng.beta(2, 3, size=len(students_df))
+    for column in ['test 1', 'test 2']:
+        for test, group in students_df.groupby(column):
+            key = keys_df[test].dropna().to_numpy().astype('S1').view(np.uint8)
+            right = rng.random((len(group), len(key))) < ability[group.index.to_numpy()][:, None]
+            answers = np.where(right, key, letters[rng.integers(0, 5, size=(len(group), len(key)))])
+            for school_id, student_id, row in zip(group['school id'], group['student id'], answers):
+                sheets.append([f'{school_id:03d}{student_id:02d}'.encode(), test_numbers[test].encode(), row.tobytes()])
+    return sheets
+
+# applies one mistake to about error_rate of the sheets
+def add_errors(sheets, error_rate, students_per_school, rng):
+    marked = np.flatnonzero(rng.random(len(sheets)) < error_rate)
+    kinds = rng.integers(0, len(error_kinds), size=len(marked))
+    extra = []
+    for index, kind in zip(marked, kinds):
+        sheet_id, test, answers = sheets[index]
+        kind = error_kinds[kind]
+        if kind == 'blank_school':
+            sheets[index][0] = b'   '+sheet_id[3:]
+        elif kind == 'blank_student':
+            sheets[index][0] = sheet_id[:3]+b'  '
+        elif kind == 'improper_test':
+            sheets[index][1] = b'7'
+        elif kind == 'duplicate':
+            extra.append(list(sheets[index]))
+        elif kind == 'unregistered':
+            sheets[index][0] = sheet_id[:3]+f'{students_per_school+1:02d}'.encode()
+    return sheets + extra
+
+def format_sheet(sheet_id, test, answers):
+    return ascii_header+sheet_id+b'     '+test+b'     '+answers
+
+# writes MaST-Schools.xlsx, MaST-Students.xlsx, MaST-Keys.xlsx and MaST-ascii-1.dat ... MaST-ascii-N.dat to folder.
+# Returns the list of ascii files and the number of answer sheets
+def generate_tournament(folder, num_schools=34, students_per_school=12, test_names=None, error_rate=0.0, num_files=3, seed=0):
+    if not 1 <= num_schools <= 900:
+        raise ValueError('School ids are 3 digits starting at 100, so there can be 1 to 900 schools')
+    if not 1 <= students_per_school <= 98:
+        raise ValueError('Student ids are 2 digits and one more is needed for unregistered students, so there can be 1 to 98 students per school')
+    test_names = list(test_names or test_lengths)
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    schools_df = make_schools(num_schools)
+    students_df = make_students(schools_df, students_per_school, test_names, rng)
+    keys_df = make_keys(test_names, rng)
+    schools_df.to_excel(os.path.join(folder, 'MaST-Schools.xlsx'), index=False)
+    students_df.to_excel(os.path.join(folder, 'MaST-Students.xlsx'), index=False)
+    keys_df.to_excel(os.path.join(folder, 'MaST-Keys.xlsx'), index=False)
+
+    # sheets come off the scanner in no particular order and are split into batches
+    sheets = add_errors(make_sheets(students_df, keys_df, rng), error_rate, students_per_school, rng)
+    order = rng.permutation(len(sheets))
+    ascii_files = []
+    for number, batch in enumerate(np.array_split(order, max(1, num_files)), start=1):
+        ascii_file = os.path.join(folder, f'MaST-ascii-{number}.dat')
+        with open(ascii_file, 'wb') as f:
+            f.write(b'\n'.join(format_sheet(*sheets[index]) for index in batch))
+        ascii_files.append(ascii_file)
+    return ascii_files, len(sheets)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic MaST tournament.')
+    parser.add_argument('-o', '--output', required=True, help='Folder to write the files to.')
+    parser.add_argument('--schools', type=int, default=34, help='Number of schools. (Default: 34)')
+    parser.add_argument('--students', type=int, default=12, help='Number of students per school. (Default: 12)')
+    parser.add_argument('--tests', nargs='+', choices=list(test_lengths), default=list(test_lengths), help='Tests offered. (Default: all five)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of answer sheets with a mistake. (Default: 0)')
+    parser.add_argument('--files', type=int, default=3, help='Number of ascii files. (Default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. (Default: 0)')
+    args = parser.parse_args()
+
+    ascii_files, num_sheets = generate_tournament(args.output, args.schools, args.students, args.tests, args.error_rate, args.files, args.seed)
+    print(f'Wrote {args.schools} schools, {args.schools*args.students} students and {num_sheets} answer sheets in {len(ascii_files)} ascii files to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Scale benchmark for MaST.py
+
+Generates synthetic tournaments with generate.py at several multiples of the sample tournament (about 150 students
+taking 2 tests each) and times each stage of update and results mode on them. Run from anywhere with
+
+python benchmarks/scale.py [--scales 1 10 100] [--compare OLD.json]
+
+Timings are saved to benchmarks/results/scale-YYYYMMDD-HHMMSS.json (or --output) so a later run can be compared
+against them with --compare. Tournaments larger than 12 students per school or school ids above 425 don't fit the
+limits in MaST.py, so those limits are raised for the run.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+benchmarks_folder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarks_folder))
+sys.path.insert(0, benchmarks_folder)
+import MaST
+from generate import generate_tournament
+
+base_students = 150
+
+# picks a school count and school size for about students registered students, filling schools of 12 first
+def tournament_shape(students):
+    num_schools = min(900, max(1, math.ceil(students/MaST.num_students_per_school)))
+    return num_schools, math.ceil(students/num_schools)
+
+# best of repeat runs of function, and its last return value
+def best_time(function, repeat):
+    best = math.inf
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        best = min(best, perf_counter() - start)
+    return best, result
+
+# times every stage on one generated tournament in folder and fills result with the timings. Each stage is timed on
+# its own with the inputs the real pipeline would hand it, then update and results mode are timed end to end
+def run_scale(result, folder, scale, error_rate, repeat, workers):
+    num_schools, students_per_school = tournament_shape(base_students*scale)
+    ascii_files, num_sheets = generate_tournament(folder, num_schools, students_per_school, error_rate=error_rate, seed=scale)
+    result.update({'schools': num_schools, 'students_per_school': students_per_school, 'sheets': num_sheets})
+    MaST.max_school_id = max(MaST.max_school_id, 99+num_schools)
+    MaST.num_students_per_school = max(MaST.num_students_per_school, students_per_school)
+    MaST.use_cache = False
+    stages = result['stages']
+
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            stages['read_ascii'], results = best_time(lambda: MaST.read_ascii_files(ascii_files, workers), repeat)
+            df = pd.concat(results, ignore_index=True)
+            stages['load_excel'], (keys_df, students_df, schools_df) = best_time(lambda: (MaST.safe_open_excel('-k', 'MaST-Keys.xlsx'), MaST.safe_open_excel('-i', 'MaST-Students.xlsx'), MaST.safe_open_excel('-s', 'MaST-Schools.xlsx')), repeat)
+            stages['registry'], registry = best_time(lambda: MaST.Registry(students_df, schools_df), repeat)
+            stages['validate'], _ = best_time(lambda: MaST.validate(df, registry=registry), repeat)
+            stages['grade'], (scores, _) = best_time(lambda: MaST.grade_tests(df, keys_df), repeat)
+            df['Score'] = scores
+            stages['save_data'], _ = best_time(lambda: MaST.save_data(df, 'benchmark.npz'), repeat)
+            stages['load_data'], _ = best_time(lambda: MaST.load_data('benchmark.npz'), repeat)
+            def quantiles():
+                agg = MaST.make_agg_df(df)
+                return MaST.assign_quantiles(df, agg)
+            stages['quantiles'], df['Calc Quantile'] = best_time(quantiles, repeat)
+            df['Award Quantile'] = df['Calc Quantile']
+            stages['write_final'], _ = best_time(lambda: df.sort_values(by=['Test', 'Score'], ascending=[True, False]).to_excel('benchmark-final.xlsx'), repeat)
+
+            # end to end, one run each since update mode adds to its data file
+            start = perf_counter()
+            MaST.update_main(ascii_files, 'MaST-Keys.xlsx', 'MaST-Students.xlsx', no_lost=False, workers=workers, non_interactive=True)
+            stages['update'] = perf_counter() - start
+            start = perf_counter()
+            MaST.results_main('MaST-data-final'+MaST.file_date_tag+'.xlsx', 'MaST-Students.xlsx', 'MaST-Schools.xlsx', workers)
+            stages['results'] = perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+def print_report(report, baseline=None):
+    for scale, result in report['scales'].items():
+        print(f"\n{scale}x: {result['schools']} schools, {result['students_per_school']} students per school, {result['sheets']} answer sheets")
+        old = (baseline or {}).get('scales', {}).get(scale, {}).get('stages', {})
+        print(f'   {"stage":<14}{"seconds":>10}' + (f'{"baseline":>10}{"ratio":>8}' if old else ''))
+        for stage, seconds in result['stages'].items():
+            line = f'   {stage:<14}{seconds:>10.3f}'
+            if stage in old:
+                line += f'{old[stage]:>10.3f}{seconds/old[stage] if old[stage] else math.inf:>8.2f}'
+            print(line)
+        if 'error' in result:
+            print('   failed: '+result['error'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Time MaST.py stages on synthetic tournaments.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='Multiples of the sample tournament to run. (Default: 1 10 100)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of answer sheets with a mistake. (Default: 0)')
+    parser.add_argument('--repeat', type=int, default=3, help='Each stage is run this many times and the best time kept. (Default: 3)')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of processes for the pooled stages. (Default: number of CPUs)')
+    parser.add_argument('--output', default=None, help='Where to save the timings. (Default: benchmarks/results/scale-YYYYMMDD-HHMMSS.json)')
+    parser.add_argument('--compare', default=None, help='Earlier timings .json file to compare against.')
+    args = parser.parse_args()
+
+    report = {
+        'created': str(datetime.now()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'scales': {},
+    }
+    for scale in args.scales:
+        result = report['scales'][str(scale)] = {'schools': 0, 'students_per_school': 0, 'sheets': 0, 'stages': {}}
+        with tempfile.TemporaryDirectory() as folder:
+            try:
+                run_scale(result, folder, scale, args.error_rate, args.repeat, args.workers)
+            except (Exception, SystemExit) as e:
+                result['error'] = repr(e)
+
+    output = args.output or os.path.join(benchmarks_folder, 'results', 'scale-'+datetime.now().strftime('%Y%m%d-%H%M%S')+'.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f'\nTimings saved to {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark for MaST.py
+
+Times fresh interpreter runs of the cheap entry points (import, --help) and compares them with importing the
+libraries MaST.py used to load eagerly on every start. Run from anywhere with
+
+python benchmarks/startup.py [-n RUNS] [--baseline OLD_MaST.py]
+
+--baseline also times --help for another copy of MaST.py, e.g. one checked out from an older commit.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(repo, 'MaST.py')
+
+# median wall time of a fresh python process running args, in a scratch folder so no log files are left behind
+def time_command(args, runs, folder):
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        subprocess.run([sys.executable] + args, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(perf_counter() - start)
+    return median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Time MaST.py startup.')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='Number of runs per command. (Default: 10)')
+    parser.add_argument('--baseline', default=None, help='Another MaST.py to time --help for, e.g. an older version.')
+    args = parser.parse_args()
+
+    commands = [
+        ('python -c pass', ['-c', 'pass']),
+        ('import MaST', ['-c', 'import sys; sys.path.insert(0, '+repr(repo)+'); import MaST']),
+        ('MaST.py --help', [script, '--help']),
+        ('MaST.py results --help', [script, 'results', '--help']),
+        ('eager imports (old startup cost)', ['-c', 'import numpy, pandas, fpdf, colorama, ast']),
+    ]
+    if args.baseline:
+        commands.append(('baseline --help', [os.path.abspath(args.baseline), '--help']))
+
+    with tempfile.TemporaryDirectory() as folder:
+        print(f'{"command":<36}{"median (ms)":>12}')
+        for label, command in commands:
+            print(f'{label:<36}{time_command(command, args.runs, folder)*1000:>12.1f}')
+
+if __name__ == '__main__':
+    main()